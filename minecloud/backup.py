@@ -0,0 +1,602 @@
+"""
+Incremental, deduplicated Minecraft world backups to S3, and restores.
+
+A world is split into fixed-size chunks, and each chunk is stored once,
+zlib-compressed, under the SHA-1 of its contents. A backup uploads only
+the chunks S3 doesn't already have, then writes a small manifest listing
+the chunks of every file. Fixed-size chunks work well for worlds, since
+the game rewrites region files in place, 4 KiB sector at a time, so an
+unchanged part of a file always produces the same chunks.
+
+Layout of the bucket, under the world's prefix:
+
+    chunks/<sha1>                   compressed chunk
+    manifests/<timestamp>.json.gz   one per backup
+    latest                          name of the newest manifest
+
+This module is run on the game server, so it only depends on boto (and
+redis, to report progress). Usage:
+
+    python -m minecloud.backup backup <world dir> [--reply-to <list>]
+    python -m minecloud.backup restore <world dir> [--reply-to <list>]
+                                       [--ready-command <command>]
+    python -m minecloud.backup gc [--keep <n>]
+
+The bucket and prefix default to the MSM_S3_BUCKET and MSM_S3_PREFIX env
+variables. Set MSM_S3_ENDPOINT (e.g. "http://localhost:4567") to use a
+local S3 stand-in instead of S3.
+
+"""
+import calendar
+import datetime
+import gzip
+import hashlib
+import json
+import optparse
+import os
+import Queue
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+from cStringIO import StringIO
+
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_THREADS = 8
+DOWNLOAD_THREADS = 8
+MANIFEST_VERSION = 1
+
+# Region files within this many regions of the spawn region are restored
+# before the game server is started.
+SPAWN_RADIUS = 1
+REGION_RE = re.compile(r'^(?:.*/)?r\.(-?\d+)\.(-?\d+)\.mc[ar]$')
+
+
+class S3Store(object):
+    """
+    Stores named blobs under `prefix` in an S3 bucket.
+
+    Safe to use from several threads: each thread gets its own boto
+    connection.
+
+    """
+    def __init__(self, bucket_name, prefix='', endpoint=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix + '/' if prefix else ''
+        self.endpoint = endpoint
+        self._local = threading.local()
+
+    @property
+    def bucket(self):
+        if getattr(self._local, 'bucket', None) is None:
+            self._local.bucket = self._connect().get_bucket(self.bucket_name,
+                                                            validate=False)
+        return self._local.bucket
+
+    def _connect(self):
+        import boto
+        from boto.s3.connection import OrdinaryCallingFormat
+        if not self.endpoint:
+            return boto.connect_s3()
+        url = urlparse.urlparse(self.endpoint)
+        return boto.connect_s3(host=url.hostname, port=url.port,
+                               is_secure=(url.scheme == 'https'),
+                               calling_format=OrdinaryCallingFormat())
+
+    def list(self, prefix=''):
+        """Yield (name, last modified timestamp) of the stored blobs."""
+        from boto.utils import parse_ts
+        for key in self.bucket.list(prefix=self.prefix + prefix):
+            modified = calendar.timegm(parse_ts(key.last_modified).timetuple())
+            yield key.name[len(self.prefix):], modified
+
+    def get(self, name):
+        key = self.bucket.get_key(self.prefix + name)
+        if key is None:
+            return None
+        return key.get_contents_as_string()
+
+    def put(self, name, data):
+        self.bucket.new_key(self.prefix + name).set_contents_from_string(data)
+
+    def delete(self, names):
+        names = [self.prefix + name for name in names]
+        for i in range(0, len(names), 1000):
+            self.bucket.delete_keys(names[i:i + 1000])
+
+
+class WorkerPool(object):
+    """
+    Calls `func` with each queued item, from a pool of threads.
+
+    At most 2 * `threads` items wait in the queue at a time; put() blocks
+    when the queue is full. close() waits for all items to be done and
+    raises the first error, if there was one.
+
+    """
+    def __init__(self, func, threads):
+        self.func = func
+        self.queue = Queue.Queue(maxsize=threads * 2)
+        self.error = None
+        self.failed = threading.Event()
+        self.threads = [threading.Thread(target=self._run)
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.func(*item)
+                except Exception as e:
+                    self.error = e
+                    self.failed.set()
+
+    def put(self, *item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def chunk_name(digest):
+    return 'chunks/%s' % digest
+
+
+def iter_chunks(path, chunk_size=CHUNK_SIZE):
+    """Yield (SHA-1 hex digest, data) for each chunk of a file."""
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            yield hashlib.sha1(data).hexdigest(), data
+
+
+def walk_world(world_dir):
+    """Yield (relative path, os.stat result) for each file of a world."""
+    for root, dirs, files in os.walk(world_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            yield os.path.relpath(path, world_dir), os.stat(path)
+
+
+def dump_manifest(manifest):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(json.dumps(manifest, sort_keys=True))
+    return buf.getvalue()
+
+
+def load_manifest(store, name=None):
+    """Return the manifest called `name` (or the latest one), or None."""
+    if name is None:
+        name = store.get('latest')
+        if name is None:
+            return None
+    data = store.get(name)
+    if data is None:
+        return None
+    with gzip.GzipFile(fileobj=StringIO(data)) as f:
+        return json.loads(f.read())
+
+
+def backup(store, world_dir, threads=UPLOAD_THREADS, progress=None):
+    """
+    Back up `world_dir`, uploading only the chunks `store` doesn't have.
+
+    Files whose size and modification time match the previous backup
+    aren't even read. Only the chunks the previous backup references are
+    reused: gc never deletes the latest manifest, but may delete any
+    other chunk while the backup runs, so those are uploaded again,
+    which also restarts gc's grace period. `progress`, if given, is
+    called with (bytes done, bytes total) as the backup proceeds.
+    Returns the name of the new manifest, and a dict of statistics.
+
+    """
+    previous = load_manifest(store)
+    previous_files = previous['files'] if previous else {}
+    if previous and previous.get('chunk_size') != CHUNK_SIZE:
+        previous_files = {}
+    referenced = set()
+    for entry in previous_files.values():
+        referenced.update(entry['chunks'])
+    stored = referenced.intersection(
+        name.split('/')[-1] for name, modified in store.list('chunks/'))
+
+    world = list(walk_world(world_dir))
+    total = sum(st.st_size for relpath, st in world)
+    stats = {'files': len(world), 'bytes': total,
+             'uploaded_chunks': 0, 'uploaded_bytes': 0}
+    done = 0
+
+    files = {}
+    uploader = WorkerPool(store.put, threads)
+    try:
+        for relpath, st in world:
+            entry = {'size': st.st_size,
+                     'mtime': int(st.st_mtime),
+                     'mode': st.st_mode & 0o777}
+            old = previous_files.get(relpath)
+            if (old and old['size'] == entry['size'] and
+                    old['mtime'] == entry['mtime']):
+                entry['chunks'] = old['chunks']
+            else:
+                entry['chunks'] = []
+                path = os.path.join(world_dir, relpath)
+                for digest, data in iter_chunks(path):
+                    entry['chunks'].append(digest)
+                    if digest not in stored:
+                        stored.add(digest)
+                        compressed = zlib.compress(data)
+                        uploader.put(chunk_name(digest), compressed)
+                        stats['uploaded_chunks'] += 1
+                        stats['uploaded_bytes'] += len(compressed)
+            files[relpath] = entry
+            done += st.st_size
+            if progress:
+                progress(done, total)
+    finally:
+        uploader.close()
+
+    created = datetime.datetime.utcnow()
+    manifest = {'version': MANIFEST_VERSION,
+                'created': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'chunk_size': CHUNK_SIZE,
+                'files': files}
+    name = 'manifests/%s.json.gz' % created.strftime('%Y%m%dT%H%M%S.%fZ')
+    store.put(name, dump_manifest(manifest))
+    store.put('latest', name)
+    return name, stats
+
+
+def gc(store, keep=10, grace=24*60*60):
+    """
+    Delete all but the newest `keep` manifests, and unreferenced chunks.
+
+    Chunks uploaded less than `grace` seconds ago are kept, since they
+    may belong to a backup that is still running. Returns the number of
+    manifests and chunks deleted.
+
+    """
+    manifests = sorted(name for name, modified in store.list('manifests/'))
+    latest = store.get('latest')
+    old = [name for name in manifests[:max(len(manifests) - keep, 0)]
+           if name != latest]
+    store.delete(old)
+
+    referenced = set()
+    for name in manifests:
+        if name in old:
+            continue
+        manifest = load_manifest(store, name)
+        for entry in manifest['files'].values():
+            referenced.update(entry['chunks'])
+
+    cutoff = time.time() - grace
+    unreferenced = [name for name, modified in store.list('chunks/')
+                    if name.split('/')[-1] not in referenced and
+                    modified < cutoff]
+    store.delete(unreferenced)
+    return len(old), len(unreferenced)
+
+
+def spawn_region(level_dat):
+    """
+    Return the (x, z) coordinates of the region holding the world spawn.
+
+    Rather than parsing the NBT in `level_dat`, looks for the SpawnX and
+    SpawnZ int tags. Returns (0, 0) if they can't be found.
+
+    """
+    try:
+        with gzip.open(level_dat, 'rb') as f:
+            data = f.read()
+    except (IOError, zlib.error):
+        return 0, 0
+    coords = []
+    for tag in ('SpawnX', 'SpawnZ'):
+        header = struct.pack('>bh', 3, len(tag)) + tag
+        i = data.find(header)
+        if i < 0:
+            return 0, 0
+        i += len(header)
+        coords.append(struct.unpack('>i', data[i:i + 4])[0] >> 9)
+    return tuple(coords)
+
+
+def restore_order(relpath, spawn):
+    """
+    Sort key putting the files the game server needs to start first.
+
+    Those are all files but region files, plus the overworld regions
+    around spawn. The other regions follow, nearest to spawn first.
+
+    """
+    match = REGION_RE.match(relpath)
+    if match is None:
+        return (0, 0, relpath)
+    distance = max(abs(int(match.group(1)) - spawn[0]),
+                   abs(int(match.group(2)) - spawn[1]))
+    needed = (os.path.dirname(relpath) == 'region' and
+              distance <= SPAWN_RADIUS)
+    return (0 if needed else 1, distance, relpath)
+
+
+class Restorer(object):
+    """
+    Downloads the chunks of a manifest's files, from a pool of threads.
+
+    Each file is written to "<name>.part", which is renamed once all its
+    chunks are on disk, so the game server never sees a partial file.
+
+    """
+    def __init__(self, store, world_dir, chunk_size, total, threads,
+                 progress=None):
+        self.store = store
+        self.world_dir = world_dir
+        self.chunk_size = chunk_size
+        self.total = total
+        self.progress = progress
+        self.pool = WorkerPool(self._fetch_chunk, threads)
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.done = 0
+        self.pending = 0
+        self.idle = threading.Condition(self.lock)
+
+    def path(self, relpath):
+        return os.path.join(self.world_dir, relpath)
+
+    def restore_file(self, relpath, entry):
+        """Queue the chunks of `relpath`, unless it's already on disk."""
+        path = self.path(relpath)
+        try:
+            st = os.stat(path)
+        except OSError:
+            pass
+        else:
+            if (st.st_size == entry['size'] and
+                    int(st.st_mtime) == entry['mtime']):
+                self._add_done(entry['size'])
+                return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.part', 'wb') as f:
+            f.truncate(entry['size'])
+        if not entry['chunks']:
+            self._finish_file(relpath, entry)
+            return
+
+        with self.lock:
+            self.remaining[relpath] = len(entry['chunks'])
+            self.pending += 1
+        for i, digest in enumerate(entry['chunks']):
+            self.pool.put(relpath, entry, i * self.chunk_size, digest)
+
+    def _fetch_chunk(self, relpath, entry, offset, digest):
+        data = self.store.get(chunk_name(digest))
+        if data is None:
+            raise IOError('Missing chunk %s of %s' % (digest, relpath))
+        data = zlib.decompress(data)
+        with open(self.path(relpath) + '.part', 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+        with self.lock:
+            self.remaining[relpath] -= 1
+            finished = not self.remaining[relpath]
+        if finished:
+            self._finish_file(relpath, entry)
+            with self.lock:
+                del self.remaining[relpath]
+                self.pending -= 1
+                self.idle.notify_all()
+        self._add_done(len(data))
+
+    def _finish_file(self, relpath, entry):
+        path = self.path(relpath)
+        os.chmod(path + '.part', entry['mode'])
+        os.utime(path + '.part', (entry['mtime'], entry['mtime']))
+        os.rename(path + '.part', path)
+
+    def _add_done(self, size):
+        with self.lock:
+            self.done += size
+            if self.progress:
+                self.progress(self.done, self.total)
+
+    def wait(self):
+        """Wait until all files queued so far are on disk."""
+        with self.lock:
+            while self.pending and not self.pool.failed.is_set():
+                self.idle.wait(1)
+        if self.pool.error is not None:
+            raise self.pool.error
+
+    def close(self):
+        self.pool.close()
+
+
+def restore(store, world_dir, threads=DOWNLOAD_THREADS, progress=None,
+            ready=None):
+    """
+    Restore the latest backup into `world_dir`.
+
+    Chunks are fetched in parallel and decompressed straight into place.
+    The files needed to start the game server (see restore_order) come
+    first; `ready`, if given, is called as soon as they're on disk, while
+    the remaining regions are still downloading. `progress` is called
+    with (bytes done, bytes total). Returns the manifest's name, or None
+    if there is no backup yet.
+
+    """
+    name = store.get('latest')
+    manifest = load_manifest(store, name) if name else None
+    if manifest is None:
+        if ready:
+            ready()
+        return None
+    files = manifest['files']
+    total = sum(entry['size'] for entry in files.values())
+
+    restorer = Restorer(store, world_dir, manifest['chunk_size'], total,
+                        threads, progress)
+    try:
+        # level.dat tells where spawn is, so it has to come first.
+        if 'level.dat' in files:
+            restorer.restore_file('level.dat', files['level.dat'])
+            restorer.wait()
+        spawn = spawn_region(restorer.path('level.dat'))
+
+        ordered = sorted((restore_order(relpath, spawn), relpath)
+                         for relpath in files if relpath != 'level.dat')
+        needed = [relpath for key, relpath in ordered if key[0] == 0]
+        rest = [relpath for key, relpath in ordered if key[0] != 0]
+        for relpath in needed:
+            restorer.restore_file(relpath, files[relpath])
+        restorer.wait()
+        if ready:
+            ready()
+        for relpath in rest:
+            restorer.restore_file(relpath, files[relpath])
+    finally:
+        restorer.close()
+    return name
+
+
+class ProgressReporter(object):
+    """
+    Pushes replies onto a Redis list, and progress at most once a second.
+
+    See minecloud.launcher.tasks.terminate and follow_restore for the
+    reply protocol. Progress includes the throughput so far, in bytes per
+    second. Replies nobody reads expire after an hour.
+
+    """
+    def __init__(self, conn, reply_to, interval=1):
+        self.conn = conn
+        self.reply_to = reply_to
+        self.interval = interval
+        self.started = time.time()
+        self.last_report = 0
+
+    def send(self, status, **fields):
+        fields['status'] = status
+        self.conn.rpush(self.reply_to, json.dumps(fields))
+        self.conn.expire(self.reply_to, 60*60)
+
+    def rate(self, done):
+        return int(done / max(time.time() - self.started, 0.001))
+
+    def __call__(self, done, total):
+        now = time.time()
+        if now - self.last_report < self.interval and done < total:
+            return
+        self.last_report = now
+        percent = 100 * done // total if total else 100
+        self.send('progress', percent=percent, bytes=done,
+                  rate=self.rate(done))
+
+
+def redis_connection():
+    import redis
+    return redis.StrictRedis.from_url(os.getenv('REDISTOGO_URL'))
+
+
+def get_store(options):
+    if not options.bucket:
+        raise SystemExit('Set MSM_S3_BUCKET, or use --bucket.')
+    return S3Store(options.bucket, options.prefix, options.endpoint)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog backup <world dir> [options]\n'
+              '       %prog restore <world dir> [options]\n'
+              '       %prog gc [options]')
+    parser.add_option('--bucket', default=os.getenv('MSM_S3_BUCKET'))
+    parser.add_option('--prefix', default=os.getenv('MSM_S3_PREFIX', ''))
+    parser.add_option('--endpoint', default=os.getenv('MSM_S3_ENDPOINT'))
+    parser.add_option('--threads', type='int', default=UPLOAD_THREADS)
+    parser.add_option('--reply-to', dest='reply_to',
+                      help='Redis list to push progress messages to. '
+                           'Restore defaults to MCL_RESTORE_REPLY_TO.')
+    parser.add_option('--ready-command', dest='ready_command',
+                      help='Command that starts the game server, run once '
+                           'restore has the files it needs.')
+    parser.add_option('--keep', type='int', default=10,
+                      help='Number of backups gc keeps.')
+    options, args = parser.parse_args(argv)
+
+    if args[:1] == ['backup'] and len(args) == 2:
+        reporter = None
+        if options.reply_to:
+            reporter = ProgressReporter(redis_connection(), options.reply_to)
+            reporter.send('started')
+        try:
+            name, stats = backup(get_store(options), args[1],
+                                 threads=options.threads, progress=reporter)
+        except Exception as e:
+            if reporter:
+                reporter.send('failed', error=str(e))
+            raise
+        if reporter:
+            reporter.send('finished', manifest=name,
+                          seconds=int(time.time() - reporter.started))
+        sys.stdout.write('%s: %s\n' % (name, json.dumps(stats)))
+    elif args[:1] == ['restore'] and len(args) == 2:
+        reporter = None
+        reply_to = options.reply_to or os.getenv('MCL_RESTORE_REPLY_TO')
+        if reply_to:
+            reporter = ProgressReporter(redis_connection(), reply_to)
+            reporter.send('started')
+
+        def ready():
+            if options.ready_command:
+                subprocess.check_call(options.ready_command, shell=True)
+            if reporter:
+                reporter.send('ready')
+
+        try:
+            name = restore(get_store(options), args[1],
+                           threads=options.threads, progress=reporter,
+                           ready=ready)
+        except Exception as e:
+            if reporter:
+                reporter.send('failed', error=str(e))
+            raise
+        if reporter:
+            reporter.send('finished', manifest=name,
+                          seconds=int(time.time() - reporter.started))
+        sys.stdout.write('Restored %s\n' % name)
+    elif args == ['gc']:
+        if options.keep < 1:
+            parser.error('--keep must be at least 1.')
+        manifests, chunks = gc(get_store(options), keep=options.keep)
+        sys.stdout.write('Deleted %d manifests and %d chunks.\n'
+                         % (manifests, chunks))
+    else:
+        parser.error('Unknown command.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,49 @@
 from django.contrib import admin
-from .models import Instance
+from .models import (DailyPlaytime, DailyUptime, Instance, LaunchAttempt,
+                     PhaseTiming, PoolServer, TelemetrySample, WorldVolume)
 
 class InstanceAdmin(admin.ModelAdmin):
-    list_display = ('name', 'ami', 'ip_address', 'start', 'end', 'state')
+    list_display = ('name', 'world', 'ami', 'ip_address', 'start', 'end', 'state',
+                    'launch_latency', 'pool_server', 'prewarmed', 'region')
+
+class PoolServerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'world', 'ami', 'created', 'released', 'state')
+
+class WorldVolumeAdmin(admin.ModelAdmin):
+    list_display = ('world', 'volume_id', 'zone', 'snapshot_id')
+
+class DailyPlaytimeAdmin(admin.ModelAdmin):
+    list_display = ('day', 'user', 'world', 'seconds')
+    list_filter = ('world',)
+    date_hierarchy = 'day'
+
+class DailyUptimeAdmin(admin.ModelAdmin):
+    list_display = ('day', 'instance', 'world', 'launched_by', 'seconds')
+    list_filter = ('world',)
+    date_hierarchy = 'day'
+
+class PhaseTimingAdmin(admin.ModelAdmin):
+    list_display = ('ended', 'instance', 'phase', 'seconds')
+    list_filter = ('phase',)
+    date_hierarchy = 'ended'
+
+class LaunchAttemptAdmin(admin.ModelAdmin):
+    list_display = ('start', 'instance', 'number', 'region', 'zone', 'name',
+                    'outcome', 'seconds_to_ready', 'error')
+    list_filter = ('outcome', 'region')
+    date_hierarchy = 'start'
+
+class TelemetrySampleAdmin(admin.ModelAdmin):
+    list_display = ('start', 'resolution', 'instance', 'world', 'count',
+                    'tps_min', 'memory_max', 'players_max', 'latency_max')
+    list_filter = ('world', 'resolution')
+    date_hierarchy = 'start'
 
 admin.site.register(Instance, InstanceAdmin)
+admin.site.register(PoolServer, PoolServerAdmin)
+admin.site.register(WorldVolume, WorldVolumeAdmin)
+admin.site.register(DailyPlaytime, DailyPlaytimeAdmin)
+admin.site.register(DailyUptime, DailyUptimeAdmin)
+admin.site.register(PhaseTiming, PhaseTimingAdmin)
+admin.site.register(LaunchAttempt, LaunchAttemptAdmin)
+admin.site.register(TelemetrySample, TelemetrySampleAdmin)
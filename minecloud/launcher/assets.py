@@ -0,0 +1,268 @@
+"""
+Static assets, built ahead of time and served without Django.
+
+`collectstatic` (run when the slug is built, not when a dyno starts)
+copies the assets to STATIC_ROOT with PrecompressedStaticFilesStorage,
+which:
+
+* Gives every file a content-hashed name (css/index.3f2a9c1b7d4e.css),
+  rewrites the url()s in CSS files to match, and records the names in a
+  manifest, MANIFEST_NAME, that {% static %} looks them up in.
+
+* Writes a gzip (.gz) and, if the brotli module is installed, a brotli
+  (.br) variant of each text file, at the highest compression level.
+
+StaticFilesApplication then serves STATIC_URL from STATIC_ROOT in front
+of the Django application (see minecloud.wsgi), so asset requests never
+go through the Django request cycle and don't keep worker greenlets from
+SSE connections for long. It picks the smallest variant the client
+accepts, and sends hashed names with a one year Cache-Control lifetime,
+since their content never changes, and other files with CACHE_MAX_AGE.
+Every response has an ETag, and a matching If-None-Match gets a 304.
+
+"""
+import gzip
+import json
+import mimetypes
+import os
+import re
+from cStringIO import StringIO
+from email.utils import formatdate
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import (CachedFilesMixin,
+                                                StaticFilesStorage)
+from django.contrib.staticfiles.utils import matches_patterns
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Lists every collected file's hashed name, in STATIC_ROOT.
+MANIFEST_NAME = 'staticfiles.json'
+
+COMPRESSIBLE = ('*.css', '*.js', '*.svg', '*.json', '*.txt', '*.html')
+
+# Content-Encoding -> suffix of the variant, best first.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Matches the 12 hex digit hash CachedFilesMixin adds to names.
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+CACHE_MAX_AGE = 5 * 60
+
+
+def gzip_compress(data):
+    out = StringIO()
+    # mtime=0 so the same file always compresses the same way.
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                       fileobj=out, mtime=0) as compressed:
+        compressed.write(data)
+    return out.getvalue()
+
+
+def compressors():
+    """Return (suffix, compress function) for each encoding available."""
+    available = {'.gz': gzip_compress}
+    if brotli is not None:
+        available['.br'] = lambda data: brotli.compress(data, quality=11)
+    return [(suffix, available[suffix])
+            for encoding, suffix in ENCODINGS if suffix in available]
+
+
+class PrecompressedStaticFilesStorage(CachedFilesMixin, StaticFilesStorage):
+    """
+    Saves content-hashed, precompressed copies of the static files, and
+    a manifest of their hashed names.
+
+    Unlike CachedStaticFilesStorage, url() never reads files or the cache
+    at request time: names missing from the manifest (e.g. before
+    collectstatic runs, or in tests) are returned unhashed.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(PrecompressedStaticFilesStorage, self).__init__(*args, **kwargs)
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                with self.open(MANIFEST_NAME) as manifest:
+                    self._manifest = json.loads(manifest.read())
+            except (IOError, OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def url(self, name, force=False):
+        if force:
+            return super(PrecompressedStaticFilesStorage, self).url(
+                name, force=True)
+        if not settings.DEBUG:
+            name = self.manifest.get(name, name)
+        return super(CachedFilesMixin, self).url(name)
+
+    def url_converter(self, name, template=None):
+        """
+        Leave url()s to files that don't exist alone, rather than fail
+        (bootstrap.css refers to icons this app doesn't use).
+
+        """
+        convert = super(PrecompressedStaticFilesStorage, self).url_converter(
+            name, template)
+
+        def converter(matchobj):
+            try:
+                return convert(matchobj)
+            except ValueError:
+                return matchobj.group(1)
+        return converter
+
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            return
+        # Hash from the files, not a manifest left by an earlier build.
+        self._manifest = {}
+        manifest = {}
+        processed = super(PrecompressedStaticFilesStorage, self).post_process(
+            paths, dry_run, **options)
+        for name, hashed_name, was_processed in processed:
+            manifest[name.replace('\\', '/')] = hashed_name
+            if matches_patterns(name, COMPRESSIBLE):
+                self.compress(name)
+                self.compress(hashed_name)
+            yield name, hashed_name, was_processed
+
+        if self.exists(MANIFEST_NAME):
+            self.delete(MANIFEST_NAME)
+        self._save(MANIFEST_NAME, ContentFile(json.dumps(manifest, indent=1)))
+        self._manifest = manifest
+
+    def compress(self, name):
+        """Save the compressed variants of `name` that are any smaller."""
+        with self.open(name) as original:
+            data = original.read()
+        for suffix, compress in compressors():
+            compressed = compress(data)
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            if len(compressed) < len(data):
+                self._save(name + suffix, ContentFile(compressed))
+
+
+def accepted_encodings(header):
+    """Return the content codings an Accept-Encoding header allows."""
+    accepted = set()
+    for coding in (header or '').split(','):
+        params = coding.strip().split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            accepted.add(name)
+    return accepted
+
+
+class StaticFilesApplication(object):
+    """
+    WSGI middleware that serves the files under `root` at `prefix`,
+    passing every other request to `application`.
+
+    """
+    def __init__(self, application, root=None, prefix=None):
+        self.application = application
+        self.root = os.path.abspath(root or settings.STATIC_ROOT)
+        self.prefix = prefix or settings.STATIC_URL
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix):
+            return self.application(environ, start_response)
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            start_response('405 METHOD NOT ALLOWED',
+                           [('Content-Type', 'text/plain'),
+                            ('Allow', 'GET, HEAD')])
+            return ['Method not allowed']
+
+        name = path[len(self.prefix):]
+        filename = self.find(name)
+        if filename is None:
+            start_response('404 NOT FOUND', [('Content-Type', 'text/plain')])
+            return ['Not found']
+
+        accepted = accepted_encodings(environ.get('HTTP_ACCEPT_ENCODING'))
+        encoding = None
+        for coding, suffix in ENCODINGS:
+            if coding in accepted and os.path.isfile(filename + suffix):
+                encoding = coding
+                filename += suffix
+                break
+
+        stat = os.stat(filename)
+        etag = '"%x-%x%s"' % (int(stat.st_mtime), stat.st_size,
+                              '-' + encoding if encoding else '')
+        if HASHED_NAME_RE.search(name):
+            cache_control = 'public, max-age=%d' % IMMUTABLE_MAX_AGE
+        else:
+            cache_control = 'public, max-age=%d' % CACHE_MAX_AGE
+        content_type = mimetypes.guess_type(name)[0]
+        headers = [('Content-Type', content_type or
+                                    'application/octet-stream'),
+                   ('Cache-Control', cache_control),
+                   ('ETag', etag),
+                   ('Last-Modified', formatdate(stat.st_mtime, usegmt=True)),
+                   ('Vary', 'Accept-Encoding')]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')] or \
+                if_none_match.strip() == '*':
+            start_response('304 NOT MODIFIED', headers)
+            return []
+
+        headers.append(('Content-Length', str(stat.st_size)))
+        start_response('200 OK', headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        f = open(filename, 'rb')
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(f, 64 * 1024)
+        return FileIterator(f)
+
+    def find(self, name):
+        """Return the path of file `name` in root, or None."""
+        filename = os.path.abspath(os.path.join(self.root, name))
+        if not filename.startswith(self.root + os.sep):
+            return None
+        if not os.path.isfile(filename):
+            return None
+        return filename
+
+
+class FileIterator(object):
+    """Read a file in blocks, for WSGI servers without a file_wrapper."""
+
+    def __init__(self, f, block_size=64 * 1024):
+        self.f = f
+        self.block_size = block_size
+
+    def __iter__(self):
+        while True:
+            block = self.f.read(self.block_size)
+            if not block:
+                break
+            yield block
+
+    def close(self):
+        self.f.close()
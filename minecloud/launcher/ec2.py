@@ -0,0 +1,93 @@
+"""
+Shared EC2 connections for the worker process.
+
+Creating a boto connection for every task means a new HTTPS handshake for
+every API call. connect_ec2() instead keeps one connection per region for
+the life of the process.
+
+boto is imported when the first connection is made, so the web process,
+which never makes one, doesn't load it.
+
+Set the MCL_EC2_ENDPOINT env variable (e.g. "http://localhost:5000") to
+talk to a local fake EC2 endpoint, such as moto_server, instead of AWS.
+
+"""
+import os
+import threading
+import urlparse
+
+_connections = {}
+_lock = threading.Lock()
+
+
+def default_region():
+    return os.getenv('MCL_EC2_REGION', 'us-west-2')
+
+
+def connect_ec2(region_name=None):
+    """Return the shared connection to EC2 in `region_name`."""
+    region_name = region_name or default_region()
+    with _lock:
+        conn = _connections.get(region_name)
+        if conn is None:
+            conn = _connections[region_name] = _create_connection(region_name)
+    return conn
+
+
+def _create_connection(region_name):
+    import boto
+    import boto.ec2
+    from boto.ec2.regioninfo import RegionInfo
+
+    endpoint = os.getenv('MCL_EC2_ENDPOINT')
+    if endpoint:
+        url = urlparse.urlparse(endpoint)
+        region = RegionInfo(name=region_name, endpoint=url.hostname)
+        return boto.connect_ec2(region=region,
+                                is_secure=(url.scheme == 'https'),
+                                port=url.port,
+                                path=url.path or '/')
+    return boto.connect_ec2(region=boto.ec2.get_region(region_name))
+
+
+def api_error():
+    """
+    Return the exception class EC2 API errors are raised as. Call it in
+    the except clause, so boto is only imported once an error happens.
+
+    """
+    from boto.exception import EC2ResponseError
+    return EC2ResponseError
+
+
+def describe_servers(conn, server_ids):
+    """
+    Return a dict of EC2 instances, keyed by id, using one API call.
+
+    Ids that EC2 doesn't know about (yet) are left out, rather than
+    failing the whole call.
+
+    """
+    if not server_ids:
+        return {}
+    reservations = conn.get_all_instances(
+        filters={'instance-id': list(server_ids)})
+    return dict((server.id, server)
+                for reservation in reservations
+                for server in reservation.instances)
+
+
+def describe_volume(conn, volume_id):
+    """Return the EBS volume `volume_id`, or None if it doesn't exist."""
+    if not volume_id:
+        return None
+    volumes = conn.get_all_volumes(filters={'volume-id': [volume_id]})
+    return volumes[0] if volumes else None
+
+
+def describe_snapshot(conn, snapshot_id):
+    """Return the EBS snapshot `snapshot_id`, or None if it doesn't exist."""
+    if not snapshot_id:
+        return None
+    snapshots = conn.get_all_snapshots(filters={'snapshot-id': [snapshot_id]})
+    return snapshots[0] if snapshots else None
@@ -0,0 +1,131 @@
+"""
+Hedged launches: booting a backup server elsewhere when a launch is slow
+or fails, and keeping whichever server is ready first.
+
+A launch normally boots one server, in the default region. When
+MINECLOUD_HEDGE_PLACEMENTS lists other availability zones or regions,
+e.g.
+
+    MCL_HEDGE_PLACEMENTS="us-west-2b us-east-1:ami-1234abcd"
+
+and the server isn't running after MINECLOUD_HEDGE_AFTER_SECONDS, or
+EC2 can't start it (e.g. InsufficientInstanceCapacity), tasks.hedge
+boots another one in the next placement, and so on down the list. A
+placement is a zone ("us-west-2b") or a region ("us-east-1", any zone),
+with the AMI to boot there after a colon, if it isn't MCL_EC2_AMI (AMIs
+belong to a region).
+
+Each server is a LaunchAttempt. reconcile keeps the first one EC2
+reports running, with an IP address, as the instance's server, and
+terminates the others. The attempts are kept, so the deadline can be
+tuned from how long servers actually take (see attempt_report()).
+Hedging is skipped for EBS persistence, whose servers must boot next to
+the world's volume, and for warm pool servers, which start in seconds.
+
+"""
+from django.conf import settings
+
+from .ec2 import default_region
+from .metrics import percentile
+from .models import LaunchAttempt
+
+# The share of primary attempts that should be ready before the deadline;
+# the rest get a backup server.
+SUGGESTED_PERCENTILE = 95
+
+
+def parse_placement(value):
+    """Return the (region, zone, AMI) of a MINECLOUD_HEDGE_PLACEMENTS entry."""
+    placement, _, ami = value.partition(':')
+    if placement[-1:].isalpha():
+        # A zone is its region's name and a letter.
+        return placement[:-1], placement, ami or None
+    return placement, '', ami or None
+
+
+def placements():
+    """Return the backup placements, in the order they're tried."""
+    return [parse_placement(value)
+            for value in settings.MINECLOUD_HEDGE_PLACEMENTS]
+
+
+def hedging_enabled(instance):
+    return bool(settings.MINECLOUD_HEDGE_PLACEMENTS and
+                settings.MINECLOUD_PERSISTENCE != 'ebs' and
+                not instance.pool_server_id)
+
+
+def pick_winner(instance, attempts, servers):
+    """
+    Decide which of `instance`'s pending `attempts` (with their EC2
+    `servers`, by id) is kept, marking failed the ones whose servers went
+    away, and recording when each was ready.
+
+    Returns (winner, losers, failed): the winning attempt, or None if no
+    server is ready yet, the attempts to terminate, and the attempts that
+    failed just now.
+
+    """
+    ready = []
+    failed = []
+    for attempt in attempts:
+        server = servers.get(attempt.name)
+        if server is None:
+            continue
+        if server.state in (u'shutting-down', u'terminated', u'stopped'):
+            attempt.outcome = 'failed'
+            attempt.error = 'Server %s while launching.' % server.state
+            failed.append(attempt)
+        elif server.state == u'running' and server.ip_address:
+            ready.append(attempt)
+
+    if not ready:
+        return None, [], failed
+    # Keep the instance's server if it's one of them, so nothing changes
+    # unless hedging helped.
+    winner = min(ready, key=lambda attempt: (attempt.name != instance.name,
+                                             attempt.number))
+    losers = [attempt for attempt in attempts
+              if attempt is not winner and attempt not in failed]
+    return winner, losers, failed
+
+
+def attempt_report(since):
+    """
+    Return how long servers took to be ready since `since`, per
+    placement, and the hedging deadline that would have hedged
+    100 - SUGGESTED_PERCENTILE percent of the launches.
+
+    """
+    attempts = list(LaunchAttempt.objects
+        .filter(start__gte=since)
+        .order_by('region', 'zone')
+    )
+    by_placement = {}
+    for attempt in attempts:
+        by_placement.setdefault((attempt.region, attempt.zone), []).append(
+            attempt)
+
+    rows = []
+    for (region, zone), placement_attempts in sorted(by_placement.items()):
+        seconds = [attempt.seconds_to_ready for attempt in placement_attempts
+                   if attempt.ready is not None]
+        rows.append({
+            'placement': zone or region,
+            'attempts': len(placement_attempts),
+            'won': sum(1 for attempt in placement_attempts
+                       if attempt.outcome == 'won'),
+            'failed': sum(1 for attempt in placement_attempts
+                          if attempt.outcome == 'failed'),
+            'p50': percentile(seconds, 50),
+            'p90': percentile(seconds, 90),
+            'p99': percentile(seconds, 99),
+        })
+
+    primary = [attempt.seconds_to_ready for attempt in attempts
+               if attempt.number == 0 and attempt.ready is not None]
+    return {'placements': rows,
+            'hedge_after': settings.MINECLOUD_HEDGE_AFTER_SECONDS,
+            'suggested_hedge_after': percentile(primary,
+                                                SUGGESTED_PERCENTILE),
+            'default_region': default_region()}
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from minecloud.launcher.rollups import backfill
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily playtime and uptime rollups from history.'
+
+    def handle(self, *args, **options):
+        playtime, uptime = backfill()
+        self.stdout.write('Wrote %d playtime and %d uptime rows.'
+                          % (playtime, uptime))
@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+from optparse import make_option
+
+import psycopg2
+from kombu import Connection
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_connection, connection
+
+from minecloud.launcher.metrics import percentile
+
+QUEUE = 'benchbroker'
+
+TRANSPORTS = ('pglisten', 'django')
+
+
+class Consumer(threading.Thread):
+    """
+    Takes messages off the benchmark queue, as a worker would, recording
+    how long each took to be picked up after it was sent.
+
+    """
+    def __init__(self, url, latencies):
+        super(Consumer, self).__init__()
+        self.daemon = True
+        self.url = url
+        self.latencies = latencies
+        self.ready = threading.Event()
+
+    def run(self):
+        try:
+            with Connection(self.url) as conn:
+                queue = conn.SimpleQueue(QUEUE)
+                self.ready.set()
+                while True:
+                    message = queue.get(block=True)
+                    message.ack()
+                    if message.payload.get('stop'):
+                        break
+                    self.latencies.append(
+                        time.time() - message.payload['sent'])
+                queue.close()
+        finally:
+            self.ready.set()
+            close_connection()
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the Celery broker transports on the Postgres '
+            'database: reports how long messages take to be picked up, and '
+            'the database load of idle consumers.')
+    option_list = BaseCommand.option_list + (
+        make_option('--transport', action='append', choices=TRANSPORTS,
+                    help='Transport to benchmark (default: all of them).'),
+        make_option('--consumers', type='int', default=2,
+                    help='Consumers (worker processes) waiting for messages.'),
+        make_option('--messages', type='int', default=100),
+        make_option('--interval', type='float', default=0.1,
+                    help='Seconds between messages.'),
+        make_option('--idle', type='float', default=30,
+                    help='Seconds to measure the load of idle consumers for.'),
+        make_option('--output', help='Also write the results, as JSON, '
+                                     'to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('benchbroker needs a Postgres DATABASE_URL.')
+
+        self.stdout.write('%-10s %9s %9s %9s %10s' % (
+            'transport', 'p50 ms', 'p99 ms', 'delivered', 'idle tx/s'))
+        results = []
+        for transport in options['transport'] or TRANSPORTS:
+            result = self.run(transport, options)
+            results.append(result)
+            self.report(result)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def broker_url(self, transport):
+        return '%s://%s' % (transport, settings.BROKER_URL.split('://', 1)[1])
+
+    def run(self, transport, options):
+        url = self.broker_url(transport)
+        with Connection(url) as conn:
+            queue = conn.SimpleQueue(QUEUE)
+            queue.clear()
+
+            latencies = []
+            consumers = [Consumer(url, latencies)
+                         for i in range(options['consumers'])]
+            for consumer in consumers:
+                consumer.start()
+            for consumer in consumers:
+                consumer.ready.wait()
+
+            # Let the consumers settle, then count the transactions they
+            # make while nothing is sent. (Backends report their statistics
+            # every half a second or so.)
+            time.sleep(2)
+            commits = self.transactions()
+            time.sleep(options['idle'])
+            idle = (self.transactions() - commits) / options['idle']
+
+            for n in range(options['messages']):
+                queue.put({'n': n, 'sent': time.time()})
+                time.sleep(options['interval'])
+
+            # Give the last messages time to arrive; the Django transport
+            # may not look for them for a whole polling interval.
+            polling_interval = conn.transport.polling_interval or 0
+            deadline = time.time() + 2 * polling_interval + 5
+            while (time.time() < deadline and
+                   len(latencies) < options['messages']):
+                time.sleep(0.1)
+
+            for consumer in consumers:
+                queue.put({'stop': True})
+            for consumer in consumers:
+                consumer.join(2 * polling_interval + 5)
+            queue.clear()
+            queue.close()
+
+        return {
+            'transport': transport,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'delivered': (float(len(latencies)) / options['messages']
+                          if options['messages'] else 0),
+            'idle_transactions_per_second': idle,
+        }
+
+    def transactions(self):
+        """Transactions committed in the database so far, by anyone."""
+        db = settings.DATABASES['default']
+        stats = psycopg2.connect(host=db['HOST'] or None,
+                                 port=db['PORT'] or None,
+                                 user=db['USER'] or None,
+                                 password=db['PASSWORD'] or None,
+                                 database=db['NAME'])
+        try:
+            cursor = stats.cursor()
+            cursor.execute('SELECT xact_commit FROM pg_stat_database '
+                           'WHERE datname = %s', [db['NAME']])
+            return cursor.fetchone()[0]
+        finally:
+            stats.close()
+
+    def report(self, result):
+        def ms(seconds):
+            return '%.1f' % (seconds * 1000) if seconds is not None else '-'
+        self.stdout.write('%-10s %9s %9s %8.1f%% %10.1f' % (
+            result['transport'], ms(result['p50']), ms(result['p99']),
+            result['delivered'] * 100, result['idle_transactions_per_second']))
@@ -0,0 +1,337 @@
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import urlparse
+from optparse import make_option
+
+import gevent
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.importlib import import_module
+
+from minecloud.launcher.metrics import percentile
+from minecloud.launcher.sseview import send_event
+from minecloud.launcher.standins import RedisCache, RedisStandIn
+
+BENCH_EVENT = 'bench'
+
+
+def rss_kib(pid):
+    """Resident memory of process `pid`, in KiB (Linux only)."""
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def child_pids(pid):
+    """The ids of the child processes of `pid` (Linux only)."""
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as stat:
+                # The command name, in parentheses, may contain spaces.
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(name))
+    return children
+
+
+class SseClient(object):
+    """
+    One /sse connection, recording how long each benchmark event took to
+    arrive after it was sent.
+
+    """
+    def __init__(self, address, cookie, latencies):
+        self.address = address
+        self.cookie = cookie
+        self.latencies = latencies
+        self.sock = None
+
+    def connect(self):
+        """Open the stream; return whether the server accepted it."""
+        try:
+            self.open()
+            return True
+        except (socket.error, IOError):
+            self.close()
+            return False
+
+    def open(self):
+        self.sock = socket.create_connection(self.address, timeout=30)
+        # HTTP/1.0, so the stream isn't chunked.
+        self.sock.sendall('GET /sse HTTP/1.0\r\n'
+                          'Host: %s:%d\r\n'
+                          'Accept: text/event-stream\r\n'
+                          'Cookie: %s\r\n\r\n'
+                          % (self.address + (self.cookie,)))
+        self.stream = self.sock.makefile('rb')
+        status = self.stream.readline()
+        if ' 200 ' not in status:
+            raise IOError('Unexpected response: %r' % status.strip())
+        while self.stream.readline().strip():
+            pass
+        self.sock.settimeout(None)
+
+    def read(self):
+        event = None
+        data = []
+        try:
+            for line in self.stream:
+                line = line.rstrip('\r\n')
+                if line.startswith('event:'):
+                    event = line[6:].strip()
+                elif line.startswith('data:'):
+                    data.append(line[5:].strip())
+                elif not line:
+                    if event == BENCH_EVENT:
+                        self.received(json.loads('\n'.join(data)))
+                    event = None
+                    data = []
+        except (socket.error, ValueError):
+            pass
+
+    def received(self, data):
+        self.latencies.append((data['round'], time.time() - data['sent']))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class Command(BaseCommand):
+    help = ('Load tests the SSE stream: opens concurrent /sse connections '
+            'to a local web worker, sends events, and reports how long they '
+            'took to arrive, the cache load and memory per connection.')
+    option_list = BaseCommand.option_list + (
+        make_option('--server', default='gunicorn',
+                    choices=('gunicorn', 'sseserver'),
+                    help='Serve /sse from one gevent gunicorn worker (as in '
+                         'ProcfileProduction), or from runsseserver.'),
+        make_option('--clients', type='int', default=100,
+                    help='Concurrent connections (in the first round).'),
+        make_option('--events', type='int', default=20,
+                    help='Events sent per round.'),
+        make_option('--interval', type='float', default=0.5,
+                    help='Seconds between events.'),
+        make_option('--idle', type='float', default=5,
+                    help='Seconds to measure the idle cache load for.'),
+        make_option('--pubsub', action='store_true', default=False,
+                    help='Send events through Redis Pub/Sub '
+                         '(REDISTOGO_URL), instead of polling the cache.'),
+        make_option('--ramp', action='store_true', default=False,
+                    help='Double the connections each round, until they '
+                         'are no longer sustainable.'),
+        make_option('--max-clients', type='int', default=10000),
+        make_option('--max-p99', type='float', default=2.0,
+                    help='Highest sustainable p99 latency, in seconds.'),
+        make_option('--port', type='int', default=8100),
+        make_option('--output', help='Also write the results, as JSON, '
+                                     'to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        cache_settings = settings.CACHES['default']
+        if cache_settings['BACKEND'] != '%s.%s' % (RedisCache.__module__,
+                                                   RedisCache.__name__):
+            raise CommandError('Run benchsse with '
+                               '--settings=minecloud.settings.bench')
+        redis_url = cache_settings['LOCATION']
+        url = urlparse.urlparse(redis_url)
+        standin = RedisStandIn((url.hostname, url.port))
+        standin.start()
+
+        # Each connection takes a file descriptor here and in the worker.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = min(hard, options['max_clients'] + 100)
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+        env = dict(os.environ,
+                   DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE,
+                   MCL_BENCH_REDIS_URL=redis_url,
+                   # Don't let responses end and reconnect mid-round.
+                   MCL_SSE_TIMEOUT='3600')
+        env.pop('MCL_SSE_URL', None)
+        if options['pubsub']:
+            env['REDISTOGO_URL'] = os.environ['REDISTOGO_URL'] = redis_url
+        else:
+            env.pop('REDISTOGO_URL', None)
+            os.environ.pop('REDISTOGO_URL', None)
+
+        call_command('syncdb', interactive=False, verbosity=0)
+        cookie = self.login()
+
+        address = ('127.0.0.1', options['port'])
+        server = self.start_server(options['server'], address, env)
+        results = []
+        try:
+            self.wait_for_port(address, server)
+            pid = server.pid
+            if options['server'] == 'gunicorn':
+                pid = child_pids(server.pid)[0]
+            # The first request loads the app; keep that out of the memory
+            # per connection.
+            warmup = SseClient(address, cookie, [])
+            warmup.open()
+            warmup.close()
+
+            self.stdout.write('%8s %9s %9s %9s %9s %10s %10s %9s' % (
+                'clients', 'connected', 'p50 ms', 'p99 ms', 'delivered',
+                'idle op/s', 'event op/s', 'KiB/conn'))
+            clients = options['clients']
+            number = 0
+            while True:
+                result = self.run_round(number, clients, address, cookie,
+                                        pid, standin, options)
+                results.append(result)
+                self.report(result)
+                if not options['ramp'] or not result['sustainable']:
+                    break
+                if clients >= options['max_clients']:
+                    break
+                clients = min(clients * 2, options['max_clients'])
+                number += 1
+        finally:
+            server.terminate()
+            server.wait()
+            standin.stop()
+
+        sustainable = [run['clients'] for run in results
+                       if run['sustainable']]
+        if options['ramp']:
+            self.stdout.write('Max sustainable connections per worker: %s'
+                              % (max(sustainable) if sustainable
+                                 else 'fewer than %d' % options['clients']))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'options': dict(
+                              (name, options[name]) for name in
+                              ('server', 'events', 'interval', 'pubsub')),
+                           'rounds': results}, output, indent=2)
+
+    def login(self):
+        """Return the session cookie of a logged in benchmark user."""
+        user, created = User.objects.get_or_create(username='benchsse')
+        engine = import_module(settings.SESSION_ENGINE)
+        session = engine.SessionStore()
+        session[SESSION_KEY] = user.pk
+        session[BACKEND_SESSION_KEY] = \
+            'django.contrib.auth.backends.ModelBackend'
+        session.save()
+        return '%s=%s' % (settings.SESSION_COOKIE_NAME, session.session_key)
+
+    def start_server(self, server, address, env):
+        bind = '%s:%d' % address
+        if server == 'gunicorn':
+            # The web process of ProcfileProduction, with a single worker.
+            gunicorn = os.path.join(os.path.dirname(sys.executable),
+                                    'gunicorn')
+            args = [gunicorn, 'minecloud.wsgi', '--bind', bind,
+                    '--workers', '1', '--worker-class', 'gevent']
+        else:
+            args = [sys.executable, os.path.abspath(sys.argv[0]),
+                    'runsseserver', bind]
+        return subprocess.Popen(args, env=env, cwd=settings.PROJECT_PATH)
+
+    def wait_for_port(self, address, server, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if server.poll() is not None:
+                raise CommandError('The server exited with status %d.'
+                                   % server.returncode)
+            try:
+                socket.create_connection(address, timeout=1).close()
+                return
+            except socket.error:
+                gevent.sleep(0.2)
+        raise CommandError('The server did not start listening on %s:%d.'
+                           % address)
+
+    def run_round(self, number, clients, address, cookie, pid, standin,
+                  options):
+        latencies = []
+        connections = [SseClient(address, cookie, latencies)
+                       for i in range(clients)]
+        rss_before = rss_kib(pid)
+        connects = [gevent.spawn(connection.connect)
+                    for connection in connections]
+        gevent.joinall(connects)
+        connected = [connection for connection, connect
+                     in zip(connections, connects) if connect.value]
+        readers = [gevent.spawn(connection.read) for connection in connected]
+        try:
+            # Let the worker settle, then measure the cache load and memory
+            # of idle connections.
+            gevent.sleep(2)
+            rss_after = rss_kib(pid)
+            ops = standin.total_ops()
+            gevent.sleep(options['idle'])
+            idle_ops = (standin.total_ops() - ops) / options['idle']
+
+            ops = standin.total_ops()
+            started = time.time()
+            for n in range(options['events']):
+                send_event(BENCH_EVENT, json.dumps(
+                    {'round': number, 'n': n, 'sent': time.time()}),
+                    key=BENCH_EVENT, changes_page=False)
+                gevent.sleep(options['interval'])
+            event_ops = (standin.total_ops() - ops) / (time.time() - started)
+
+            # Give the last events time to arrive.
+            expected = len(connected) * options['events']
+            deadline = time.time() + max(options['max_p99'], 2)
+            while time.time() < deadline and len(
+                    [r for r, latency in latencies if r == number]) < expected:
+                gevent.sleep(0.1)
+        finally:
+            for connection in connected:
+                connection.close()
+            gevent.killall(readers)
+
+        times = [latency for r, latency in latencies if r == number]
+        p50 = percentile(times, 50)
+        p99 = percentile(times, 99)
+        delivered = float(len(times)) / expected if expected else 0
+        return {
+            'clients': clients,
+            'connected': len(connected),
+            'p50': p50,
+            'p99': p99,
+            'delivered': delivered,
+            'idle_ops_per_second': idle_ops,
+            'event_ops_per_second': event_ops,
+            'kib_per_connection': (float(rss_after - rss_before) /
+                                   len(connected) if connected else None),
+            'sustainable': (len(connected) == clients and
+                            delivered >= 0.99 and
+                            p99 is not None and p99 <= options['max_p99']),
+        }
+
+    def report(self, result):
+        def ms(seconds):
+            return '%.1f' % (seconds * 1000) if seconds is not None else '-'
+        self.stdout.write('%8d %9d %9s %9s %8.1f%% %10.1f %10.1f %9s' % (
+            result['clients'], result['connected'], ms(result['p50']),
+            ms(result['p99']), result['delivered'] * 100,
+            result['idle_ops_per_second'], result['event_ops_per_second'],
+            '%.1f' % result['kib_per_connection']
+            if result['kib_per_connection'] is not None else '-'))
@@ -0,0 +1,282 @@
+import collections
+import datetime
+import json
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils.timezone import utc
+
+from minecloud.launcher import tasks
+from minecloud.launcher.metrics import percentile, record_state
+from minecloud.launcher.models import Instance, command_channel
+from minecloud.launcher.standins import (FakeEC2Connection, FakeRedis,
+                                         TaskSimulation)
+from minecloud.launcher.sseview import send_instance_state
+
+# Seconds between a player's checks on their instance, as the page would
+# get its state changes.
+PLAYER_POLL_INTERVAL = 1
+
+# Seconds a game server takes to start, once its world is on disk.
+GAME_START_SECONDS = 10
+
+
+class GameServers(object):
+    """
+    Plays the part of the game servers: restores worlds as servers boot,
+    answers backup commands, and marks instances terminated as their
+    servers shut down, as the AMI's scripts do.
+
+    """
+    def __init__(self, sim, redis, restore_seconds, backup_seconds):
+        self.sim = sim
+        self.redis = redis
+        self.restore_seconds = restore_seconds
+        self.backup_seconds = backup_seconds
+
+    def listen(self, worlds):
+        for world in worlds:
+            self.redis.subscribe(command_channel(world), self.command)
+
+    def server_changed(self, server):
+        reply_to = server.env('MCL_RESTORE_REPLY_TO')
+        if server.state == u'running' and server.ip_address:
+            if server.env('MCL_WARM_POOL'):
+                # A warm pool server, with its world on disk already.
+                self.sim.spawn(self.start, server.id)
+            elif reply_to:
+                self.sim.spawn(self.restore, reply_to)
+        elif server.state == u'terminated':
+            (Instance.objects
+                .filter(name=server.id)
+                .exclude(state__exact='terminated')
+                .update(state='terminated')
+            )
+
+    def restore(self, reply_to):
+        self.reply(reply_to, status='started')
+        self.sim.sleep(self.restore_seconds / 2.0)
+        self.reply(reply_to, status='ready')
+        self.sim.sleep(self.restore_seconds / 2.0)
+        self.reply(reply_to, status='finished')
+
+    def start(self, server_id):
+        self.sim.sleep(GAME_START_SECONDS)
+        (Instance.objects
+            .filter(name=server_id, state__exact='pending')
+            .update(state='running', ready=tasks.now())
+        )
+
+    def command(self, message):
+        command = json.loads(message)
+        if command.get('command') == 'backup':
+            self.sim.spawn(self.backup, command['reply_to'])
+
+    def backup(self, reply_to):
+        self.reply(reply_to, status='started')
+        self.sim.sleep(self.backup_seconds)
+        self.reply(reply_to, status='finished')
+
+    def reply(self, reply_to, **message):
+        self.redis.rpush(reply_to, json.dumps(message))
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the launch/terminate task pipeline against local '
+            'stand-ins for EC2 and Redis, on a simulated clock, and reports '
+            'lifecycle times, worker occupancy, API calls and DB queries.')
+    option_list = BaseCommand.option_list + (
+        make_option('--worlds', type='int', default=4,
+                    help='Worlds launched and terminated in parallel.'),
+        make_option('--cycles', type='int', default=5,
+                    help='Launch/terminate cycles per world.'),
+        make_option('--concurrency', type='int', default=4,
+                    help='Celery worker processes.'),
+        make_option('--play-seconds', type='float', default=600),
+        make_option('--pending-delay', type='float', default=45,
+                    help='Seconds EC2 takes to boot a server.'),
+        make_option('--stopping-delay', type='float', default=30,
+                    help='Seconds EC2 takes to stop a server.'),
+        make_option('--missing-ip-delay', type='float', default=5,
+                    help='Seconds a running server has no IP address.'),
+        make_option('--throttle-every', type='int', default=0,
+                    help='Throttle every Nth EC2 API call.'),
+        make_option('--api-latency', type='float', default=0.2,
+                    help='Seconds each EC2 API call takes.'),
+        make_option('--restore-seconds', type='float', default=30),
+        make_option('--backup-seconds', type='float', default=20),
+        make_option('--warm-pool', type='int', default=0,
+                    help='MINECLOUD_WARM_POOL_SIZE.'),
+        make_option('--persistence', default='s3', choices=('s3', 'ebs')),
+        make_option('--timeout', type='float', default=24*60*60,
+                    help='Simulated seconds before giving up.'),
+        make_option('--output', help='Also write the results, as JSON, '
+                                     'to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        # Run against a scratch database, like the tests.
+        old_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        saved = (tasks.connect_ec2, tasks.redis_connection, tasks.time,
+                 tasks.now, tasks.latest_manifest, settings.MINECLOUD_WORLDS,
+                 settings.MINECLOUD_WARM_POOL_SIZE,
+                 settings.MINECLOUD_PERSISTENCE)
+        try:
+            results = self.run(options)
+        finally:
+            (tasks.connect_ec2, tasks.redis_connection, tasks.time,
+             tasks.now, tasks.latest_manifest, settings.MINECLOUD_WORLDS,
+             settings.MINECLOUD_WARM_POOL_SIZE,
+             settings.MINECLOUD_PERSISTENCE) = saved
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+
+    def run(self, options):
+        cache.clear()
+        worlds = ['world%d' % i for i in range(options['worlds'])]
+        settings.MINECLOUD_WORLDS = worlds
+        settings.MINECLOUD_WARM_POOL_SIZE = options['warm_pool']
+        settings.MINECLOUD_PERSISTENCE = options['persistence']
+
+        task_list = [task for task in vars(tasks).values()
+                     if getattr(task, 'name', '').startswith(tasks.__name__)]
+        sim = TaskSimulation(task_list, concurrency=options['concurrency'],
+                             beat_schedule=settings.CELERYBEAT_SCHEDULE)
+        redis = FakeRedis(clock=sim)
+        game_servers = GameServers(sim, redis, options['restore_seconds'],
+                                   options['backup_seconds'])
+        game_servers.listen(worlds)
+        conn = FakeEC2Connection(
+            pending_polls=0, stopping_polls=0,
+            pending_delay=options['pending_delay'],
+            stopping_delay=options['stopping_delay'],
+            missing_ip_delay=options['missing_ip_delay'],
+            throttle_every=options['throttle_every'],
+            latency=options['api_latency'], clock=sim,
+            on_change=game_servers.server_changed)
+
+        tasks.connect_ec2 = lambda *args: conn
+        tasks.redis_connection = lambda: redis
+        tasks.time = sim
+        tasks.now = lambda: datetime.datetime.utcfromtimestamp(
+            sim.time()).replace(tzinfo=utc)
+        # The game servers' backups don't go anywhere, so every pool
+        # server has the latest one.
+        tasks.latest_manifest = lambda world: ''
+
+        user, created = User.objects.get_or_create(username='benchtasks')
+        lifecycles = []
+
+        def wait_for(instance_id, states):
+            while True:
+                state = Instance.objects.get(pk=instance_id).state
+                if state in states:
+                    return state
+                sim.sleep(PLAYER_POLL_INTERVAL)
+
+        def play(world):
+            # What the launch and terminate views do, then wait for the
+            # page to show the result.
+            for cycle in range(options['cycles']):
+                instance = Instance.objects.create(
+                    launched_by=user, world=world, start=tasks.now(),
+                    state='initiating')
+                record_state(instance.id, instance.state)
+                send_instance_state(world, instance.state)
+                launched = sim.time()
+                tasks.launch.delay(instance.id)
+                wait_for(instance.id, ['running'])
+                ready = sim.time()
+
+                sim.sleep(options['play_seconds'])
+                Instance.objects.filter(pk=instance.id).update(
+                    state='shutting down')
+                record_state(instance.id, 'shutting down')
+                send_instance_state(world, 'shutting down')
+                shutdown = sim.time()
+                tasks.terminate.delay(instance.id)
+                state = wait_for(instance.id, ['terminated', 'backup failed'])
+                lifecycles.append({'launch': ready - launched,
+                                   'shutdown': sim.time() - shutdown,
+                                   'state': state})
+                if state != 'terminated':
+                    return
+
+        def players():
+            greenlets = [sim.spawn(play, world) for world in worlds]
+            while not all(glet.dead for glet in greenlets):
+                sim.sleep(PLAYER_POLL_INTERVAL)
+
+        sim.install()
+        try:
+            finished = sim.run(players, timeout=options['timeout'])
+        finally:
+            sim.uninstall()
+
+        calls = collections.Counter(conn.calls)
+        queries = sum(stats['queries'] for stats in sim.stats.values())
+        count = len(lifecycles) or 1
+        return {
+            'finished': finished,
+            'lifecycles': len(lifecycles),
+            'failed': len([l for l in lifecycles
+                           if l['state'] != 'terminated']),
+            'simulated_seconds': sim.time() - sim.started,
+            'launch': dict(
+                (name, percentile([l['launch'] for l in lifecycles], p))
+                for name, p in (('p50', 50), ('p99', 99))),
+            'shutdown': dict(
+                (name, percentile([l['shutdown'] for l in lifecycles], p))
+                for name, p in (('p50', 50), ('p99', 99))),
+            'occupancy': sim.occupancy(),
+            'queue_wait_p99': percentile(sim.queue_waits, 99),
+            'api_calls': dict(calls),
+            'api_calls_per_lifecycle': float(sum(calls.values())) / count,
+            'throttled': conn.throttled,
+            'queries_per_lifecycle': float(queries) / count,
+            'tasks': dict((name, dict(stats))
+                          for name, stats in sim.stats.items()),
+        }
+
+    def report(self, results):
+        def seconds(value):
+            return '%.1f s' % value if value is not None else '-'
+
+        write = self.stdout.write
+        write('Lifecycles:           %d (%d failed)%s' % (
+            results['lifecycles'], results['failed'],
+            '' if results['finished'] else ', timed out'))
+        write('Simulated time:       %s' % seconds(
+            results['simulated_seconds']))
+        write('Launch to running:    p50 %s, p99 %s' % (
+            seconds(results['launch']['p50']),
+            seconds(results['launch']['p99'])))
+        write('Shutdown:             p50 %s, p99 %s' % (
+            seconds(results['shutdown']['p50']),
+            seconds(results['shutdown']['p99'])))
+        write('Worker occupancy:     %.1f%%' % (results['occupancy'] * 100))
+        write('Queue wait p99:       %s' % seconds(results['queue_wait_p99']))
+        write('EC2 calls/lifecycle:  %.1f (%d throttled)' % (
+            results['api_calls_per_lifecycle'], results['throttled']))
+        write('DB queries/lifecycle: %.1f' % results['queries_per_lifecycle'])
+        write('')
+        write('%-22s %6s %8s %8s %10s %8s' % (
+            'task', 'runs', 'retries', 'failures', 'seconds', 'queries'))
+        for name, stats in sorted(results['tasks'].items()):
+            write('%-22s %6d %8d %8d %10.1f %8d' % (
+                name.rsplit('.', 1)[1], stats.get('runs', 0),
+                stats.get('retries', 0), stats.get('failures', 0),
+                stats.get('seconds', 0), stats.get('queries', 0)))
+        write('')
+        write('%-22s %6s' % ('EC2 call', 'count'))
+        for name, count in sorted(results['api_calls'].items()):
+            write('%-22s %6d' % (name, count))
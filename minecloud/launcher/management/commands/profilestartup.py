@@ -0,0 +1,60 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from minecloud.launcher.startup import DEFAULT_PATH, PROCESSES, run
+
+
+class Command(BaseCommand):
+    help = ('Starts web and worker processes from scratch, and reports how '
+            'long they take to be ready, by phase and by module imported.')
+    option_list = BaseCommand.option_list + (
+        make_option('--process', action='append', choices=PROCESSES,
+                    help='Process to start (default: all of them).'),
+        make_option('--repeat', type='int', default=3,
+                    help='Starts per process; the median is reported.'),
+        make_option('--path', default=DEFAULT_PATH,
+                    help='Path of the web process\'s first request.'),
+        make_option('--top', type='int', default=15,
+                    help='Slowest modules to list, by their own time.'),
+        make_option('--budget', type='float',
+                    help='Fail if a process takes more milliseconds than '
+                         'this to be ready.'),
+        make_option('--output', help='Also write the results, as JSON, '
+                                     'to this file.'),
+    )
+
+    def handle(self, *args, **options):
+        results = []
+        for process in options['process'] or PROCESSES:
+            runs = [run(process, options['path'])
+                    for i in range(max(options['repeat'], 1))]
+            result = sorted(runs, key=lambda r: r['wall'])[len(runs) // 2]
+            result['runs'] = [r['wall'] for r in runs]
+            results.append(result)
+            self.report(result, options['top'])
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+        budget = options['budget']
+        over = [profile['process'] for profile in results
+                if budget and profile['wall'] * 1000 > budget]
+        if over:
+            raise CommandError('Over the %d ms budget: %s.' % (
+                budget, ', '.join(over)))
+
+    def report(self, result, top):
+        self.stdout.write('%s: ready in %d ms (median of %d)' % (
+            result['process'], result['wall'] * 1000, len(result['runs'])))
+        phases = [('interpreter', result['wall'] - result['total'])]
+        for name, seconds in phases + result['phases']:
+            self.stdout.write('  %-24s %7.1f ms' % (name, seconds * 1000))
+        if result['status']:
+            self.stdout.write('  (first request: %s)' % result['status'])
+        self.stdout.write('  %-40s %9s %9s' % ('module', 'self ms', 'total ms'))
+        for name, total, own in result['modules'][:top]:
+            self.stdout.write('  %-40s %9.1f %9.1f' % (
+                name, own * 1000, total * 1000))
@@ -0,0 +1,27 @@
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pywsgi import WSGIServer
+
+from django.core.management.base import BaseCommand, CommandError
+
+from minecloud.launcher.sseserver import SseApplication
+
+
+class Command(BaseCommand):
+    args = '[addr:]port'
+    help = 'Serves the instance state SSE stream from a gevent event loop.'
+
+    def handle(self, addrport='8001', *args, **options):
+        if args:
+            raise CommandError('Usage is runsseserver %s' % self.args)
+        addr, _, port = addrport.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            raise CommandError('%r is not a valid port number.' % port)
+
+        server = WSGIServer((addr or '0.0.0.0', port), SseApplication(),
+                            log=None)
+        self.stdout.write('Serving SSEs on %s:%s' % (addr or '0.0.0.0', port))
+        server.serve_forever()
@@ -0,0 +1,180 @@
+"""
+Counters and histograms of the hot paths, shared by all processes.
+
+Values are kept in the Django cache, so the web and worker processes
+add to the same numbers, and render_metrics() can report them from any
+web process, in the Prometheus text format. Each observation costs a few
+cache increments; on the SSE path, that's once per event or connection,
+never per heartbeat.
+
+How long each instance spends in each lifecycle state is also saved in
+the DB, as PhaseTiming rows, so it can be compared across launches.
+
+"""
+import datetime
+import time
+
+from django.core.cache import cache
+from django.utils.timezone import utc
+
+from .models import PhaseTiming
+
+METRICS_TIMEOUT = 60*60*24*365    # One year
+
+# Seconds an instance's current state is remembered, to time its phase.
+PHASE_TIMEOUT = 60*60*24*7
+
+PHASE_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+DELAY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+# The states record_state() times, as phase labels.
+PHASES = ('initiating', 'pending', 'running', 'shutting down',
+          'backup started', 'backup failed', 'backup finished', 'stopping')
+
+# name: (help, buckets, label name, label values)
+HISTOGRAMS = {
+    'minecloud_phase_seconds': (
+        'Seconds instances spent in each lifecycle state.',
+        PHASE_BUCKETS, 'phase', PHASES),
+    'minecloud_sse_event_delay_seconds': (
+        'Seconds from send_event() until a web process read the event.',
+        DELAY_BUCKETS, None, ('',)),
+}
+COUNTERS = {
+    'minecloud_events_sent_total': 'Events sent with send_event().',
+    'minecloud_requests_coalesced_total':
+        'Launch and shut down requests joined to one already in flight.',
+    'minecloud_sse_connections_total': 'SSE connections opened.',
+    'minecloud_telemetry_samples_total': 'Telemetry samples recorded.',
+}
+GAUGES = {
+    'minecloud_sse_connections': 'SSE connections currently open.',
+}
+
+
+def _key(name, *parts):
+    # Memcached keys can't have spaces.
+    return ':'.join(('metrics', name) + parts).replace(' ', '_')
+
+
+def incr(name, delta=1, *parts):
+    """
+    Add `delta` to a counter or gauge (or one part of a histogram).
+
+    Values never go below zero: memcached can't store or decrement below
+    it, so a gauge decremented before its key was set starts from 0.
+
+    """
+    key = _key(name, *parts)
+    try:
+        value = cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, METRICS_TIMEOUT)
+        try:
+            value = cache.incr(key, delta)
+        except ValueError:
+            # Evicted again already.
+            return
+    if value < 0:
+        # Caches other than memcached go below zero.
+        cache.set(key, 0, METRICS_TIMEOUT)
+
+
+def observe(name, value, label=''):
+    """Add `value` to the histogram `name`."""
+    buckets = HISTOGRAMS[name][1]
+    bucket = len(buckets)
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            bucket = i
+            break
+    incr(name, 1, label, str(bucket))
+    incr(name, 1, label, 'count')
+    incr(name, int(value * 1000), label, 'sum_ms')
+
+
+def record_state(instance_id, state):
+    """
+    Note that instance `instance_id` has just moved to `state`.
+
+    Records the time it spent in its previous state in the phase
+    histogram, and as a PhaseTiming row. Repeated calls for the same
+    state are ignored.
+
+    """
+    key = 'instance_phase:%s' % instance_id
+    now = time.time()
+    previous = cache.get(key)
+    if previous is not None and previous[0] == state:
+        return
+    if state == 'terminated':
+        cache.delete(key)
+    else:
+        cache.set(key, (state, now), PHASE_TIMEOUT)
+    if previous is None:
+        return
+
+    phase, started = previous
+    seconds = now - started
+    observe('minecloud_phase_seconds', seconds, phase)
+    PhaseTiming.objects.create(
+        instance_id=instance_id, phase=phase, seconds=seconds,
+        ended=datetime.datetime.utcnow().replace(tzinfo=utc))
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of `values`, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def _labels(label_name, label, **extra):
+    labels = []
+    if label_name:
+        labels.append('%s="%s"' % (label_name, label))
+    for name, value in sorted(extra.items()):
+        labels.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(labels) if labels else ''
+
+
+def render_metrics():
+    """Return all metrics, in the Prometheus text exposition format."""
+    keys = []
+    for name, (help, buckets, label_name, labels) in HISTOGRAMS.items():
+        for label in labels:
+            keys.extend(_key(name, label, part) for part in
+                        [str(i) for i in range(len(buckets) + 1)] +
+                        ['count', 'sum_ms'])
+    keys.extend(_key(name) for name in COUNTERS)
+    keys.extend(_key(name) for name in GAUGES)
+    values = cache.get_many(keys)
+
+    lines = []
+    for name, help in sorted(COUNTERS.items()):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s counter' % name)
+        lines.append('%s %d' % (name, values.get(_key(name), 0)))
+    for name, help in sorted(GAUGES.items()):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %d' % (name, max(values.get(_key(name), 0), 0)))
+    for name, (help, buckets, label_name, labels) in sorted(
+            HISTOGRAMS.items()):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+        for label in labels:
+            cumulative = 0
+            for i, bound in enumerate(buckets + ('+Inf',)):
+                cumulative += values.get(_key(name, label, str(i)), 0)
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(label_name, label, le=bound), cumulative))
+            lines.append('%s_sum%s %.3f' % (
+                name, _labels(label_name, label),
+                values.get(_key(name, label, 'sum_ms'), 0) / 1000.0))
+            lines.append('%s_count%s %d' % (
+                name, _labels(label_name, label),
+                values.get(_key(name, label, 'count'), 0)))
+    return '\n'.join(lines) + '\n'
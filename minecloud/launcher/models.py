@@ -1,18 +1,120 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import connection, models
+
+# Most rows changed by one bulk_update() query.
+BULK_UPDATE_BATCH_SIZE = 300
+
+
+def command_channel(world):
+    """Redis channel on which the game server of `world` listens."""
+    if world == 'default':
+        return 'command'
+    return 'command:%s' % world
+
+
+def bulk_update(model, assignment, values):
+    """
+    Set a column of many rows, each to its own value, in a few queries.
+
+    `values` maps row ids to (DB-ready) values. `assignment` is the SET
+    clause, with "%(value)s" standing for each row's value, e.g.
+    "seconds = seconds + %(value)s".
+
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    items = values.items()
+    for i in range(0, len(items), BULK_UPDATE_BATCH_SIZE):
+        batch = items[i:i + BULK_UPDATE_BATCH_SIZE]
+        case = 'CASE id %s END' % ' '.join(['WHEN %s THEN %s'] * len(batch))
+        params = []
+        for pk, value in batch:
+            params.extend([pk, value])
+        params.extend(pk for pk, value in batch)
+        connection.cursor().execute(
+            'UPDATE %s SET %s WHERE id IN (%s)' % (
+                table,
+                assignment % {'value': case},
+                ', '.join(['%s'] * len(batch))),
+            params)
+
+
+class PoolServer(models.Model):
+    """
+    A pre-provisioned EBS-backed EC2 server, kept stopped in the warm pool.
+
+    Pool servers boot once to restore their world, then halt. Launching
+    one is just a start_instances call; when it's shut down, it's stopped
+    and returned to the pool with the world still on disk. `manifest` is
+    the backup (see minecloud.backup) of the world on disk, so a server
+    whose world is older than the latest backup isn't launched.
+
+    """
+    world = models.CharField(max_length=50)
+    name = models.CharField(max_length=20, blank=True)
+    ami = models.CharField(max_length=20, blank=True)
+    manifest = models.CharField(max_length=100, blank=True)
+    created = models.DateTimeField()
+    released = models.DateTimeField(null=True, blank=True)
+    # 'provisioning', 'ready', 'in use' or 'retired'
+    state = models.CharField(max_length=30)
+
+    def __unicode__(self):
+        return "%s: %s (%s)" % (self.id, self.name, self.world)
+
+
+class WorldVolume(models.Model):
+    """
+    The EBS volume a world is kept on, when MINECLOUD_PERSISTENCE is 'ebs'.
+
+    The volume is attached to the world's server while it runs, and
+    snapshotted on shutdown. Since volumes can't leave their availability
+    zone, a server launched elsewhere gets a new volume from the latest
+    snapshot.
+
+    """
+    world = models.CharField(max_length=50, unique=True)
+    volume_id = models.CharField(max_length=20, blank=True)
+    zone = models.CharField(max_length=30, blank=True)
+    snapshot_id = models.CharField(max_length=20, blank=True)
+
+    def __unicode__(self):
+        return "%s: %s (%s)" % (self.world, self.volume_id, self.zone)
+
 
 class Instance(models.Model):
     launched_by = models.ForeignKey(User)
+    world = models.CharField(max_length=50, default='default')
     name = models.CharField(max_length=20)
     ami =  models.CharField(max_length=20)
+    # EC2 region of the server, if not the default one (MCL_EC2_REGION).
+    region = models.CharField(max_length=30, blank=True)
     ip_address = models.IPAddressField(null=True, blank=True)
     start= models.DateTimeField()
     end = models.DateTimeField(null=True, blank=True)
-    state = models.CharField(max_length=30)
+    state = models.CharField(max_length=30, db_index=True)
+    # When the game server first reported 'running'.
+    ready = models.DateTimeField(null=True, blank=True)
+    # Set if the instance was started from the warm pool.
+    pool_server = models.ForeignKey(PoolServer, null=True, blank=True)
+    # Set if the instance was started ahead of players, by tasks.prewarm.
+    prewarmed = models.BooleanField(default=False)
 
     def __unicode__(self):
         return "%s: %s" % (self.id, self.name)
 
+    @property
+    def launch_latency(self):
+        """Seconds from 'Wake Up Server' until the server was running."""
+        if self.ready is None:
+            return None
+        delta = self.ready - self.start
+        return delta.days * 86400 + delta.seconds
+
+    @property
+    def command_channel(self):
+        """Redis channel on which the game server listens for commands."""
+        return command_channel(self.world)
+
 class Session(models.Model):
     user = models.ForeignKey(User)
     instance = models.ForeignKey(Instance)
@@ -21,6 +123,118 @@ class Session(models.Model):
 
     class Meta:
         unique_together = ("user", "instance", "login")
+        index_together = [("instance", "logout")]
 
     def __unicode__(self):
         return "%s, %s" % (self.user, self.instance)
+
+
+class DailyPlaytime(models.Model):
+    """Seconds `user` played in `world` on `day` (UTC). See rollups.py."""
+    user = models.ForeignKey(User)
+    world = models.CharField(max_length=50)
+    day = models.DateField(db_index=True)
+    seconds = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "world", "day")
+
+    def __unicode__(self):
+        return "%s, %s, %s" % (self.user, self.world, self.day)
+
+
+class DailyUptime(models.Model):
+    """Seconds `instance` ran on `day` (UTC). See rollups.py."""
+    instance = models.ForeignKey(Instance)
+    world = models.CharField(max_length=50)
+    launched_by = models.ForeignKey(User)
+    day = models.DateField(db_index=True)
+    seconds = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("instance", "day")
+
+    def __unicode__(self):
+        return "%s, %s" % (self.instance, self.day)
+
+
+class PhaseTiming(models.Model):
+    """Seconds `instance` spent in lifecycle state `phase`. See metrics.py."""
+    instance = models.ForeignKey(Instance)
+    phase = models.CharField(max_length=30)
+    seconds = models.FloatField()
+    ended = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return "%s, %s" % (self.instance, self.phase)
+
+
+class LaunchAttempt(models.Model):
+    """
+    One of the servers booted for a hedged launch of `instance` (see
+    hedging.py): number 0 in the default placement, then one in each of
+    MINECLOUD_HEDGE_PLACEMENTS, in order, as the earlier ones fail or run
+    late.
+
+    """
+    instance = models.ForeignKey(Instance)
+    number = models.IntegerField()
+    region = models.CharField(max_length=30)
+    zone = models.CharField(max_length=30, blank=True)
+    name = models.CharField(max_length=20, blank=True)
+    start = models.DateTimeField()
+    # When EC2 first reported the server running, with an IP address.
+    ready = models.DateTimeField(null=True, blank=True)
+    # 'pending', 'won', 'lost' or 'failed'
+    outcome = models.CharField(max_length=10, default='pending')
+    error = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        unique_together = ("instance", "number")
+
+    def __unicode__(self):
+        return "%s, %s: %s" % (self.instance, self.number, self.outcome)
+
+    @property
+    def seconds_to_ready(self):
+        if self.ready is None:
+            return None
+        delta = self.ready - self.start
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class TelemetrySample(models.Model):
+    """
+    A game server's telemetry over `resolution` seconds from `start`.
+
+    Raw samples (resolution 1) are rolled up into 1-minute, then 1-hour
+    rows as they age. Sums, counts, minimums and maximums all carry over,
+    so a rollup of rollups is exact. See telemetry.py.
+
+    """
+    instance = models.ForeignKey(Instance)
+    world = models.CharField(max_length=50)
+    resolution = models.IntegerField()
+    start = models.DateTimeField()
+    count = models.IntegerField(default=1)
+    # Ticks per second (20 at most), and the lowest 1-minute average.
+    tps_sum = models.FloatField()
+    tps_min = models.FloatField()
+    # Heap in use, in MiB.
+    memory_sum = models.FloatField()
+    memory_max = models.FloatField()
+    # Loaded chunks.
+    chunks_sum = models.IntegerField()
+    chunks_max = models.IntegerField()
+    players_max = models.IntegerField()
+    # Player latency in ms, over `latency_count` player samples.
+    latency_sum = models.IntegerField()
+    latency_count = models.IntegerField()
+    latency_max = models.IntegerField()
+
+    class Meta:
+        unique_together = ("instance", "resolution", "start")
+        index_together = [("resolution", "start")]
+
+    def __unicode__(self):
+        return "%s, %s, %ss" % (self.instance, self.start, self.resolution)
@@ -0,0 +1,201 @@
+"""
+Kombu transport that keeps messages in Postgres, like
+kombu.transport.django, but wakes consumers with LISTEN/NOTIFY instead of
+having them poll.
+
+Messages are kept in the same tables as kombu.transport.django
+(djkombu_queue and djkombu_message), so either transport can read what
+the other sent. The differences:
+
+* Publishing a message also sends a NOTIFY on the 'kombu' channel, in the
+  same transaction, which wakes the waiting consumers right away. They
+  only look at the tables every POLLING_INTERVAL seconds otherwise, in
+  case they miss a notification (e.g. after reconnecting).
+
+* Consumers claim a message and delete it in one statement, skipping rows
+  other consumers have locked (FOR UPDATE SKIP LOCKED, Postgres 9.5+), so
+  several workers never wait on each other, or get the same message.
+
+Each channel keeps its own autocommit connection for LISTEN and for
+claiming messages; messages are published on Django's connection.
+
+Select it with a 'pglisten://' broker URL, by setting MCL_BROKER_TRANSPORT
+to 'pglisten' (see BROKER_URL in settings).
+
+"""
+from __future__ import absolute_import
+
+import select
+import socket
+from Queue import Empty
+from time import sleep, time
+
+from anyjson import dumps, loads
+import psycopg2
+import psycopg2.extensions
+
+from django.conf import settings
+from django.db import connection as django_connection, transaction
+
+from kombu.exceptions import StdConnectionError, StdChannelError
+from kombu.transport import virtual
+from kombu.transport.django.models import Message, Queue
+
+# Seconds between checks for messages when no notifications arrive.
+POLLING_INTERVAL = getattr(settings, 'KOMBU_PGLISTEN_POLLING_INTERVAL', 30.0)
+
+# The NOTIFY channel; the payload is the name of the queue.
+NOTIFY_CHANNEL = 'kombu'
+
+CLAIM_SQL = """
+    DELETE FROM {message} WHERE id = (
+        SELECT id FROM {message}
+        WHERE queue_id = %s AND visible
+        ORDER BY sent_at, id
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1)
+    RETURNING payload
+""".format(message=Message._meta.db_table)
+
+PUBLISH_SQL = """
+    INSERT INTO {message} (visible, sent_at, payload, queue_id)
+    VALUES (true, now(), %s, %s)
+""".format(message=Message._meta.db_table)
+
+
+class Channel(virtual.Channel):
+
+    def __init__(self, *args, **kwargs):
+        super(Channel, self).__init__(*args, **kwargs)
+        self._client = None
+        self._queue_ids = {}
+
+    @property
+    def client(self):
+        """The channel's own connection, listening for notifications."""
+        if self._client is None:
+            conninfo = self.connection.client
+            client = psycopg2.connect(
+                host=conninfo.hostname or None,
+                port=conninfo.port or None,
+                user=conninfo.userid or None,
+                password=conninfo.password or None,
+                database=conninfo.virtual_host.lstrip('/'),
+                sslmode='require' if conninfo.ssl else 'prefer')
+            client.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            client.cursor().execute('LISTEN %s' % NOTIFY_CHANNEL)
+            self._client = client
+        return self._client
+
+    def queue_id(self, queue):
+        if queue not in self._queue_ids:
+            self._queue_ids[queue] = \
+                Queue.objects.get_or_create(name=queue)[0].pk
+        return self._queue_ids[queue]
+
+    def _new_queue(self, queue, **kwargs):
+        self.queue_id(queue)
+
+    def _put(self, queue, message, **kwargs):
+        cursor = django_connection.cursor()
+        cursor.execute(PUBLISH_SQL, [dumps(message), self.queue_id(queue)])
+        cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, queue])
+        transaction.commit_unless_managed()
+
+    def basic_consume(self, queue, *args, **kwargs):
+        qinfo = self.state.bindings[queue]
+        exchange = qinfo[0]
+        if self.typeof(exchange).type == 'fanout':
+            return
+        super(Channel, self).basic_consume(queue, *args, **kwargs)
+
+    def _get(self, queue):
+        cursor = self.client.cursor()
+        cursor.execute(CLAIM_SQL, [self.queue_id(queue)])
+        row = cursor.fetchone()
+        if row is None:
+            raise Empty()
+        return loads(row[0])
+
+    def _size(self, queue):
+        cursor = self.client.cursor()
+        cursor.execute('SELECT count(*) FROM %s WHERE queue_id = %%s '
+                       'AND visible' % Message._meta.db_table,
+                       [self.queue_id(queue)])
+        return cursor.fetchone()[0]
+
+    def _purge(self, queue):
+        cursor = self.client.cursor()
+        cursor.execute('DELETE FROM %s WHERE queue_id = %%s'
+                       % Message._meta.db_table, [self.queue_id(queue)])
+        return cursor.rowcount
+
+    def close(self):
+        super(Channel, self).close()
+        if self._client is not None:
+            try:
+                self._client.close()
+            except psycopg2.InterfaceError:
+                pass
+            self._client = None
+
+
+class Transport(virtual.Transport):
+    Channel = Channel
+
+    default_port = 5432
+    polling_interval = POLLING_INTERVAL
+    connection_errors = (StdConnectionError,
+                         psycopg2.OperationalError,
+                         psycopg2.InterfaceError)
+    channel_errors = (StdChannelError,
+                      psycopg2.DatabaseError)
+    driver_type = 'sql'
+    driver_name = 'psycopg2'
+
+    def driver_version(self):
+        return psycopg2.__version__.split()[0]
+
+    def drain_events(self, connection, timeout=None):
+        """
+        Like virtual.Transport.drain_events, but waits for a notification
+        instead of sleeping while the queues are empty.
+
+        """
+        time_start = time()
+        get = self.cycle.get
+        while True:
+            try:
+                item, channel = get(timeout=timeout)
+            except Empty:
+                elapsed = time() - time_start
+                if timeout and elapsed >= timeout:
+                    raise socket.timeout()
+                wait = self.polling_interval
+                if timeout:
+                    wait = min(wait, timeout - elapsed)
+                self.wait_for_notify(wait)
+            else:
+                break
+
+        message, queue = item
+        if not queue or queue not in self._callbacks:
+            raise KeyError(
+                'Received message for queue %r without consumers: %r' % (
+                    queue, message))
+        self._callbacks[queue](message)
+
+    def wait_for_notify(self, seconds):
+        """Wait up to `seconds` for any channel to be notified."""
+        clients = [channel.client for channel in self.channels
+                   if channel._consumers]
+        if not clients:
+            sleep(seconds)
+            return
+        readable, _, _ = select.select(clients, [], [], seconds)
+        for client in readable:
+            client.poll()
+            # Any notification means "look again"; which queue it was
+            # for doesn't matter.
+            del client.notifies[:]
@@ -0,0 +1,165 @@
+"""
+Player sessions, recorded from the game servers' join and leave events.
+
+Game servers RPUSH their events, as JSON, onto the PLAYER_EVENTS_KEY list
+in Redis:
+
+  {"event": "join", "world": "default", "player": "steve", "time": 1371234567}
+  {"event": "leave", "world": "default", "player": "steve", "time": 1371234890}
+
+The ingest_player_events task takes them off the list in batches, and
+records each batch with a fixed number of queries, in one transaction.
+
+"""
+import datetime
+import json
+import logging
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.timezone import utc
+
+from .models import Instance, Session, bulk_update
+from .rollups import add_playtime
+from .sseview import send_event
+
+logger = logging.getLogger(__name__)
+
+PLAYER_EVENTS_KEY = 'player_events'
+
+
+def parse_event(event):
+    """Return the fields of a raw player event, or None if malformed."""
+    try:
+        kind = event['event']
+        player = event['player']
+        world = event.get('world', 'default')
+        timestamp = datetime.datetime.utcfromtimestamp(
+            int(event['time'])).replace(tzinfo=utc)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    if kind not in ('join', 'leave') or not player:
+        return None
+    return {'event': kind,
+            'world': world,
+            'player': player,
+            'time': timestamp}
+
+
+@transaction.commit_on_success
+def record_player_events(events):
+    """
+    Create and log out the Sessions for a batch of join and leave events.
+
+    Malformed events, and events for unknown players or worlds without
+    a running instance, are dropped. Joins that were recorded already (e.g. when a batch is
+    replayed) are skipped, so the (user, instance, login) constraint
+    holds. The playtime of the sessions logged out is added to the daily
+    rollups. Returns the ids of the instances whose sessions changed.
+
+    """
+    parsed_events = filter(None, map(parse_event, events))
+    if len(parsed_events) < len(events):
+        logger.error("Dropped %d malformed player events.",
+                     len(events) - len(parsed_events))
+    events = parsed_events
+    if not events:
+        return set()
+
+    worlds = set(event['world'] for event in events)
+    instances = dict((instance.world, instance) for instance in
+                     Instance.objects
+                        .filter(world__in=worlds)
+                        .exclude(state__exact='terminated'))
+    usernames = set(event['player'] for event in events)
+    users = dict((user.username, user) for user in
+                 User.objects.filter(username__in=usernames))
+
+    parsed = []
+    for event in events:
+        instance = instances.get(event['world'])
+        user = users.get(event['player'])
+        if instance is None or user is None:
+            logger.warning("Dropped %s event of player %s in world %s.",
+                           event['event'], event['player'], event['world'])
+            continue
+        parsed.append((event['event'], instance, user, event['time']))
+    if not parsed:
+        return set()
+
+    # The open sessions, and any sessions these joins already created.
+    logins = set(timestamp for kind, instance, user, timestamp in parsed
+                 if kind == 'join')
+    existing = (Session.objects
+        .filter(instance__in=[running.id for running in instances.values()])
+        .filter(user__in=[known.id for known in users.values()])
+        .filter(Q(logout__isnull=True) | Q(login__in=logins))
+        .order_by('login')
+    )
+    recorded = set()
+    open_sessions = {}
+    for session in existing:
+        recorded.add((session.user_id, session.instance_id, session.login))
+        if session.logout is None:
+            open_sessions[(session.instance_id, session.user_id)] = session
+
+    new_sessions = []
+    closed = []
+    changed = set()
+    for kind, instance, user, timestamp in parsed:
+        key = (instance.id, user.id)
+        if kind == 'join':
+            if (user.id, instance.id, timestamp) in recorded:
+                continue
+            recorded.add((user.id, instance.id, timestamp))
+            # A join without a leave means the leave was lost.
+            close_session(open_sessions.pop(key, None), timestamp, closed)
+            session = Session(user=user, instance=instance, login=timestamp)
+            new_sessions.append(session)
+            open_sessions[key] = session
+        elif not close_session(open_sessions.pop(key, None), timestamp,
+                               closed):
+            continue
+        changed.add(instance.id)
+
+    Session.objects.bulk_create(new_sessions)
+    bulk_update(Session, 'logout = %(value)s', dict(
+        (session.pk, connection.ops.value_to_db_datetime(session.logout))
+        for session in closed if session.pk is not None))
+
+    worlds = dict((instance.id, instance.world)
+                  for instance in instances.values())
+    add_playtime((session.user_id, worlds[session.instance_id],
+                  session.login, session.logout) for session in closed)
+    return changed
+
+
+def close_session(session, timestamp, closed):
+    """Log out `session`, if any, once the batch is written."""
+    if session is None:
+        return False
+    session.logout = timestamp
+    closed.append(session)
+    return True
+
+
+def send_rosters(instance_ids):
+    """Send the current players of each instance to all SSE clients."""
+    if not instance_ids:
+        return
+    rosters = dict((instance.id, (instance.world, [])) for instance in
+                   Instance.objects.filter(id__in=instance_ids))
+    sessions = (Session.objects
+        .filter(instance__in=instance_ids)
+        .filter(logout__isnull=True)
+        .select_related('user')
+        .order_by('login')
+    )
+    for session in sessions:
+        rosters[session.instance_id][1].append(
+            {'name': session.user.username,
+             'login': session.login.isoformat()})
+    for world, players in rosters.values():
+        data = json.dumps({'world': world, 'players': players})
+        send_event('roster', data, key='roster:%s' % world)
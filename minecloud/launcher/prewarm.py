@@ -0,0 +1,132 @@
+"""
+Predicts when players will want each world's server, from when they've
+launched it and logged in to it before, so it can be started shortly
+before they do (see tasks.prewarm).
+
+The week is split into SLOT_MINUTES slots, in TIME_ZONE, so evenings stay
+evenings across daylight saving changes. A world's DemandPattern records,
+for each slot, in which of the last HISTORY_WEEKS weeks players wanted
+the server then: someone pressed "Wake Up Server", or logged in. The
+chance they'll want it in a slot is the share of weeks in which they did,
+with recent weeks counting for more (HALF_LIFE_WEEKS), so a new routine
+takes over within a few weeks.
+
+Learning the patterns takes two queries, and they're cached for an hour,
+so deciding which worlds to pre-warm is a few dict lookups.
+
+"""
+import datetime
+import itertools
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Instance, Session
+
+SLOT_MINUTES = 15
+SLOTS_PER_WEEK = 7 * 24 * 60 // SLOT_MINUTES
+
+# Weeks of history patterns are learned from, and how quickly older
+# weeks stop counting.
+HISTORY_WEEKS = 8
+HALF_LIFE_WEEKS = 3.0
+
+# A single week is a coincidence, not a pattern.
+MIN_HISTORY_WEEKS = 2
+
+PATTERNS_CACHE_KEY = 'prewarm_patterns'
+PATTERNS_CACHE_TIMEOUT = 60*60
+
+WEEK_SECONDS = 7 * 24 * 60 * 60
+
+
+def week_slot(when):
+    """Return the slot of the week `when` falls in, in local time."""
+    local = timezone.localtime(when)
+    minutes = (local.weekday() * 24 + local.hour) * 60 + local.minute
+    return minutes // SLOT_MINUTES
+
+
+def weight(weeks_ago):
+    """How much a week counts, compared to the latest one."""
+    return 0.5 ** (weeks_ago / HALF_LIFE_WEEKS)
+
+
+class DemandPattern(object):
+    """The weeks in which players wanted a server, by slot of the week."""
+
+    def __init__(self):
+        self.weeks = 0      # Weeks of history, up to HISTORY_WEEKS.
+        self.slots = {}     # Slot -> set of weeks ago.
+
+    @classmethod
+    def learn(cls, times, now):
+        """Return the pattern of demand at `times` (aware datetimes)."""
+        pattern = cls()
+        for when in times:
+            delta = now - when
+            weeks_ago = int((delta.days * 86400 + delta.seconds) //
+                            WEEK_SECONDS)
+            if not 0 <= weeks_ago < HISTORY_WEEKS:
+                continue
+            pattern.slots.setdefault(week_slot(when), set()).add(weeks_ago)
+            pattern.weeks = max(pattern.weeks, weeks_ago + 1)
+        return pattern
+
+    def probability(self, start, minutes):
+        """
+        Return the chance, from 0 to 1, that players want the server
+        between `start` and `minutes` later.
+
+        """
+        if self.weeks < MIN_HISTORY_WEEKS:
+            return 0.0
+        first = week_slot(start)
+        last = week_slot(start + datetime.timedelta(minutes=minutes))
+        weeks = set()
+        for i in range((last - first) % SLOTS_PER_WEEK + 1):
+            weeks.update(self.slots.get((first + i) % SLOTS_PER_WEEK, ()))
+        total = sum(weight(week) for week in range(self.weeks))
+        return sum(weight(week) for week in weeks) / total
+
+
+def learn_patterns(now):
+    """
+    Return a DemandPattern per world, from the launches (other than
+    pre-warms) and logins of the last HISTORY_WEEKS weeks.
+
+    """
+    since = now - datetime.timedelta(weeks=HISTORY_WEEKS)
+    launches = (Instance.objects
+        .filter(start__gte=since, prewarmed=False)
+        .values_list('world', 'start')
+    )
+    logins = (Session.objects
+        .filter(login__gte=since)
+        .values_list('instance__world', 'login')
+    )
+    times = {}
+    for world, when in itertools.chain(launches, logins):
+        times.setdefault(world, []).append(when)
+    return dict((world, DemandPattern.learn(world_times, now))
+                for world, world_times in times.items())
+
+
+def demand_patterns(now):
+    """Return the cached patterns, learning them again once an hour."""
+    patterns = cache.get(PATTERNS_CACHE_KEY)
+    if patterns is None:
+        patterns = learn_patterns(now)
+        cache.set(PATTERNS_CACHE_KEY, patterns, PATTERNS_CACHE_TIMEOUT)
+    return patterns
+
+
+def worlds_to_prewarm(patterns, worlds, now, lead_minutes, threshold):
+    """
+    Return the `worlds` players will probably want within `lead_minutes`
+    of `now`, i.e. with a probability of at least `threshold`.
+
+    """
+    return [world for world in worlds
+            if world in patterns and
+            patterns[world].probability(now, lead_minutes) >= threshold]
@@ -0,0 +1,119 @@
+"""
+Daily playtime and uptime totals, kept up to date as sessions and
+instances end, so reports never have to scan the Session and Instance
+history.
+
+DailyPlaytime rows are added to as each batch of sessions is logged out
+(see players.record_player_events). DailyUptime rows are rewritten for an
+instance when it gets its end timestamp, which makes that idempotent.
+manage.py backfill_rollups rebuilds both from the full history.
+
+"""
+import datetime
+
+from django.db import transaction
+
+from .models import (DailyPlaytime, DailyUptime, Instance, Session,
+                     bulk_update)
+
+
+def split_by_day(start, end):
+    """Yield (date, seconds) for each UTC day between `start` and `end`."""
+    while start < end:
+        next_day = (start + datetime.timedelta(days=1)).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        until = min(end, next_day)
+        delta = until - start
+        yield start.date(), delta.days * 86400 + delta.seconds
+        start = until
+
+
+def playtime_by_day(sessions):
+    """
+    Sum up playtime per (user id, world, day).
+
+    `sessions` is an iterable of (user id, world, login, logout).
+
+    """
+    totals = {}
+    for user_id, world, login, logout in sessions:
+        for day, seconds in split_by_day(login, logout):
+            key = (user_id, world, day)
+            totals[key] = totals.get(key, 0) + seconds
+    return totals
+
+
+def add_playtime(sessions):
+    """
+    Add the playtime of finished `sessions` to the DailyPlaytime rows.
+
+    `sessions` is an iterable of (user id, world, login, logout). Costs
+    one query to find the existing rows, one insert for the new ones, and
+    a bulk_update() of the others.
+
+    """
+    totals = playtime_by_day(sessions)
+    if not totals:
+        return
+    existing = dict(
+        ((row.user_id, row.world, row.day), row.id) for row in
+        DailyPlaytime.objects
+            .filter(user__in=set(key[0] for key in totals))
+            .filter(day__in=set(key[2] for key in totals))
+            .only('id', 'user', 'world', 'day'))
+
+    increments = {}
+    new_rows = []
+    for key, seconds in totals.items():
+        if key in existing:
+            increments[existing[key]] = seconds
+        else:
+            user_id, world, day = key
+            new_rows.append(DailyPlaytime(user_id=user_id, world=world,
+                                          day=day, seconds=seconds))
+    DailyPlaytime.objects.bulk_create(new_rows)
+    bulk_update(DailyPlaytime, 'seconds = seconds + %(value)s', increments)
+
+
+def uptime_rows(instance):
+    return [DailyUptime(instance_id=instance.id, world=instance.world,
+                        launched_by_id=instance.launched_by_id,
+                        day=day, seconds=seconds)
+            for day, seconds in split_by_day(instance.start, instance.end)]
+
+
+@transaction.commit_on_success
+def record_uptime(instance_id):
+    """Rewrite the DailyUptime rows of an instance that has ended."""
+    instance = Instance.objects.get(pk=instance_id)
+    if instance.end is None:
+        return
+    DailyUptime.objects.filter(instance=instance_id).delete()
+    DailyUptime.objects.bulk_create(uptime_rows(instance))
+
+
+@transaction.commit_on_success
+def backfill(batch_size=1000):
+    """Rebuild all rollups from the Session and Instance history."""
+    DailyPlaytime.objects.all().delete()
+    DailyUptime.objects.all().delete()
+
+    worlds = dict(Instance.objects.values_list('id', 'world'))
+    sessions = (Session.objects
+        .filter(logout__isnull=False)
+        .values_list('user', 'instance', 'login', 'logout')
+        .iterator()
+    )
+    totals = playtime_by_day(
+        (user_id, worlds[instance_id], login, logout)
+        for user_id, instance_id, login, logout in sessions)
+    DailyPlaytime.objects.bulk_create(
+        [DailyPlaytime(user_id=user_id, world=world, day=day, seconds=seconds)
+         for (user_id, world, day), seconds in totals.items()],
+        batch_size=batch_size)
+
+    rows = []
+    for instance in Instance.objects.filter(end__isnull=False).iterator():
+        rows.extend(uptime_rows(instance))
+    DailyUptime.objects.bulk_create(rows, batch_size=batch_size)
+    return len(totals), len(rows)
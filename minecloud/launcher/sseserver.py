@@ -0,0 +1,117 @@
+"""
+Standalone server for the instance state SSE stream.
+
+SseView streams events through the whole Django request cycle, and every
+open connection holds a gunicorn worker greenlet until it times out.
+SseApplication is a bare WSGI application that serves the same stream
+with the same authentication (the Django session cookie), but touches
+Django only to look up the session. Run it with:
+
+    python manage.py runsseserver 0.0.0.0:8001
+
+which serves it from a single gevent event loop, so one process can hold
+many thousands of idle connections. Route /sse to it (or set the
+MCL_SSE_URL env variable) to use it instead of SseView.
+
+Served from another origin (host or port), it allows credentialed
+cross-origin requests from SSE_ALLOWED_ORIGINS, so the page's
+EventSource can send the session cookie. The cookie must also be set
+for the SSE server's host (see SESSION_COOKIE_DOMAIN); cookies ignore
+ports, so a different port on the same host needs nothing more.
+
+"""
+from django import db
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import User
+from django.http import QueryDict, parse_cookie
+from django.utils.importlib import import_module
+
+from .sseview import (instance_state_stream, parse_channels,
+                      parse_last_event_id)
+
+
+def get_session_user_id(environ):
+    """Return the id of the logged in user, or None."""
+    cookies = parse_cookie(environ.get('HTTP_COOKIE', ''))
+    session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+    if not session_key:
+        return None
+
+    engine = import_module(settings.SESSION_ENGINE)
+    try:
+        user_id = engine.SessionStore(session_key).get(SESSION_KEY)
+        if user_id is None:
+            return None
+        if not User.objects.filter(pk=user_id, is_active=True).exists():
+            return None
+        return user_id
+    finally:
+        # Don't keep the DB connection open while SSEs are sent.
+        db.close_connection()
+
+
+class SseApplication(object):
+    """WSGI application that serves the instance state stream at `path`."""
+
+    def __init__(self, path='/sse'):
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        cors = cors_headers(environ)
+        if environ.get('PATH_INFO') != self.path:
+            start_response('404 NOT FOUND', [('Content-Type', 'text/plain')])
+            return ['Not found']
+        if environ.get('REQUEST_METHOD') == 'OPTIONS' and cors:
+            # Preflight, for browsers that send one for Last-Event-ID.
+            start_response('200 OK', cors + [
+                ('Access-Control-Allow-Methods', 'GET'),
+                ('Access-Control-Allow-Headers',
+                 'Last-Event-ID, Cache-Control'),
+                ('Access-Control-Max-Age', '86400'),
+                ('Content-Length', '0')])
+            return []
+        if environ.get('REQUEST_METHOD') != 'GET':
+            start_response('405 METHOD NOT ALLOWED',
+                           [('Content-Type', 'text/plain'), ('Allow', 'GET')])
+            return ['Method not allowed']
+        if get_session_user_id(environ) is None:
+            start_response('403 FORBIDDEN',
+                           cors + [('Content-Type', 'text/plain')])
+            return ['Forbidden']
+
+        last_event_id = parse_last_event_id(
+            environ.get('HTTP_LAST_EVENT_ID'))
+        channels = parse_channels(
+            QueryDict(environ.get('QUERY_STRING', '')).get('channels'))
+        start_response('200 OK', cors + [('Content-Type', 'text/event-stream'),
+                                         ('Cache-Control', 'no-cache')])
+        return EncodedStream(instance_state_stream(last_event_id, channels))
+
+
+def cors_headers(environ):
+    """
+    Return the headers that let a page from the request's Origin read
+    the response with credentials, if it's one of SSE_ALLOWED_ORIGINS.
+
+    """
+    origin = environ.get('HTTP_ORIGIN')
+    if not origin or origin not in settings.SSE_ALLOWED_ORIGINS:
+        return []
+    return [('Access-Control-Allow-Origin', origin),
+            ('Access-Control-Allow-Credentials', 'true'),
+            ('Vary', 'Origin')]
+
+
+class EncodedStream(object):
+    """Encode the unicode chunks of an SSE stream for a WSGI server."""
+
+    def __init__(self, sse):
+        self.sse = sse
+
+    def __iter__(self):
+        for chunk in self.sse:
+            yield chunk.encode('utf-8')
+
+    def close(self):
+        self.sse.close()
@@ -1,7 +1,12 @@
+import collections
 import json
+import logging
+import os
+import threading
 import time
 
 from django import db
+from django.conf import settings
 from django.core.cache import cache
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
@@ -14,6 +19,21 @@ except ImportError:
 from django_sse.views import BaseSseView
 from sse import Sse
 
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SSE_CHANNEL = 'sse'
+EVENT_SEQUENCE_KEY = 'sse_event_id'
+EVENT_HISTORY_SIZE = 100
+# How long events are kept in the log.
+EVENT_TIMEOUT = 60*60*24
+# How long a reader waits for an event whose id was taken, but which
+# isn't in the log yet, before giving up on it (its sender died).
+EVENT_GAP_GRACE = 10
+# Id of the last event that changed what the index page shows.
+PAGE_VERSION_KEY = 'page_version'
+
 
 class EventReader(object):
     """
@@ -35,6 +55,10 @@ class EventReader(object):
           between event readings. It's not necessary if you are listening
           for events, but it's useful if you are polling for updates.
 
+    read_events() yields (event, data) tuples, or (event, data, event_id)
+    tuples for events that have an id. It may also yield None to signal
+    that nothing happened, so the client can be sent a heartbeat.
+
     """
     def __init__(self, timeout=30, sleep_interval=3):
         self.start_time = time.time()
@@ -46,8 +70,8 @@ class EventReader(object):
         raise NotImplementedError
 
     def __iter__(self):
-        for event, data in self.read_events():
-            yield event, data
+        for item in self.read_events():
+            yield item
 
             if self.timeout:
                 running_time = time.time() - self.start_time
@@ -79,6 +103,356 @@ class CacheReader(EventReader):
             yield event, data
 
 
+class EventLogReader(EventReader):
+    """
+    EventReader that follows the sequenced event log kept by send_event().
+
+    Every event sent with send_event() gets an id from a counter in the
+    Django cache and is stored under its own key. EventLogReader polls
+    the counter (a single cache GET) and only fetches the events it has
+    not seen yet, yielding (event, data, event_id, key) tuples in order,
+    where `key` is the cache key send_event() stored the event under.
+
+    On its first read, it fetches up to `history` earlier events, so
+    they can be replayed to clients that reconnect. When a poll finds
+    nothing new, and after the first read, it yields None. Polls are
+    `poll_interval` seconds apart.
+
+    send_event() takes an id before it stores the event, so a poll can
+    find the counter ahead of the log. The reader then stops at the
+    missing event and fetches it again on the next poll, until it has
+    been missing for EVENT_GAP_GRACE seconds, or an event sent after it
+    is that old.
+
+    """
+    def __init__(self, history=EVENT_HISTORY_SIZE, poll_interval=1,
+                 *args, **kwargs):
+        self.history = history
+        self.poll_interval = poll_interval
+        self.last_id = None
+        self.gap = None     # (missing event id, when first found missing)
+        # Sleep between polls, not between the events found by a poll.
+        kwargs.setdefault('sleep_interval', None)
+        super(EventLogReader, self).__init__(*args, **kwargs)
+
+    def read_new_events(self):
+        """Return the events sent since the last read, oldest first."""
+        seq = cache.get(EVENT_SEQUENCE_KEY) or 0
+        if self.last_id is not None and seq <= self.last_id:
+            # The counter went backwards, e.g. memcache was flushed.
+            self.last_id = min(self.last_id, seq)
+            return []
+
+        # Events loaded as history on the first read aren't new, so
+        # they don't count towards the delay metric.
+        first_read = self.last_id is None
+        if first_read:
+            self.last_id = max(seq - self.history, 0)
+        ids = range(self.last_id + 1, seq + 1)
+        found = cache.get_many([_event_key(event_id) for event_id in ids])
+        if first_read and not found:
+            # The log expired, or is empty.
+            self.last_id = seq
+            return []
+        records = {}
+        for value in found.values():
+            record = json.loads(value)
+            records[record[0]] = record
+
+        events = []
+        now = time.time()
+        for event_id in ids:
+            record = records.get(event_id)
+            if record is None:
+                if not self.gave_up(event_id, records, now):
+                    break
+                self.last_id = event_id
+                continue
+            self.last_id = event_id
+            event_id, event, data, event_key = record[:4]
+            events.append((event, data, event_id, event_key))
+            if not first_read and len(record) > 4:
+                metrics.observe('minecloud_sse_event_delay_seconds',
+                                max(now - record[4], 0))
+        return events
+
+    def gave_up(self, event_id, records, now):
+        """
+        Whether to skip missing event `event_id`, given the `records` of
+        the events found with it, rather than wait for it.
+
+        """
+        if self.gap is None or self.gap[0] != event_id:
+            self.gap = (event_id, now)
+        sent_after = [record[4] for other_id, record in records.items()
+                      if other_id > event_id and len(record) > 4]
+        waited = max([now - self.gap[1]] +
+                     [now - sent for sent in sent_after])
+        if waited <= EVENT_GAP_GRACE:
+            return False
+        logger.warning("SSE event %s was never stored; skipping it.",
+                       event_id)
+        return True
+
+    def read_events(self):
+        caught_up = False
+        while True:
+            events = self.read_new_events()
+            for event in events:
+                yield event
+            if not events or not caught_up:
+                caught_up = True
+                yield None
+            time.sleep(self.poll_interval)
+
+
+class PubSubReader(EventLogReader):
+    """
+    EventLogReader that waits for Redis Pub/Sub notifications.
+
+    Instead of polling the event log every few seconds, PubSubReader
+    reads it only when send_event() publishes a message on `channel`.
+
+    """
+    def __init__(self, redis_url, channel, *args, **kwargs):
+        self.redis_url = redis_url
+        self.channel = channel
+        self.pubsub = None
+        kwargs.setdefault('sleep_interval', None)
+        super(PubSubReader, self).__init__(*args, **kwargs)
+
+    def read_events(self):
+        import redis
+        conn = redis.StrictRedis.from_url(self.redis_url)
+        self.pubsub = conn.pubsub()
+        # Subscribe before reading the log, so no event can slip by
+        # between the two.
+        self.pubsub.subscribe(self.channel)
+        for event in self.read_new_events():
+            yield event
+        yield None
+        for message in self.pubsub.listen():
+            if message['type'] == 'message':
+                for event in self.read_new_events():
+                    yield event
+
+    def close(self):
+        if self.pubsub is not None:
+            self.pubsub.close()
+            self.pubsub = None
+
+
+class EventHub(object):
+    """
+    Per-process broadcaster that shares one upstream EventReader.
+
+    Without a hub, every open SSE connection reads its events from
+    upstream (memcache or Redis) on its own, so upstream load grows with
+    the number of browser tabs. An EventHub runs a single upstream reader
+    in a background thread (a greenlet, under the gevent worker) and
+    keeps the most recent events in a ring buffer, from which every
+    attached HubReader gets its events.
+
+    The upstream reader must yield (event, data, event_id, key) tuples,
+    or None when it has nothing new, which it must also yield once it has
+    read the event log's history. Until then, the hub isn't `loaded`.
+    The reader is created by calling `reader_factory`. If it fails or stops, a new one is created after
+    `retry_interval` seconds.
+
+    """
+    def __init__(self, reader_factory, history=EVENT_HISTORY_SIZE,
+                 retry_interval=5):
+        self.reader_factory = reader_factory
+        self.retry_interval = retry_interval
+        self.condition = threading.Condition()
+        self.events = collections.deque(maxlen=history)
+        self.loaded = False
+        self._stopping = False
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the upstream reader, unless it's already running."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='sse-event-hub')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop the upstream reader after its next read."""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+        if thread is not None:
+            thread.join(timeout)
+        self._stopping = False
+
+    def _run(self):
+        while not self._stopping:
+            reader = self.reader_factory()
+            try:
+                for item in reader:
+                    if self._stopping:
+                        break
+                    self.dispatch(item)
+            except Exception:
+                logger.exception("SSE hub upstream reader failed.")
+            finally:
+                reader.close()
+            if not self._stopping:
+                time.sleep(self.retry_interval)
+
+    @property
+    def last_id(self):
+        if self.events:
+            return self.events[-1][2]
+        return 0
+
+    def dispatch(self, item):
+        """Add a new event to the buffer and wake up attached readers."""
+        with self.condition:
+            if item is not None:
+                if item[2] <= self.last_id:
+                    # Ids restarted (e.g. memcache was flushed), so the
+                    # buffered history no longer matches.
+                    self.events.clear()
+                self.events.append(item)
+            elif self.loaded:
+                return
+            else:
+                self.loaded = True
+            self.condition.notify_all()
+
+    def snapshot(self, timeout=None):
+        """
+        Return the most recent buffered event for each key.
+
+        Returns a (last_id, events) tuple, with the events oldest first.
+        Waits up to `timeout` seconds for the upstream reader to load
+        the event log, if it hasn't yet.
+
+        """
+        self.start()
+        with self.condition:
+            if not self.loaded:
+                self.condition.wait(timeout)
+            latest = dict((item[3], item) for item in self.events)
+            events = sorted(latest.values(), key=lambda item: item[2])
+            return self.last_id, events
+
+    def events_since(self, last_id, timeout=None):
+        """
+        Return the buffered events with ids greater than `last_id`.
+
+        Waits up to `timeout` seconds for a new event if there isn't one
+        yet, or for the hub to load the event log, then returns an empty
+        list.
+
+        """
+        self.start()
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            # Until the hub has loaded the log, it may just not have
+            # reached the client's id yet.
+            while not self.loaded or self.last_id == last_id:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return []
+                self.condition.wait(remaining)
+            if self.last_id < last_id:
+                # The client is ahead of us, so ids were restarted.
+                return list(self.events)
+            return [item for item in self.events if item[2] > last_id]
+
+
+class HubReader(EventReader):
+    """
+    EventReader that gets its events from a shared EventHub.
+
+    A new client (`last_event_id` is None) first gets the latest event
+    for each key, i.e. the current state of everything. A client that
+    reconnects with the id of the last event it saw gets exactly the
+    events it missed instead. After that, HubReader only yields events
+    when new ones arrive, and yields None every `heartbeat_interval`
+    seconds while nothing happens.
+
+    If `channels` is given, only the events on those channels are
+    yielded (see subscribed()); the others are skipped as if they had
+    never been sent.
+
+    """
+    def __init__(self, hub, last_event_id=None, heartbeat_interval=15,
+                 channels=None, *args, **kwargs):
+        self.hub = hub
+        self.last_event_id = last_event_id
+        self.heartbeat_interval = heartbeat_interval
+        self.channels = channels
+        self.connected = False
+        kwargs.setdefault('sleep_interval', None)
+        super(HubReader, self).__init__(*args, **kwargs)
+
+    def read_events(self):
+        self.connected = True
+        metrics.incr('minecloud_sse_connections_total')
+        metrics.incr('minecloud_sse_connections')
+
+        last_id = self.last_event_id
+        if last_id is None:
+            last_id, snapshot = self.hub.snapshot(self.heartbeat_interval)
+            snapshot = [event for event in snapshot if self.subscribed(event)]
+            for event in snapshot:
+                yield event
+            if not snapshot:
+                yield None
+
+        quiet_since = time.time()
+        while True:
+            events = self.hub.events_since(last_id, self.heartbeat_interval)
+            if events:
+                last_id = events[-1][2]
+            subscribed = [event for event in events if self.subscribed(event)]
+            for event in subscribed:
+                yield event
+            if subscribed:
+                quiet_since = time.time()
+            elif (not events or
+                  time.time() - quiet_since >= self.heartbeat_interval):
+                # Nothing happened, or nothing this client wants.
+                quiet_since = time.time()
+                yield None
+
+    def subscribed(self, event):
+        """
+        Return whether `event` is on one of the client's channels.
+
+        A channel is either an event name (e.g. 'roster'), for that
+        event from every world, or the key the event is stored under
+        (e.g. 'roster:survival'), for a single world's.
+
+        """
+        if self.channels is None:
+            return True
+        return event[0] in self.channels or event[3] in self.channels
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            metrics.incr('minecloud_sse_connections', -1)
+
+
+def _hub_reader_factory():
+    redis_url = os.getenv('REDISTOGO_URL')
+    if redis_url:
+        return PubSubReader(redis_url, channel=SSE_CHANNEL, timeout=None)
+    return EventLogReader(timeout=None)
+
+hub = EventHub(_hub_reader_factory)
+
+
 class SelfUpdatingSse(Sse):
     """
     Iterable object to be passed to StreamingHttpResponse.
@@ -102,8 +476,15 @@ class SelfUpdatingSse(Sse):
         super(SelfUpdatingSse, self).__init__(*args, **kwargs)
 
     def __iter__(self):
-        for event, data in self.event_reader:
-            self.add_message(event, data)
+        for event in self.event_reader:
+            if event is None:
+                # SSE comment: keeps the connection alive, but isn't
+                # dispatched as an event by the browser.
+                self._buffer.append(": heartbeat\n\n")
+            else:
+                if len(event) > 2 and event[2] is not None:
+                    self._buffer.append("id: {0}\n".format(event[2]))
+                self.add_message(event[0], event[1])
             for item in self._buffer:
                 yield item
             self.flush()
@@ -121,6 +502,10 @@ class SelfUpdatingSse(Sse):
 
 class SseView(BaseSseView):
 
+    def get_last_id(self):
+        """Return the Last-Event-ID sent by a reconnecting client."""
+        return parse_last_event_id(super(SseView, self).get_last_id())
+
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
         # Close Django DB connection that handled auth query,
@@ -128,22 +513,102 @@ class SseView(BaseSseView):
         # while SSEs are sent.
         db.close_connection()
 
-        reader=CacheReader(timeout=45, key='instance_state',
-                           default_value='terminated')
-        self.sse = SelfUpdatingSse(event_reader=reader)
         self.request = request
         self.args = args
         self.kwargs = kwargs
 
+        self.sse = instance_state_stream(
+            self.get_last_id(),
+            channels=parse_channels(request.GET.get('channels')))
+
         response = HttpResponse(self.sse, content_type="text/event-stream")
         response['Cache-Control'] = 'no-cache'
         response['Software'] = 'django-sse'
         return response
 
 
-def send_event(event_name, data, key='instance_state'):
-    value = json.dumps([event_name, data])
+def instance_state_stream(last_event_id=None, channels=None):
+    """
+    Return a SelfUpdatingSse that streams instance state events, and
+    the other events sent with send_event(), on the given channels (all
+    of them if `channels` is None).
+
+    """
+    reader = HubReader(hub, last_event_id=last_event_id,
+                       heartbeat_interval=settings.SSE_HEARTBEAT_INTERVAL,
+                       channels=channels, timeout=settings.SSE_TIMEOUT)
+    return SelfUpdatingSse(event_reader=reader)
+
+
+def parse_channels(value):
+    """
+    Convert the comma-separated ?channels= of an SSE request to a set of
+    channel names, or None (all channels) if it's missing or empty.
+
+    """
+    channels = frozenset(channel.strip()
+                         for channel in (value or '').split(',')
+                         if channel.strip())
+    return channels or None
+
+
+def parse_last_event_id(value):
+    """Convert a Last-Event-ID header value to an int, or None."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _event_key(event_id):
+    return 'sse_event:%d' % event_id
+
+
+def send_event(event_name, data, key='instance_state', changes_page=True):
+    """
+    Send an event to all SSE clients.
+
+    The event is numbered and added to the event log, from which the
+    EventHub of each web process reads it. The latest value is also
+    stored under `key`. Unless `changes_page` is False (e.g. for progress
+    updates), the event also invalidates the cached index page.
+
+    """
     cache_timeout = 60*60*24*365    # One year
-    cache.set(key, value, cache_timeout)
+    cache.add(EVENT_SEQUENCE_KEY, 0, cache_timeout)
+    event_id = cache.incr(EVENT_SEQUENCE_KEY)
+    cache.set(_event_key(event_id),
+              json.dumps([event_id, event_name, data, key, time.time()]),
+              EVENT_TIMEOUT)
+    metrics.incr('minecloud_events_sent_total')
 
-__all__ = ['send_event', 'SseView']
+    value = json.dumps([event_name, data])
+    cache.set(key, value, cache_timeout)
+    if changes_page:
+        cache.set(PAGE_VERSION_KEY, event_id, cache_timeout)
+
+    # Wake up the EventHubs of the web processes right away, rather
+    # than on their next cache poll.
+    redis_url = os.getenv('REDISTOGO_URL')
+    if redis_url:
+        import redis
+        try:
+            conn = redis.StrictRedis.from_url(redis_url)
+            conn.publish(SSE_CHANNEL, event_id)
+        except redis.RedisError:
+            logger.exception("Could not publish SSE event to Redis.")
+    return event_id
+
+
+def page_version():
+    """Return a value that changes whenever the index page changes."""
+    return cache.get(PAGE_VERSION_KEY, 0)
+
+
+def send_instance_state(world, state):
+    """Send the state of the server of `world` to all SSE clients."""
+    data = json.dumps({'world': world, 'state': state})
+    return send_event('instance_state', data,
+                      key='instance_state:%s' % world)
+
+__all__ = ['page_version', 'send_event', 'send_instance_state', 'SseView']
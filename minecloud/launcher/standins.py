@@ -0,0 +1,797 @@
+"""
+Local stand-ins for the services Minecloud talks to, for tests and
+benchmarks.
+
+FakeEC2Connection and FakeRedis stand in for boto's EC2 connection and
+the Redis client in the tasks. TaskSimulation runs the tasks on top of
+them, with a simulated clock and worker pool (see manage.py benchtasks).
+
+RedisStandIn is a small Redis server (just the commands Minecloud uses,
+including Pub/Sub) that runs in a gevent event loop and counts every
+command it serves. RedisCache is a Django cache backend on top of Redis,
+so separate processes (gunicorn workers, the SSE server, Celery) can
+share the cache through the stand-in, the way they share memcache in
+production:
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'minecloud.launcher.standins.RedisCache',
+            'LOCATION': 'redis://localhost:6390/0',
+        }
+    }
+
+"""
+import collections
+import cPickle as pickle
+import heapq
+import logging
+import time
+import uuid
+
+from boto.exception import EC2ResponseError
+from celery.exceptions import RetryTaskError
+import gevent
+from gevent.queue import Queue
+from gevent.server import StreamServer
+from greenlet import getcurrent, greenlet
+import redis
+
+from django.core.cache.backends.base import BaseCache
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class RedisCache(BaseCache):
+    """
+    Django cache backend that keeps its values in Redis.
+
+    Integers are stored as they are, so incr() can use INCRBY; anything
+    else is pickled.
+
+    """
+    def __init__(self, location, params):
+        super(RedisCache, self).__init__(params)
+        self.location = location
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = redis.StrictRedis.from_url(self.location)
+        return self._client
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _timeout(self, timeout):
+        # 0 means forever, as with memcached.
+        return int(timeout if timeout is not None else self.default_timeout)
+
+    def _dumps(self, value):
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            return str(value)
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, value):
+        if value.startswith('\x80'):
+            return pickle.loads(value)
+        return int(value)
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self._key(key, version)
+        if not self.client.setnx(key, self._dumps(value)):
+            return False
+        if self._timeout(timeout):
+            self.client.expire(key, self._timeout(timeout))
+        return True
+
+    def get(self, key, default=None, version=None):
+        value = self.client.get(self._key(key, version))
+        if value is None:
+            return default
+        return self._loads(value)
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self._key(key, version)
+        if self._timeout(timeout):
+            self.client.setex(key, self._timeout(timeout), self._dumps(value))
+        else:
+            self.client.set(key, self._dumps(value))
+
+    def delete(self, key, version=None):
+        self.client.delete(self._key(key, version))
+
+    def get_many(self, keys, version=None):
+        if not keys:
+            return {}
+        values = self.client.mget([self._key(key, version) for key in keys])
+        return dict((key, self._loads(value))
+                    for key, value in zip(keys, values) if value is not None)
+
+    def has_key(self, key, version=None):
+        return bool(self.client.exists(self._key(key, version)))
+
+    def incr(self, key, delta=1, version=None):
+        # Django raises ValueError for missing keys, where Redis would
+        # start from 0.
+        key = self._key(key, version)
+        if not self.client.exists(key):
+            raise ValueError("Key '%s' not found" % key)
+        return self.client.incr(key, delta)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+class RedisStandIn(object):
+    """
+    In-process Redis server, for benchmarks.
+
+    Speaks enough of the Redis protocol for redis-py, the RedisCache
+    backend and Minecloud's own use of Redis. `ops` counts the commands
+    served, per command name.
+
+    """
+    def __init__(self, address=('127.0.0.1', 6390)):
+        self.address = address
+        self.data = {}
+        self.expires = {}
+        self.subscribers = {}
+        self.ops = {}
+        self.server = StreamServer(address, self.handle)
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def total_ops(self):
+        return sum(self.ops.values())
+
+    def handle(self, sock, address):
+        reader = sock.makefile('rb')
+        outbox = Queue()
+        writer = gevent.spawn(self._write, sock, outbox)
+        try:
+            while True:
+                command = self._read_command(reader)
+                if command is None:
+                    break
+                name = command[0].upper()
+                self.ops[name] = self.ops.get(name, 0) + 1
+                method = getattr(self, 'do_' + name.lower(), None)
+                if method is None:
+                    outbox.put('-ERR unknown command %s\r\n' % name)
+                else:
+                    outbox.put(method(outbox, *command[1:]))
+        finally:
+            for queues in self.subscribers.values():
+                queues.discard(outbox)
+            outbox.put(None)
+            writer.join()
+            sock.close()
+
+    def _write(self, sock, outbox):
+        for reply in outbox:
+            if reply is None:
+                break
+            if reply:
+                sock.sendall(reply)
+
+    def _read_command(self, reader):
+        line = reader.readline()
+        if not line:
+            return None
+        if not line.startswith('*'):
+            # Inline command, e.g. from telnet.
+            return line.split()
+        args = []
+        for i in range(int(line[1:])):
+            length = int(reader.readline()[1:])
+            args.append(reader.read(length + 2)[:-2])
+        return args
+
+    # Replies
+
+    def _bulk(self, value):
+        if value is None:
+            return '$-1\r\n'
+        return '$%d\r\n%s\r\n' % (len(value), value)
+
+    def _multi(self, values):
+        return '*%d\r\n%s' % (len(values), ''.join(
+            ':%d\r\n' % value if isinstance(value, (int, long))
+            else self._bulk(value) for value in values))
+
+    def _get(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            del self.data[key]
+            del self.expires[key]
+        return self.data.get(key)
+
+    # Commands
+
+    def do_ping(self, outbox):
+        return '+PONG\r\n'
+
+    def do_select(self, outbox, db):
+        return '+OK\r\n'
+
+    def do_flushdb(self, outbox):
+        self.data.clear()
+        self.expires.clear()
+        return '+OK\r\n'
+
+    def do_get(self, outbox, key):
+        return self._bulk(self._get(key))
+
+    def do_mget(self, outbox, *keys):
+        return self._multi([self._get(key) for key in keys])
+
+    def do_set(self, outbox, key, value):
+        self.data[key] = value
+        self.expires.pop(key, None)
+        return '+OK\r\n'
+
+    def do_setex(self, outbox, key, seconds, value):
+        self.data[key] = value
+        self.expires[key] = time.time() + int(seconds)
+        return '+OK\r\n'
+
+    def do_setnx(self, outbox, key, value):
+        if self._get(key) is not None:
+            return ':0\r\n'
+        self.data[key] = value
+        return ':1\r\n'
+
+    def do_expire(self, outbox, key, seconds):
+        if self._get(key) is None:
+            return ':0\r\n'
+        self.expires[key] = time.time() + int(seconds)
+        return ':1\r\n'
+
+    def do_exists(self, outbox, key):
+        return ':%d\r\n' % (self._get(key) is not None)
+
+    def do_del(self, outbox, *keys):
+        deleted = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self.data[key]
+                self.expires.pop(key, None)
+                deleted += 1
+        return ':%d\r\n' % deleted
+
+    def do_incrby(self, outbox, key, delta):
+        value = int(self._get(key) or 0) + int(delta)
+        self.data[key] = str(value)
+        return ':%d\r\n' % value
+
+    def do_incr(self, outbox, key):
+        return self.do_incrby(outbox, key, 1)
+
+    def do_publish(self, outbox, channel, message):
+        queues = self.subscribers.get(channel, ())
+        for queue in queues:
+            queue.put(self._multi(['message', channel, message]))
+        return ':%d\r\n' % len(queues)
+
+    def do_subscribe(self, outbox, *channels):
+        replies = []
+        for channel in channels:
+            self.subscribers.setdefault(channel, set()).add(outbox)
+            count = sum(1 for queues in self.subscribers.values()
+                        if outbox in queues)
+            replies.append(self._multi(['subscribe', channel, count]))
+        return ''.join(replies)
+
+    def do_unsubscribe(self, outbox, *channels):
+        replies = []
+        for channel in channels or list(self.subscribers):
+            self.subscribers.get(channel, set()).discard(outbox)
+            count = sum(1 for queues in self.subscribers.values()
+                        if outbox in queues)
+            replies.append(self._multi(['unsubscribe', channel, count]))
+        return ''.join(replies)
+
+
+class FakeServer(object):
+    def __init__(self, id, image_id, halts_after_boot=False,
+                 placement='us-west-2a', user_data=''):
+        self.id = id
+        self.image_id = image_id
+        self.halts_after_boot = halts_after_boot
+        self.placement = placement
+        self.user_data = user_data or ''
+        self.state = u'pending'
+        self.ip_address = None
+        self.changed = None
+
+    def env(self, name):
+        """The value of env variable `name` in the server's user data."""
+        prefix = 'echo %s=' % name
+        for line in self.user_data.splitlines():
+            line = line.strip(' -')
+            if line.startswith(prefix):
+                return line[len(prefix):].split(' >>')[0].strip()
+        return ''
+
+
+class FakeAttachment(object):
+    def __init__(self, instance_id=None):
+        self.instance_id = instance_id
+
+
+class FakeVolume(object):
+    def __init__(self, id, size, zone, snapshot_id):
+        self.id = id
+        self.size = size
+        self.zone = zone
+        self.snapshot_id = snapshot_id
+        self.status = u'creating'
+        self.attach_data = FakeAttachment()
+
+
+class FakeSnapshot(object):
+    def __init__(self, id, volume_id, description, start_time):
+        self.id = id
+        self.volume_id = volume_id
+        self.description = description
+        self.start_time = start_time
+        self.status = u'pending'
+
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeEC2Connection(object):
+    """
+    Stand-in for a boto EC2 connection.
+
+    Servers stay 'pending' for `pending_polls` describe calls, and at
+    least `pending_delay` seconds, before they are 'running'. Once
+    running, they have no IP address for another `missing_ip_delay`
+    seconds. They take `stopping_polls` calls and `stopping_delay`
+    seconds to stop. Servers that stop on shutdown (warm pool servers)
+    halt after their first boot. Volumes are available, and snapshots
+    completed, after one describe call.
+
+    run_instances fails with InsufficientInstanceCapacity in the
+    `unavailable_zones`.
+
+    Every `throttle_every`th API call fails with RequestLimitExceeded,
+    and every call takes `latency` seconds. Seconds are counted on
+    `clock` (anything with time() and sleep(), e.g. a TaskSimulation),
+    which defaults to the real time. `on_change`, if given, is called
+    with each server that changes state, or gets its IP address.
+
+    """
+    def __init__(self, pending_polls=2, stopping_polls=2, pending_delay=0,
+                 stopping_delay=0, missing_ip_delay=0, throttle_every=0,
+                 latency=0, clock=time, on_change=None,
+                 unavailable_zones=()):
+        self.pending_polls = pending_polls
+        self.stopping_polls = stopping_polls
+        self.pending_delay = pending_delay
+        self.stopping_delay = stopping_delay
+        self.missing_ip_delay = missing_ip_delay
+        self.throttle_every = throttle_every
+        self.latency = latency
+        self.clock = clock
+        self.on_change = on_change
+        self.unavailable_zones = unavailable_zones
+        self.servers = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.client_tokens = {}
+        self.polls = {}
+        self.calls = []
+        self.throttled = 0
+        self.next_id = 0
+
+    def _call(self, name):
+        """Record an API call, and fail it if it's throttled."""
+        self.calls.append(name)
+        if self.latency:
+            self.clock.sleep(self.latency)
+        if self.throttle_every and len(self.calls) % self.throttle_every == 0:
+            self.throttled += 1
+            raise EC2ResponseError(
+                503, 'Service Unavailable',
+                '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                '<Message>Request limit exceeded.</Message></Error></Errors>'
+                '</Response>')
+
+    def _new_id(self, prefix):
+        self.next_id += 1
+        return '%s-%05d' % (prefix, self.next_id)
+
+    def _set_state(self, server, state):
+        server.state = state
+        server.changed = self.clock.time()
+        self.polls[server.id] = 0
+        if self.on_change is not None:
+            self.on_change(server)
+
+    def _elapsed(self, server):
+        return self.clock.time() - server.changed
+
+    def run_instances(self, image_id, client_token=None,
+                      instance_initiated_shutdown_behavior=None,
+                      placement=None, user_data=None, **kwargs):
+        self._call('run_instances')
+        if (placement or 'us-west-2a') in self.unavailable_zones:
+            raise EC2ResponseError(
+                500, 'Server Error',
+                '<Response><Errors><Error>'
+                '<Code>InsufficientInstanceCapacity</Code>'
+                '<Message>Insufficient capacity.</Message></Error></Errors>'
+                '</Response>')
+        if client_token in self.client_tokens:
+            server = self.client_tokens[client_token]
+        else:
+            server = FakeServer(self._new_id('i'),
+                                image_id or 'ami-00000000',
+                                instance_initiated_shutdown_behavior == 'stop',
+                                placement or 'us-west-2a', user_data)
+            self._set_state(server, u'pending')
+            self.servers[server.id] = server
+            self.client_tokens[client_token] = server
+        return FakeReservation([server])
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        self._call('get_all_instances')
+        if filters:
+            instance_ids = filters['instance-id']
+        servers = [self.servers[server_id] for server_id in instance_ids
+                   if server_id in self.servers]
+        for server in servers:
+            self.polls[server.id] = self.polls.get(server.id, 0) + 1
+            if (server.state == u'running' and server.halts_after_boot):
+                server.halts_after_boot = False
+                self._set_state(server, u'stopped')
+                server.ip_address = None
+            elif (server.state == u'pending' and
+                    self.polls[server.id] > self.pending_polls and
+                    self._elapsed(server) >= self.pending_delay):
+                self._set_state(server, u'running')
+            elif (server.state == u'stopping' and
+                    self.polls[server.id] > self.stopping_polls and
+                    self._elapsed(server) >= self.stopping_delay):
+                self._set_state(server, u'stopped')
+
+            if (server.state == u'running' and not server.ip_address and
+                    self._elapsed(server) >= self.missing_ip_delay):
+                server.ip_address = '10.0.%d.%d' % divmod(
+                    len(self.servers), 256)
+                if self.on_change is not None:
+                    self.on_change(server)
+        return [FakeReservation(servers)]
+
+    def stop_instances(self, instance_ids):
+        self._call('stop_instances')
+        for server_id in instance_ids:
+            self._set_state(self.servers[server_id], u'stopping')
+
+    def start_instances(self, instance_ids):
+        self._call('start_instances')
+        for server_id in instance_ids:
+            self._set_state(self.servers[server_id], u'pending')
+
+    def terminate_instances(self, instance_ids):
+        self._call('terminate_instances')
+        for server_id in instance_ids:
+            self._set_state(self.servers[server_id], u'terminated')
+            self.servers[server_id].ip_address = None
+        for volume in self.volumes.values():
+            if volume.attach_data.instance_id in instance_ids:
+                volume.status = u'available'
+                volume.attach_data = FakeAttachment()
+
+    def create_volume(self, size, zone, snapshot=None):
+        self._call('create_volume')
+        volume = FakeVolume(self._new_id('vol'), size, zone, snapshot)
+        self.volumes[volume.id] = volume
+        return volume
+
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        self._call('get_all_volumes')
+        volumes = [self.volumes[volume_id] for volume_id
+                   in filters['volume-id'] if volume_id in self.volumes]
+        for volume in volumes:
+            if volume.status == u'creating':
+                volume.status = u'available'
+        return volumes
+
+    def attach_volume(self, volume_id, instance_id, device):
+        self._call('attach_volume')
+        volume = self.volumes[volume_id]
+        volume.status = u'in-use'
+        volume.attach_data = FakeAttachment(instance_id)
+
+    def delete_volume(self, volume_id):
+        self._call('delete_volume')
+        del self.volumes[volume_id]
+
+    def create_snapshot(self, volume_id, description=None):
+        self._call('create_snapshot')
+        snapshot = FakeSnapshot(self._new_id('snap'), volume_id,
+                                description, self.next_id)
+        self.snapshots[snapshot.id] = snapshot
+        return snapshot
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None,
+                          filters=None):
+        self._call('get_all_snapshots')
+        snapshots = self.snapshots.values()
+        if 'snapshot-id' in filters:
+            snapshots = [s for s in snapshots if s.id in filters['snapshot-id']]
+        if 'description' in filters:
+            snapshots = [s for s in snapshots
+                         if s.description == filters['description']]
+        for snapshot in snapshots:
+            snapshot.status = u'completed'
+        return snapshots
+
+    def delete_snapshot(self, snapshot_id):
+        self._call('delete_snapshot')
+        del self.snapshots[snapshot_id]
+
+
+class FakeRedis(object):
+    """
+    Stand-in for the few Redis commands the tasks use.
+
+    blpop() returns right away, unless a `clock` that can block (a
+    TaskSimulation) is given. Functions subscribed to a channel with
+    subscribe() are called with each message published on it.
+
+    """
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.published = []
+        self.lists = {}
+        self.subscribers = {}
+        self.waiters = {}
+
+    def subscribe(self, channel, func):
+        self.subscribers.setdefault(channel, []).append(func)
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        for func in self.subscribers.get(channel, []):
+            func(message)
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+        for waiter in self.waiters.pop(key, []):
+            self.clock.notify(waiter)
+
+    def blpop(self, keys, timeout=0):
+        deadline = self.clock.time() + timeout if self.clock else None
+        while True:
+            for key in keys:
+                if self.lists.get(key):
+                    return key, self.lists[key].pop(0)
+            if self.clock is None or (timeout and
+                                      self.clock.time() >= deadline):
+                return None
+            waiter = self.clock.waiter(deadline if timeout else None)
+            for key in keys:
+                self.waiters.setdefault(key, []).append(waiter)
+            self.clock.block(waiter)
+            for key in keys:
+                if waiter in self.waiters.get(key, []):
+                    self.waiters[key].remove(waiter)
+
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:(end + 1) or None]
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists.get(key, [])[start:]
+
+    def expire(self, key, seconds):
+        pass
+
+    def delete(self, key):
+        self.lists.pop(key, None)
+
+
+class Waiter(object):
+    """A greenlet blocked on a TaskSimulation's clock."""
+
+    def __init__(self, glet):
+        self.glet = glet
+        self.done = False
+
+
+class TaskSimulation(object):
+    """
+    Runs Celery tasks on a simulated clock, with `concurrency` workers.
+
+    Stands in for the broker, the worker pool and celerybeat. Messages
+    sent with apply_async() (and so delay() and retry()) are queued
+    until their countdown has passed on the simulated clock, then run in
+    the order they became due, as soon as a worker is free. Tasks, and
+    the stand-ins, wait on the simulated clock (sleep(), or
+    FakeRedis.blpop()), each in its own greenlet, so hours of lifecycles
+    run in seconds, and a task blocked in a wait holds its worker, as it
+    would in a real worker.
+
+    Keeps, per task name: runs, retries, failures, worker seconds and DB
+    queries (see `stats`), and how long due tasks waited for a worker.
+
+    """
+    def __init__(self, tasks, concurrency=4, beat_schedule=None,
+                 start=None):
+        self.tasks = dict((task.name, task) for task in tasks)
+        self.concurrency = concurrency
+        self.beat_schedule = beat_schedule or {}
+        self.started = self.now = start if start is not None else time.time()
+        self.main = None
+        self.timers = []
+        self.due = collections.deque()
+        self.busy = 0
+        self.busy_seconds = 0
+        self.queue_waits = []
+        self.stats = {}
+        self._seq = 0
+        self._saved = []
+
+    # Clock
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.block(self.waiter(self.now + seconds))
+
+    def waiter(self, deadline=None):
+        """A Waiter for the current greenlet, woken at `deadline`, if any."""
+        waiter = Waiter(getcurrent())
+        if deadline is not None:
+            self._push(deadline, waiter)
+        return waiter
+
+    def block(self, waiter):
+        """Switch away from the current greenlet until `waiter` is woken."""
+        self.main.switch()
+
+    def notify(self, waiter):
+        """Wake `waiter` now (or once the current greenlet blocks)."""
+        self._push(self.now, waiter)
+
+    def spawn(self, func, *args, **kwargs):
+        """Run `func` in a new greenlet, starting now."""
+        waiter = Waiter(greenlet(lambda: func(*args, **kwargs),
+                                 parent=self.main))
+        self._push(self.now, waiter)
+        return waiter.glet
+
+    def _push(self, when, item):
+        self._seq += 1
+        heapq.heappush(self.timers, (when, self._seq, item))
+
+    # Broker
+
+    def install(self):
+        """Send the tasks' messages to the simulation, until uninstall()."""
+        # Task classes (not instances) are patched, because delay() and
+        # apply_async() are classmethods of @task's v2 compatible tasks.
+        for task in self.tasks.values():
+            cls = type(task)
+            self._saved.append((cls, cls.__dict__.get('apply_async')))
+            cls.apply_async = staticmethod(self._sender(task))
+
+    def uninstall(self):
+        for cls, apply_async in self._saved:
+            if apply_async is None:
+                del cls.apply_async
+            else:
+                cls.apply_async = apply_async
+        self._saved = []
+
+    def _sender(self, task):
+        def apply_async(args=None, kwargs=None, countdown=None, eta=None,
+                        task_id=None, retries=0, **options):
+            task_id = task_id or str(uuid.uuid4())
+            when = self.now + (countdown or 0)
+            if eta is not None:
+                when = time.mktime(eta.timetuple())
+            message = (task, task_id, tuple(args or ()), dict(kwargs or {}),
+                       retries)
+            self._push(when, ('message', message))
+            return task.AsyncResult(task_id)
+        return apply_async
+
+    # Worker
+
+    def _execute(self, message, due):
+        task, task_id, args, kwargs, retries = message
+        stats = self.stats.setdefault(task.name, collections.Counter())
+        started = self.now
+        self.queue_waits.append(started - due)
+        queries = len(connection.queries)
+        task.push_request(id=task_id, args=args, kwargs=kwargs,
+                          retries=retries, is_eager=False,
+                          called_directly=False, delivery_info={})
+        try:
+            task.run(*args, **kwargs)
+        except RetryTaskError:
+            stats['retries'] += 1
+        except Exception, exc:
+            logger.error("Task %s%r failed: %r", task.name, args, exc)
+            stats['failures'] += 1
+        finally:
+            task.pop_request()
+            stats['runs'] += 1
+            stats['seconds'] += self.now - started
+            stats['queries'] += len(connection.queries) - queries
+            self.busy_seconds += self.now - started
+            self.busy -= 1
+
+    def _start_due_tasks(self):
+        while self.due and self.busy < self.concurrency:
+            message, due = self.due.popleft()
+            self.busy += 1
+            glet = greenlet(lambda: self._execute(message, due),
+                            parent=self.main)
+            glet.switch()
+
+    # Beat
+
+    def _beat(self, name, entry):
+        task = self.tasks.get(entry['task'])
+        if task is None:
+            return
+        interval = entry['schedule'].total_seconds()
+        while True:
+            self.sleep(interval)
+            task.apply_async()
+
+    def run(self, func, timeout=None):
+        """
+        Run `func` in a greenlet, and the tasks it sends, until it returns.
+
+        Stops early after `timeout` simulated seconds. Returns True if
+        `func` finished.
+
+        """
+        self.main = getcurrent()
+        connection.use_debug_cursor = True
+        driver = self.spawn(func)
+        for name, entry in sorted(self.beat_schedule.items()):
+            self.spawn(self._beat, name, entry)
+        deadline = self.now + timeout if timeout is not None else None
+        try:
+            while not driver.dead:
+                self._start_due_tasks()
+                if not self.timers:
+                    break
+                when, seq, item = heapq.heappop(self.timers)
+                if deadline is not None and when > deadline:
+                    self.now = deadline
+                    break
+                self.now = max(self.now, when)
+                if isinstance(item, tuple):
+                    self.due.append((item[1], self.now))
+                elif not item.done and not item.glet.dead:
+                    item.done = True
+                    item.glet.switch()
+        finally:
+            connection.use_debug_cursor = None
+        return driver.dead
+
+    def occupancy(self):
+        """Fraction of the workers' time spent running tasks."""
+        elapsed = self.now - self.started
+        if not elapsed:
+            return 0.0
+        return self.busy_seconds / (elapsed * self.concurrency)
@@ -0,0 +1,190 @@
+"""
+Measures how long a web or worker process takes to start.
+
+Run in a fresh interpreter (the profilestartup command does this), so
+nothing is imported yet:
+
+    python -m minecloud.launcher.startup web /accounts/login/
+
+It times every module import, then the phases of a cold start, and
+prints the results as JSON:
+
+  web:    settings, importing minecloud.wsgi, and the first request,
+          sent straight to the WSGI application (which is when Django
+          loads the URLconf, views and models).
+  worker: settings, and importing the Celery app and the tasks module,
+          as `manage.py celeryd` does.
+
+Each module's "self" time excludes the modules it imported in turn;
+"total" includes them.
+
+"""
+import __builtin__
+import json
+import os
+import subprocess
+import sys
+import time
+
+PROCESSES = ('web', 'worker')
+
+DEFAULT_PATH = '/accounts/login/'
+
+# The directory minecloud is imported from.
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+class ImportTimer(object):
+    """Times the imports made while installed as __import__."""
+
+    def __init__(self):
+        self.modules = {}   # Name -> [total seconds, self seconds]
+        self._stack = []    # Seconds spent in nested imports, per level.
+        self._import = None
+
+    def install(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._import
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        loaded = len(sys.modules)
+        before = set(sys.modules)
+        self._stack.append(0.0)
+        start = time.time()
+        module = None
+        try:
+            module = self._import(name, globals, locals, fromlist, level)
+            return module
+        finally:
+            elapsed = time.time() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if len(sys.modules) > loaded:
+                label = self.label(name, fromlist, module,
+                                   set(sys.modules) - before)
+                times = self.modules.setdefault(label, [0.0, 0.0])
+                times[0] += elapsed
+                times[1] += elapsed - nested
+
+    def label(self, name, fromlist, module, new):
+        """Return the full name of the module an import statement loaded."""
+        if fromlist and module is not None:
+            # "from a import b" returns a, and may load a.b.
+            targets = ['%s.%s' % (module.__name__, item) for item in fromlist]
+            targets.append(module.__name__)
+        else:
+            # "import a.b" returns a; implicit relative imports resolve to
+            # "package.a.b".
+            targets = [target for target in new
+                       if target == name or target.endswith('.' + name)]
+        candidates = [target for target in targets if target in new]
+        return min(candidates or new, key=len)
+
+
+def phase(phases, name, function, *args):
+    start = time.time()
+    result = function(*args)
+    phases.append((name, time.time() - start))
+    return result
+
+
+def first_request(application, path):
+    """Send a GET for `path` to `application`; return the status."""
+    from django.conf import settings
+    if not settings.ALLOWED_HOSTS:
+        # So the request gets past the host check, as on a real server.
+        settings.ALLOWED_HOSTS = ['localhost']
+    host = settings.ALLOWED_HOSTS[0].lstrip('.').replace('*', 'localhost')
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+               'QUERY_STRING': '', 'SERVER_NAME': host, 'SERVER_PORT': '80',
+               'HTTP_HOST': host, 'SERVER_PROTOCOL': 'HTTP/1.1',
+               'wsgi.url_scheme': 'http', 'wsgi.input': sys.stdin,
+               'wsgi.errors': sys.stderr, 'wsgi.version': (1, 0),
+               'wsgi.multithread': False, 'wsgi.multiprocess': True,
+               'wsgi.run_once': False}
+    status = []
+    body = application(environ, lambda s, headers: status.append(s))
+    try:
+        for chunk in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return status[0]
+
+
+def import_module(name):
+    __import__(name)
+    return sys.modules[name]
+
+
+def profile_startup(process, path=DEFAULT_PATH):
+    """Start a `process` ('web' or 'worker'), and return its timings."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'minecloud.settings.dev')
+    timer = ImportTimer()
+    phases = []
+    start = time.time()
+    timer.install()
+    try:
+        from django.conf import settings
+        phase(phases, 'settings', getattr, settings, 'INSTALLED_APPS')
+        status = None
+        if process == 'web':
+            wsgi = phase(phases, 'import minecloud.wsgi',
+                         import_module, 'minecloud.wsgi')
+            status = phase(phases, 'first request',
+                           first_request, wsgi.application, path)
+        else:
+            phase(phases, 'import celery app',
+                  import_module, 'celery.app')
+            phase(phases, 'import tasks',
+                  import_module, 'minecloud.launcher.tasks')
+    finally:
+        timer.uninstall()
+    return {
+        'process': process,
+        'total': time.time() - start,
+        'phases': phases,
+        'status': status,
+        'modules': sorted(([name] + times
+                           for name, times in timer.modules.items()),
+                          key=lambda module: -module[2]),
+    }
+
+
+def run(process, path=DEFAULT_PATH):
+    """
+    Start `process` in a fresh interpreter, and return its timings, with
+    the interpreter's own startup included in 'wall'.
+
+    """
+    start = time.time()
+    child = subprocess.Popen(
+        [sys.executable, '-m', 'minecloud.launcher.startup', process, path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=PROJECT_DIR)
+    out, err = child.communicate()
+    wall = time.time() - start
+    if child.returncode:
+        raise RuntimeError('Starting %s failed:\n%s' % (process, err))
+    result = json.loads(out.strip().splitlines()[-1])
+    result['wall'] = wall
+    return result
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in PROCESSES:
+        sys.exit('Usage: %s web|worker [path]' % argv[0])
+    result = profile_startup(*argv[1:3])
+    # Whatever the request or the tasks wrote to stdout was the request's;
+    # the results are the last line.
+    sys.stdout.write('\n' + json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
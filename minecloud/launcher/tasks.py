@@ -1,123 +1,1219 @@
-import boto
-import boto.ec2
 import datetime
+import itertools
+import json
+import logging
 import os
-import redis
+import pipes
 import time
+import uuid
 
 from celery import task
+from celery.signals import worker_ready
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Max
 from django.template.loader import render_to_string
 from django.utils.timezone import utc
 
-from .models import Instance
-from .sseview import send_event
+from minecloud.backup import S3Store
+
+from .ec2 import (api_error, connect_ec2, default_region, describe_servers,
+                  describe_snapshot, describe_volume)
+from .hedging import hedging_enabled, pick_winner, placements
+from .metrics import incr, record_state
+from .models import (Instance, LaunchAttempt, PoolServer, Session,
+                     WorldVolume, command_channel)
+from .players import PLAYER_EVENTS_KEY, record_player_events, send_rosters
+from .prewarm import demand_patterns, worlds_to_prewarm
+from .rollups import record_uptime
+from .telemetry import (TELEMETRY_KEY, downsample, record_telemetry,
+                        send_telemetry)
+from .sseview import send_event, send_instance_state
+
+logger = logging.getLogger(__name__)
+
+# Launching and terminating a server is a chain of short tasks, each of
+# which checks on one step and then either moves the Instance on to its
+# next state or retries itself with a backoff. No task sleeps while EC2
+# or the game server does its work, and since every step is keyed off the
+# state saved in the DB, an interrupted chain can be resumed from there.
+#
+#   initiating       -> launch, reconcile
+#   pending          -> check_state, follow_restore (until the server
+#                       reports 'running', or its restore is ready)
+#   shutting down    -> terminate, wait_for_backup
+#   backup started   -> wait_for_backup
+#   backup failed    -> (server keeps running, until shut down again)
+#   backup finished  -> stop
+#   stopping         -> reconcile, check_state
+#
+# While EC2 is starting or stopping servers, reconcile checks on all of
+# them with a single API call.
+#
+# When MINECLOUD_PERSISTENCE is 'ebs', reconcile also attaches the world's
+# volume before moving a launch on to 'pending', and stop snapshots the
+# volume and terminates the server right away, skipping 'stopped'.
+
+
+# Seconds a wait_for_backup task blocks waiting for replies, before it
+# hands the worker back and retries itself.
+BACKUP_REPLY_WAIT = 20
+
+# Same, for check_state following a new server's restore.
+RESTORE_REPLY_WAIT = 10
+
+# Don't pre-warm a world that was shut down less than this long ago.
+PREWARM_COOLDOWN = datetime.timedelta(hours=1)
+
+# Seconds a launch request holds its world's lease, at most (it's
+# released as soon as the Instance is created).
+LAUNCH_LEASE_TIMEOUT = 30
+
+# States players can shut a server down from (see world.html).
+TERMINABLE_STATES = ['running', 'backup failed']
+
+
+def backoff(retries, base=5, cap=30):
+    """Return seconds to wait before retry number `retries` + 1."""
+    return min(cap, base * 2 ** retries)
+
+
+def transition(instance, from_states, to_state, **fields):
+    """
+    Move instance to `to_state`, if it is still in one of `from_states`.
+
+    Returns True if the instance was updated. Since the check and the
+    update happen in a single UPDATE query, only one of several tasks
+    racing to make the same transition will succeed.
+
+    """
+    updated = (Instance.objects
+        .filter(pk=instance.id, state__in=from_states)
+        .update(state=to_state, **fields)
+    )
+    if updated:
+        record_state(instance.id, to_state)
+        send_instance_state(instance.world, to_state)
+    return bool(updated)
+
+
+def now():
+    return datetime.datetime.utcnow().replace(tzinfo=utc)
+
+
+def request_launch(world, user, **fields):
+    """
+    Start launching a server for `world`, on behalf of `user`.
+
+    Returns the new Instance, or None if the world already has one that
+    isn't terminated, or another request is creating one right now.
+    Concurrent requests for the same world are coalesced with a lease on
+    the world, so only one of them creates an Instance and queues a
+    launch; the others' pages get the state of that one, over SSE.
+
+    """
+    lease = 'launch_lease:%s' % world
+    if not cache.add(lease, True, LAUNCH_LEASE_TIMEOUT):
+        incr('minecloud_requests_coalesced_total')
+        return None
+    try:
+        if Instance.objects.filter(world__exact=world).exclude(
+                state__exact='terminated').exists():
+            incr('minecloud_requests_coalesced_total')
+            return None
+        instance = Instance.objects.create(launched_by=user, world=world,
+                                           start=now(), state='initiating',
+                                           **fields)
+        record_state(instance.id, instance.state)
+        send_instance_state(instance.world, instance.state)
+        launch.delay(instance.id)
+    finally:
+        cache.delete(lease)
+    return instance
 
-@task
-def launch(instance_id):
-    # Retrive instance obj from DB.
-    instance = Instance.objects.get(pk=instance_id)
 
+def request_terminate(instance):
+    """
+    Start shutting down `instance`'s server.
+
+    Returns True if this request did, or False if it isn't running, e.g.
+    because a concurrent request is shutting it down already.
+
+    """
+    if not transition(instance, TERMINABLE_STATES, 'shutting down'):
+        incr('minecloud_requests_coalesced_total')
+        return False
+    terminate.delay(instance.id)
+    return True
+
+
+def restore_reply_key(instance_id, attempt=0):
+    """
+    Redis list on which a new server reports its world restore. Each
+    server of a hedged launch (see hedging.py) reports on its own list,
+    numbered like its LaunchAttempt.
+
+    """
+    if attempt:
+        return 'restore:%s:%s' % (instance_id, attempt)
+    return 'restore:%s' % instance_id
+
+
+def ebs_persistence(instance):
+    """True if `instance` keeps its world on a WorldVolume."""
+    return (settings.MINECLOUD_PERSISTENCE == 'ebs' and
+            not instance.pool_server_id)
+
+
+def run_server(conn, world, client_token, warm_pool=False, reply_to='',
+               placement=None, image_id=None):
+    """
+    Boot a new EC2 server for `world`, and return it.
+
+    The server reports the progress of restoring its world on the
+    `reply_to` list, if given. `placement` is the availability zone to
+    boot it in, and `image_id` the AMI, if not MCL_EC2_AMI.
+
+    """
     # Set variables to launch EC2 instance
-    ec2_ami = os.getenv('MCL_EC2_AMI')
-    ec2_region = os.getenv('MCL_EC2_REGION', 'us-west-2')
+    ec2_ami = image_id or os.getenv('MCL_EC2_AMI')
     ec2_keypair = os.getenv('MCL_EC2_KEYPAIR','MinecraftEC2')
     ec2_instancetype = os.getenv('MCL_EC2_INSTANCE_TYPE', 'm1.small')
     ec2_secgroups = [os.getenv('MCL_EC2_SECURITY_GROUP', 'minecraft')]
 
+    # JSON strings are YAML strings, whatever they contain.
+    boot_command = restore_command(reply_to, warm_pool)
+    boot_command = json.dumps(boot_command) if boot_command else ''
+
     # ec2_env_vars populate the userdata.txt file. Cloud-init will append
     # them to /etc/environment on the launched EC2 instance during bootup.
     ec2_env_vars = {'AWS_ACCESS_KEY_ID': os.getenv('AWS_ACCESS_KEY_ID'),
                     'AWS_SECRET_ACCESS_KEY': os.getenv('AWS_SECRET_ACCESS_KEY'),
                     'MSM_S3_BUCKET': os.getenv('MSM_S3_BUCKET'),
+                    'MSM_S3_PREFIX': world,
+                    'MCL_WORLD': world,
+                    'MCL_COMMAND_CHANNEL': command_channel(world),
+                    'MCL_WARM_POOL': '1' if warm_pool else '',
+                    'MCL_RESTORE_REPLY_TO': reply_to,
+                    'MCL_PERSISTENCE': settings.MINECLOUD_PERSISTENCE,
+                    'MCL_EBS_DEVICE': settings.MINECLOUD_EBS_DEVICE,
                     'DATABASE_URL': os.getenv('DATABASE_URL'),
                     'MEMCACHIER_SERVERS': os.getenv('MEMCACHIER_SERVERS'),
                     'MEMCACHIER_USERNAME': os.getenv('MEMCACHIER_USERNAME'),
                     'MEMCACHIER_PASSWORD': os.getenv('MEMCACHIER_PASSWORD'),
                     'REDISTOGO_URL': os.getenv('REDISTOGO_URL'),
+                    'restore_command': boot_command,
                    }
     ec2_userdata = render_to_string('launcher/userdata.txt', ec2_env_vars)
 
-    # Launch EC2 instance
-    region = boto.ec2.get_region(ec2_region)
-    conn = boto.connect_ec2(region=region)
+    # The client token makes the request idempotent, so running a task
+    # again after a worker restart can't start a second server. Warm pool
+    # servers halt after restoring their world, and must stop, not
+    # terminate, when they do.
     reservation = conn.run_instances(
                         image_id=ec2_ami,
                         key_name=ec2_keypair,
                         security_groups=ec2_secgroups,
                         instance_type=ec2_instancetype,
-                        user_data=ec2_userdata)
-    server = reservation.instances[0]
-    while server.state == u'pending':
-        time.sleep(5)
-        server.update()
-
-    # Sometimes there's a delay assigning the ip address.
-    while not server.ip_address:
-        time.sleep(5)
-        server.update()
-
-    # Save to DB and send notification
-    instance.name = server.id
-    instance.ip_address = server.ip_address
-    instance.ami = server.image_id
-    instance.state = 'pending'
-    instance.save()
-    send_event('instance_state', instance.state)
-
-    # Send task to check if instance is running
-    check_state.delay(instance_id, 'running')
+                        user_data=ec2_userdata,
+                        instance_initiated_shutdown_behavior=(
+                            'stop' if warm_pool else None),
+                        placement=placement,
+                        client_token=client_token)
+    return reservation.instances[0]
 
+
+def restore_command(reply_to, warm_pool=False):
+    """
+    Return the boot command that restores a new server's world from S3,
+    reporting on `reply_to`, then starts the game server, or halts a
+    warm pool server. Empty with EBS persistence, which needs no restore.
+
+    """
+    if settings.MINECLOUD_PERSISTENCE == 'ebs':
+        return ''
+    args = ['python', '-m', 'minecloud.backup', 'restore',
+            settings.MINECLOUD_WORLD_DIR]
+    if reply_to:
+        args += ['--reply-to', reply_to]
+    if not warm_pool:
+        args += ['--ready-command', settings.MINECLOUD_START_COMMAND]
+    command = ' '.join(pipes.quote(arg) for arg in args)
+    if warm_pool:
+        command += ' && poweroff'
+    # runcmd doesn't see /etc/environment, which has the S3 and Redis
+    # settings.
+    return 'set -a && . /etc/environment && set +a && %s' % command
+
+
+@task
+def launch(instance_id):
+    # Retrive instance obj from DB.
+    instance = Instance.objects.get(pk=instance_id)
+    if instance.state != 'initiating':
+        return False
+
+    if not instance.name:
+        conn = connect_ec2()
+        pool_server = None
+        if settings.MINECLOUD_PERSISTENCE != 'ebs':
+            pool_server = claim_pool_server(conn, instance.world)
+        if pool_server:
+            # Save the server id before starting it, so it can't be
+            # orphaned.
+            instance.name = pool_server.name
+            instance.ami = pool_server.ami
+            instance.pool_server = pool_server
+            instance.save()
+            conn.start_instances(instance_ids=[pool_server.name])
+            fill_warm_pool.delay()
+        else:
+            # Launch EC2 instance, next to the world's volume, if any.
+            placement = None
+            if ebs_persistence(instance):
+                zones = (WorldVolume.objects
+                    .filter(world__exact=instance.world)
+                    .exclude(zone__exact='')
+                    .values_list('zone', flat=True)
+                )
+                placement = zones[0] if zones else None
+            hedged = hedging_enabled(instance)
+            if hedged:
+                attempt, created = LaunchAttempt.objects.get_or_create(
+                    instance=instance, number=0,
+                    defaults={'region': default_region(),
+                              'zone': placement or '', 'start': now()})
+                if attempt.outcome == 'failed':
+                    # Resumed after EC2 refused the server; the backups
+                    # take it from here.
+                    hedge.delay(instance.id, 1)
+                    return False
+            try:
+                server = run_server(conn, instance.world,
+                                    client_token='minecloud-%s' % instance.id,
+                                    reply_to=restore_reply_key(instance.id),
+                                    placement=placement)
+            except api_error() as e:
+                if not hedged:
+                    raise
+                # Try the next placement right away.
+                (LaunchAttempt.objects
+                    .filter(pk=attempt.pk)
+                    .update(outcome='failed', error=str(e)[:200])
+                )
+                hedge.delay(instance.id, 1)
+                return False
+
+            # Save the server id right away, so it can't be orphaned.
+            instance.name = server.id
+            instance.ami = server.image_id
+            instance.save()
+            if hedged:
+                LaunchAttempt.objects.filter(pk=attempt.pk).update(
+                    name=server.id)
+                hedge.apply_async(
+                    (instance.id, 1),
+                    countdown=settings.MINECLOUD_HEDGE_AFTER_SECONDS)
+
+    schedule_reconcile()
     return True
 
 
+@task
+def hedge(instance_id, number):
+    """
+    Boot backup server `number` for a launch that's still waiting for
+    EC2, in the placement MINECLOUD_HEDGE_PLACEMENTS lists at
+    `number` - 1, unless a server is running already (see hedging.py).
+    If EC2 can't start it, the next placement is tried right away;
+    otherwise, it is given MINECLOUD_HEDGE_AFTER_SECONDS. Once every
+    server has failed, the instance is terminated.
+
+    Returns the id of the server booted, or None.
+
+    """
+    instance = Instance.objects.get(pk=instance_id)
+    backups = placements()
+    while instance.state == 'initiating' and number <= len(backups):
+        region, zone, ami = backups[number - 1]
+        # Only one task can create attempt `number`.
+        attempt, created = LaunchAttempt.objects.get_or_create(
+            instance=instance, number=number,
+            defaults={'region': region, 'zone': zone, 'start': now()})
+        if not created:
+            return None
+        try:
+            server = run_server(
+                connect_ec2(region), instance.world,
+                client_token='minecloud-%s-%s' % (instance.id, number),
+                reply_to=restore_reply_key(instance.id, number),
+                placement=zone or None, image_id=ami)
+        except api_error() as e:
+            (LaunchAttempt.objects
+                .filter(pk=attempt.pk)
+                .update(outcome='failed', error=str(e)[:200])
+            )
+            number += 1
+            continue
+
+        LaunchAttempt.objects.filter(pk=attempt.pk).update(name=server.id)
+        # If every attempt before failed, this is the instance's server.
+        (Instance.objects
+            .filter(pk=instance.id, name__exact='')
+            .update(name=server.id, ami=server.image_id,
+                    region='' if region == default_region() else region)
+        )
+        if number < len(backups):
+            hedge.apply_async((instance.id, number + 1),
+                              countdown=settings.MINECLOUD_HEDGE_AFTER_SECONDS)
+        schedule_reconcile()
+        return server.id
+
+    if not (LaunchAttempt.objects
+            .filter(instance=instance, outcome__exact='pending')
+            .exists()):
+        # EC2 couldn't start a server in any placement. Give up, so
+        # players can try again.
+        if transition(instance, ['initiating'], 'terminated', end=now()):
+            logger.error("Launch of instance %s failed in every placement.",
+                         instance.id)
+    return None
+
+
 @task(max_retries=60)
 def check_state(instance_id, state):
     instance = Instance.objects.get(pk=instance_id)
+    followed = False
+    if state == 'running' and instance.state == 'pending':
+        followed = True
+        follow_restore(instance)
+        instance = Instance.objects.get(pk=instance_id)
     if instance.state == state:
-        send_event('instance_state', instance.state)
+        # The game server may have made this transition itself.
+        record_state(instance.id, state)
+        if state == 'running' and instance.ready is None:
+            (Instance.objects
+                .filter(pk=instance_id, ready__isnull=True)
+                .update(ready=now())
+            )
+        send_instance_state(instance.world, instance.state)
     # elif instance.state in ['initiating', 'pending', 'killing', 'shutting down']:
+    elif followed:
+        # follow_restore already waited.
+        check_state.retry(countdown=0)
     else:
-        check_state.retry(countdown=5)
+        check_state.retry(
+            countdown=backoff(check_state.request.retries, base=2, cap=10))
 
 
-@task
-def terminate(instance_id):
-    # Send redis message to backup
+def server_attempt(instance):
+    """Return the number of the LaunchAttempt of `instance`'s server."""
+    if not settings.MINECLOUD_HEDGE_PLACEMENTS:
+        return 0
+    numbers = list(LaunchAttempt.objects
+        .filter(instance=instance, name__exact=instance.name)
+        .values_list('number', flat=True)
+    )
+    return numbers[0] if numbers else 0
+
+
+def follow_restore(instance):
+    """
+    Relay the replies of a new server restoring its world.
+
+    The server pushes its replies, as JSON, onto the restore_reply_key
+    list (see minecloud.backup):
+
+      {"status": "started"}
+      {"status": "progress", "percent": 42, "bytes": 123456, "rate": 5678}
+      {"status": "ready"}
+      {"status": "finished", "manifest": "manifests/...", "seconds": 95}
+      {"status": "failed", "error": "..."}
+
+    "ready" means the game server is up, while distant regions are still
+    downloading, so the instance moves on to 'running'. Blocks for up to
+    RESTORE_REPLY_WAIT seconds, and returns True if the instance moved.
+
+    """
+    reply_key = restore_reply_key(instance.id, server_attempt(instance))
+    conn = redis_connection()
+
+    stop_waiting = time.time() + RESTORE_REPLY_WAIT
+    while True:
+        timeout = int(stop_waiting - time.time())
+        if timeout < 1:
+            return False
+        reply = conn.blpop([reply_key], timeout=timeout)
+        if reply is None:
+            return False
+
+        message = json.loads(reply[1])
+        status = message.get('status')
+        if status == 'started':
+            send_restore_progress(instance.world, {'percent': 0, 'bytes': 0})
+        elif status == 'progress':
+            send_restore_progress(instance.world, message)
+        elif status == 'ready':
+            # The server keeps reporting until its restore is finished,
+            # and the list expires on its own.
+            return transition(instance, ['pending'], 'running', ready=now())
+        elif status == 'failed':
+            logger.error("Restore of instance %s failed: %s",
+                         instance.id, message.get('error'))
+            return False
+
+
+def send_restore_progress(world, message):
+    data = json.dumps({'world': world,
+                       'percent': message.get('percent'),
+                       'bytes': message.get('bytes'),
+                       'rate': message.get('rate')})
+    send_event('restore_progress', data, key='restore_progress:%s' % world,
+               changes_page=False)
+
+
+def redis_connection():
+    # Imported here, as only workers talk to the game servers.
+    import redis
     redis_url = os.getenv('REDISTOGO_URL')
-    conn = redis.StrictRedis.from_url(redis_url)
-    conn.publish('command', 'backup')
+    return redis.StrictRedis.from_url(redis_url)
 
-    # Wait for backup to finish.
+
+@task
+def terminate(instance_id):
     instance = Instance.objects.get(pk=instance_id)
-    while instance.state != 'backup finished':
-        time.sleep(5)
-        instance = Instance.objects.get(pk=instance_id)
 
-    # Update instance state
-    instance.state = 'stopping'
-    instance.save()
-    send_event('instance_state', instance.state)
-
-    # Shut down, then terminate instance
-    ec2_region = os.getenv('MCL_EC2_REGION', 'us-west-2')
-    region = boto.ec2.get_region(ec2_region)
-    conn = boto.connect_ec2(region=region)
-    results = conn.stop_instances(instance_ids=[instance.name])
-    mc_server = results[0]
-    mc_server.update()
-    while mc_server.state != u'stopped':
-        time.sleep(10)
-        mc_server.update()
-    conn.terminate_instances(instance_ids=[instance.name])
-
-    # Save to DB and send notification
-    # But first, refresh instance, since state has changed.
+    # Send redis message to backup. The game server pushes its replies,
+    # as JSON, onto the reply_to list:
+    #
+    #   {"status": "started"}
+    #   {"status": "progress", "percent": 42, "bytes": 123456}
+    #   {"status": "finished", "manifest": "manifests/..."}
+    #   {"status": "failed", "error": "..."}
+    backup_id = uuid.uuid4().hex
+    command = {'command': 'backup',
+               'id': backup_id,
+               'reply_to': 'reply:%s' % backup_id}
+    conn = redis_connection()
+    conn.publish(instance.command_channel, json.dumps(command))
+
+    deadline = time.time() + settings.MINECLOUD_BACKUP_TIMEOUT
+    wait_for_backup.delay(instance_id, instance.world, backup_id, deadline)
+    return True
+
+
+@task(max_retries=None)
+def wait_for_backup(instance_id, world, backup_id, deadline):
+    """
+    Follow the game server's replies to a backup command.
+
+    Blocks on the reply list for up to BACKUP_REPLY_WAIT seconds at a
+    time, so replies are handled as soon as they arrive, and then
+    retries itself until the backup is finished or `deadline` (a Unix
+    timestamp) has passed. Each time it stops waiting, it also checks
+    whether the game server set the instance's state to 'backup
+    finished' itself, as servers built before the reply protocol do.
+
+    """
+    # Saves a DB query, since transition() only needs the id and world.
+    instance = Instance(id=instance_id, world=world)
+    reply_key = 'reply:%s' % backup_id
+    conn = redis_connection()
+
+    stop_waiting = min(deadline, time.time() + BACKUP_REPLY_WAIT)
+    while True:
+        timeout = int(stop_waiting - time.time())
+        if timeout < 1:
+            break
+        reply = conn.blpop([reply_key], timeout=timeout)
+        if reply is None:
+            break
+
+        message = json.loads(reply[1])
+        status = message.get('status')
+        if status == 'started':
+            transition(instance, ['shutting down'], 'backup started')
+            send_backup_progress(world, {'percent': 0, 'bytes': 0})
+        elif status == 'progress':
+            send_backup_progress(world, message)
+        elif status == 'finished':
+            conn.delete(reply_key)
+            # A pool server goes back to the pool with this backup on disk.
+            (PoolServer.objects
+                .filter(instance__id=instance_id)
+                .update(manifest=message.get('manifest') or '')
+            )
+            if transition(instance, ['shutting down', 'backup started'],
+                          'backup finished'):
+                stop.delay(instance_id)
+            return True
+        elif status == 'failed':
+            conn.delete(reply_key)
+            logger.error("Backup of instance %s failed: %s",
+                         instance_id, message.get('error'))
+            transition(instance, ['shutting down', 'backup started'],
+                       'backup failed')
+            return False
+
+    finished = (Instance.objects
+        .filter(pk=instance_id, state__exact='backup finished')
+        .exists()
+    )
+    if finished:
+        conn.delete(reply_key)
+        # Which backup a pool server has on disk isn't known.
+        PoolServer.objects.filter(instance__id=instance_id).update(manifest='')
+        stop.delay(instance_id)
+        return True
+
+    if time.time() >= deadline:
+        conn.delete(reply_key)
+        logger.error("Backup of instance %s timed out.", instance_id)
+        transition(instance, ['shutting down', 'backup started'],
+                   'backup failed')
+        return False
+    wait_for_backup.retry(countdown=0)
+
+
+def send_backup_progress(world, message):
+    data = json.dumps({'world': world,
+                       'percent': message.get('percent'),
+                       'bytes': message.get('bytes')})
+    send_event('backup_progress', data, key='backup_progress:%s' % world,
+               changes_page=False)
+
+
+@task
+def stop(instance_id):
     instance = Instance.objects.get(pk=instance_id)
-    timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
-    instance.end = timestamp
-    instance.save()
+    if not transition(instance, ['backup finished'], 'stopping'):
+        return False
+
+    conn = connect_ec2(instance.region or None)
+    if ebs_persistence(instance):
+        # The game server has unmounted the world volume. EC2 detaches it,
+        # without deleting it, when the server terminates.
+        snapshot_world_volume(conn, instance.world)
+        conn.terminate_instances(instance_ids=[instance.name])
+        Instance.objects.filter(pk=instance.id).update(end=now())
+        record_uptime(instance.id)
+        check_state.delay(instance.id, 'terminated')
+        return True
 
-    # Send task to check if instance has been terminated.
-    check_state.delay(instance_id, 'terminated')
+    # Shut down, then terminate instance (once reconcile sees that
+    # it's stopped).
+    conn.stop_instances(instance_ids=[instance.name])
 
+    schedule_reconcile()
     return True
+
+
+# States in which the next step waits for EC2.
+EC2_WAITING_STATES = ['initiating', 'stopping']
+
+
+def schedule_reconcile(countdown=5):
+    """
+    Run reconcile in `countdown` seconds, unless it's already scheduled.
+
+    However many launches and shutdowns are in flight, this keeps a
+    single reconcile task scheduled to check on all of them.
+
+    """
+    if cache.add('reconcile_scheduled', True, countdown + 60):
+        reconcile.apply_async(countdown=countdown)
+
+
+@task
+def reconcile():
+    """
+    Bring every non-terminated Instance in line with its EC2 server.
+
+    Fetches the state of all servers with one describe call, then moves
+    along the instances whose server changed state. Runs every few
+    seconds while any instance is waiting for EC2, and periodically (see
+    CELERYBEAT_SCHEDULE) as a safety net.
+
+    """
+    cache.delete('reconcile_scheduled')
+    instances = list(Instance.objects
+        .exclude(state__exact='terminated')
+        .exclude(name__exact='')
+    )
+    if not instances:
+        return 0
+
+    # The launches that are hedged, and their servers.
+    attempts = {}
+    if settings.MINECLOUD_HEDGE_PLACEMENTS:
+        launching = [instance.id for instance in instances
+                     if instance.state == 'initiating']
+        if launching:
+            for attempt in (LaunchAttempt.objects
+                    .filter(instance__in=launching, outcome__exact='pending')
+                    .exclude(name__exact='')):
+                attempts.setdefault(attempt.instance_id, []).append(attempt)
+
+    # One describe call per region.
+    names = {}
+    for instance in instances:
+        names.setdefault(instance.region, set()).add(instance.name)
+    for attempt in itertools.chain(*attempts.values()):
+        region = '' if attempt.region == default_region() else attempt.region
+        names.setdefault(region, set()).add(attempt.name)
+    servers = {}
+    for region, region_names in names.items():
+        servers.update(describe_servers(connect_ec2(region or None),
+                                        region_names))
+
+    waiting = False
+    for instance in instances:
+        if instance.id in attempts:
+            settle_attempts(instance, attempts[instance.id], servers)
+        server = servers.get(instance.name)
+        if server is None:
+            # EC2 can take a moment to list a server it just launched.
+            waiting = waiting or instance.state in EC2_WAITING_STATES
+        else:
+            conn = connect_ec2(instance.region or None)
+            waiting = reconcile_instance(conn, instance, server) or waiting
+
+    if waiting:
+        schedule_reconcile()
+    return len(instances)
+
+
+def settle_attempts(instance, attempts, servers):
+    """
+    Keep the first of a hedged launch's servers to be ready, as the
+    instance's server, and terminate the others. Boots the next backup
+    server right away if one of them failed.
+
+    """
+    winner, losers, failed = pick_winner(instance, attempts, servers)
+    for attempt in failed:
+        (LaunchAttempt.objects
+            .filter(pk=attempt.pk)
+            .update(outcome='failed', error=attempt.error)
+        )
+    if failed and winner is None:
+        hedge.delay(instance.id, max(attempt.number for attempt in attempts)
+                    + 1)
+    if winner is None:
+        return
+
+    ready = now()
+    (LaunchAttempt.objects
+        .filter(pk=winner.pk)
+        .update(outcome='won', ready=ready)
+    )
+    for attempt in losers:
+        server = servers.get(attempt.name)
+        ready_too = server is not None and server.state == u'running' and \
+            bool(server.ip_address)
+        (LaunchAttempt.objects
+            .filter(pk=attempt.pk)
+            .update(outcome='lost', ready=ready if ready_too else None)
+        )
+        connect_ec2(attempt.region).terminate_instances(
+            instance_ids=[attempt.name])
+
+    if winner.name != instance.name:
+        region = '' if winner.region == default_region() else winner.region
+        instance.name = winner.name
+        instance.region = region
+        instance.ami = servers[winner.name].image_id
+        (Instance.objects
+            .filter(pk=instance.id)
+            .update(name=instance.name, region=region, ami=instance.ami)
+        )
+
+
+def reconcile_instance(conn, instance, server):
+    """
+    Move `instance` along to match `server`.
+
+    Returns True if the instance is still waiting for EC2.
+
+    """
+    if instance.state == 'initiating':
+        if server.state == u'stopped' and instance.pool_server_id:
+            # Start request was lost, e.g. the worker restarted before
+            # sending it.
+            conn.start_instances(instance_ids=[instance.name])
+            return True
+        # Sometimes there's a delay assigning the ip address.
+        if server.state != u'running' or not server.ip_address:
+            return True
+        if ebs_persistence(instance) and not attach_world_volume(
+                conn, instance.world, server):
+            return True
+        if transition(instance, ['initiating'], 'pending',
+                      ip_address=server.ip_address):
+            # Send task to check if instance is running
+            check_state.delay(instance.id, 'running')
+
+    elif instance.state == 'stopping':
+        if server.state in [u'pending', u'running']:
+            # Stop request was lost, e.g. the worker restarted before
+            # sending it.
+            conn.stop_instances(instance_ids=[instance.name])
+            return True
+        if server.state not in [u'stopped', u'terminated']:
+            return True
+        if instance.pool_server_id and server.state == u'stopped':
+            # Keep the server, with its world, for the next launch.
+            (PoolServer.objects
+                .filter(pk=instance.pool_server_id)
+                .update(state='ready', released=now())
+            )
+            if transition(instance, ['stopping'], 'terminated', end=now()):
+                record_uptime(instance.id)
+        elif instance.end is None:
+            conn.terminate_instances(instance_ids=[instance.name])
+            Instance.objects.filter(pk=instance.id).update(end=now())
+            record_uptime(instance.id)
+            # Send task to check if instance has been terminated.
+            check_state.delay(instance.id, 'terminated')
+
+    elif server.state == u'terminated':
+        # Server went away without us, e.g. it was terminated from the
+        # AWS console.
+        if transition(instance, [instance.state], 'terminated', end=now()):
+            record_uptime(instance.id)
+
+    return False
+
+
+def attach_world_volume(conn, world, server):
+    """
+    Attach the volume of `world` to `server`, one step at a time.
+
+    Returns True once the volume is attached. If the world has no volume
+    in the server's zone yet, creates one from the latest snapshot (or an
+    empty one, for a new world), and deletes the volume in the old zone.
+
+    """
+    world_volume, created = WorldVolume.objects.get_or_create(world=world)
+    volume = describe_volume(conn, world_volume.volume_id)
+
+    if volume is not None and volume.zone != server.placement:
+        if volume.status != u'available':
+            return False
+        if not world_volume.snapshot_id:
+            # The world was never snapshotted, so move it by snapshot now.
+            snapshot_world_volume(conn, world)
+            return False
+        snapshot = describe_snapshot(conn, world_volume.snapshot_id)
+        if snapshot is None or snapshot.status != u'completed':
+            return False
+        conn.delete_volume(volume.id)
+        volume = None
+
+    if volume is None:
+        snapshot_id = world_volume.snapshot_id or None
+        if snapshot_id:
+            snapshot = describe_snapshot(conn, snapshot_id)
+            if snapshot is not None and snapshot.status != u'completed':
+                return False
+            if snapshot is None:
+                logger.error("Snapshot %s of world %s is gone; starting "
+                             "with an empty volume.", snapshot_id, world)
+                snapshot_id = None
+        volume = conn.create_volume(settings.MINECLOUD_EBS_VOLUME_SIZE,
+                                    server.placement, snapshot=snapshot_id)
+        world_volume.volume_id = volume.id
+        world_volume.zone = server.placement
+        world_volume.save()
+        return False
+
+    if volume.status == u'available':
+        conn.attach_volume(volume.id, server.id,
+                           settings.MINECLOUD_EBS_DEVICE)
+        return False
+    # 'creating', or still attached to the last server while it terminates.
+    return (volume.status == u'in-use' and
+            volume.attach_data.instance_id == server.id)
+
+
+def snapshot_world_volume(conn, world):
+    """
+    Snapshot the volume of `world`, and delete its oldest snapshots.
+
+    Keeps the newest MINECLOUD_EBS_SNAPSHOTS_KEPT snapshots. EBS snapshots
+    are incremental, so each one only stores what changed.
+
+    """
+    world_volume = WorldVolume.objects.filter(world__exact=world)[:1]
+    if not world_volume or not world_volume[0].volume_id:
+        logger.error("World %s has no volume to snapshot.", world)
+        return None
+    world_volume = world_volume[0]
+    description = 'minecloud world %s' % world
+    snapshot = conn.create_snapshot(world_volume.volume_id, description)
+    world_volume.snapshot_id = snapshot.id
+    world_volume.save()
+
+    snapshots = conn.get_all_snapshots(owner='self',
+                                       filters={'description': description})
+    snapshots.sort(key=lambda snapshot: snapshot.start_time, reverse=True)
+    kept = max(settings.MINECLOUD_EBS_SNAPSHOTS_KEPT, 1)
+    for old in snapshots[kept:]:
+        if old.id != snapshot.id:
+            conn.delete_snapshot(old.id)
+    return snapshot
+
+
+def claim_pool_server(conn, world):
+    """
+    Take a ready server for `world` out of the warm pool, or return None.
+
+    Prefers the most recently used server, whose world on disk is the
+    most up to date. Servers whose world is older than the latest backup,
+    e.g. one made by a server booted while the pool was empty, are
+    terminated instead, and the pool is refilled.
+
+    """
+    candidates = list(PoolServer.objects
+        .filter(world__exact=world, state__exact='ready')
+        .order_by('-released')[:5]
+    )
+    if not candidates:
+        return None
+    latest = latest_manifest(world)
+    retired = False
+    for pool_server in candidates:
+        claimed = (PoolServer.objects
+            .filter(pk=pool_server.pk, state__exact='ready')
+            .update(state='in use')
+        )
+        if not claimed:
+            continue
+        if pool_server.manifest == latest:
+            return pool_server
+        logger.info("Retiring pool server %s: it has backup %r of world "
+                    "%s, not %r.", pool_server.name, pool_server.manifest,
+                    world, latest)
+        conn.terminate_instances(instance_ids=[pool_server.name])
+        PoolServer.objects.filter(pk=pool_server.pk).update(state='retired')
+        retired = True
+    if retired:
+        fill_warm_pool.delay()
+    return None
+
+
+def world_store(world):
+    """Return the S3Store holding the backups of `world`."""
+    return S3Store(os.getenv('MSM_S3_BUCKET'), world,
+                   os.getenv('MSM_S3_ENDPOINT'))
+
+
+def latest_manifest(world):
+    """Return the name of the latest backup of `world`, or ''."""
+    return world_store(world).get('latest') or ''
+
+
+def pool_reply_key(pool_server_id):
+    """Redis list on which a new pool server reports its world restore."""
+    return 'restore:pool:%s' % pool_server_id
+
+
+def restored_manifest(pool_server):
+    """
+    Return the backup a halted pool server restored, from its restore
+    replies, or '' if it didn't report one.
+
+    """
+    reply_key = pool_reply_key(pool_server.id)
+    conn = redis_connection()
+    manifest = ''
+    for reply in conn.lrange(reply_key, 0, -1):
+        message = json.loads(reply)
+        if message.get('status') == 'finished':
+            manifest = message.get('manifest') or ''
+    conn.delete(reply_key)
+    return manifest
+
+
+@task
+def fill_warm_pool():
+    """
+    Keep MINECLOUD_WARM_POOL_SIZE stopped servers ready for each world.
+
+    Marks provisioning servers that have halted as ready, boots new
+    servers for worlds whose pool is short, and terminates ready servers
+    beyond the pool size.
+
+    """
+    # Don't let two runs provision servers for the same shortfall.
+    if not cache.add('fill_warm_pool_lock', True, 5*60):
+        return 0
+    size = settings.MINECLOUD_WARM_POOL_SIZE
+    if settings.MINECLOUD_PERSISTENCE == 'ebs':
+        size = 0
+    try:
+        provisioned, waiting = _fill_warm_pool(size)
+    finally:
+        cache.delete('fill_warm_pool_lock')
+
+    if waiting:
+        fill_warm_pool.apply_async(countdown=30)
+    return provisioned
+
+
+def _fill_warm_pool(size):
+    conn = connect_ec2()
+
+    provisioning = list(PoolServer.objects
+        .filter(state__exact='provisioning')
+        .exclude(name__exact='')
+    )
+    servers = describe_servers(conn, [p.name for p in provisioning])
+    for pool_server in provisioning:
+        server = servers.get(pool_server.name)
+        if server is None:
+            continue
+        if server.state == u'stopped':
+            # The server has restored its world, and halted.
+            (PoolServer.objects
+                .filter(pk=pool_server.pk, state__exact='provisioning')
+                .update(state='ready', released=now(),
+                        manifest=restored_manifest(pool_server))
+            )
+        elif server.state == u'terminated':
+            pool_server.state = 'retired'
+            pool_server.save()
+
+    # Servers in use will come back to the pool, so they count too.
+    pool_servers = list(PoolServer.objects
+        .exclude(state__exact='retired')
+        .order_by('-released')
+    )
+    by_world = {}
+    for pool_server in pool_servers:
+        by_world.setdefault(pool_server.world, []).append(pool_server)
+
+    new_servers = [p for p in pool_servers if not p.name]
+    for world in settings.MINECLOUD_WORLDS:
+        for i in range(size - len(by_world.get(world, []))):
+            new_servers.append(PoolServer.objects.create(
+                world=world, created=now(), state='provisioning'))
+
+    for pool_server in new_servers:
+        server = run_server(conn, pool_server.world, warm_pool=True,
+                            client_token='minecloud-pool-%s' % pool_server.id,
+                            reply_to=pool_reply_key(pool_server.id))
+        pool_server.name = server.id
+        pool_server.ami = server.image_id
+        pool_server.save()
+
+    for world, world_servers in by_world.items():
+        world_size = size if world in settings.MINECLOUD_WORLDS else 0
+        ready = [p for p in world_servers if p.state == 'ready']
+        in_use = len(world_servers) - len(ready)
+        for pool_server in ready[max(world_size - in_use, 0):]:
+            conn.terminate_instances(instance_ids=[pool_server.name])
+            pool_server.state = 'retired'
+            pool_server.save()
+
+    waiting = bool(new_servers) or any(
+        p.state == 'provisioning' for p in pool_servers)
+    return len(new_servers), waiting
+
+
+# Most player events ingest_player_events records at a time.
+PLAYER_EVENTS_BATCH = 1000
+
+
+@task
+def ingest_player_events():
+    """
+    Record the player events waiting in Redis, and send the new rosters.
+
+    Runs every few seconds (see CELERYBEAT_SCHEDULE), so a busy server
+    costs one batch of writes per run, rather than a transaction per
+    event. Events are removed from the list only once they're recorded.
+
+    """
+    # Batches must be recorded in order, so a leave follows its join.
+    if not cache.add('ingest_player_events_lock', True, 60):
+        return 0
+    try:
+        conn = redis_connection()
+        raw_events = conn.lrange(PLAYER_EVENTS_KEY, 0, PLAYER_EVENTS_BATCH - 1)
+        events = []
+        for raw_event in raw_events:
+            try:
+                events.append(json.loads(raw_event))
+            except ValueError:
+                logger.error("Dropped malformed player event: %r", raw_event)
+        changed = record_player_events(events)
+        conn.ltrim(PLAYER_EVENTS_KEY, len(raw_events), -1)
+    finally:
+        cache.delete('ingest_player_events_lock')
+
+    send_rosters(changed)
+    if len(raw_events) == PLAYER_EVENTS_BATCH:
+        ingest_player_events.delay()
+    return len(raw_events)
+
+
+# Most telemetry samples ingest_telemetry records at a time.
+TELEMETRY_BATCH = 1000
+
+
+@task
+def ingest_telemetry():
+    """
+    Record the telemetry samples waiting in Redis, and send the latest
+    sample of each world to the SSE 'telemetry' channel.
+
+    Runs every few seconds, like ingest_player_events, so a server
+    sending a sample a second costs one insert per run.
+
+    """
+    if not cache.add('ingest_telemetry_lock', True, 60):
+        return 0
+    try:
+        conn = redis_connection()
+        raw_samples = conn.lrange(TELEMETRY_KEY, 0, TELEMETRY_BATCH - 1)
+        samples = []
+        for raw_sample in raw_samples:
+            try:
+                samples.append(json.loads(raw_sample))
+            except ValueError:
+                logger.error("Dropped malformed telemetry sample: %r",
+                             raw_sample)
+        latest = record_telemetry(samples)
+        conn.ltrim(TELEMETRY_KEY, len(raw_samples), -1)
+    finally:
+        cache.delete('ingest_telemetry_lock')
+
+    send_telemetry(latest)
+    if len(raw_samples) == TELEMETRY_BATCH:
+        ingest_telemetry.delay()
+    return len(raw_samples)
+
+
+@task
+def downsample_telemetry():
+    """Roll up old telemetry into coarser rows (see telemetry.py)."""
+    if downsample(now()):
+        downsample_telemetry.delay()
+
+
+@task
+def prewarm():
+    """
+    Launch the servers players will probably want within the next
+    MINECLOUD_PREWARM_LEAD_MINUTES, going by when they've played before
+    (see prewarm.py), so they don't have to wait for them.
+
+    Runs every minute (see CELERYBEAT_SCHEDULE). Pre-warmed servers are
+    launched on behalf of whoever last launched the world, and left to
+    shutdown_idle if no one turns up.
+
+    """
+    if not settings.MINECLOUD_PREWARM:
+        return []
+    timestamp = now()
+    worlds = worlds_to_prewarm(demand_patterns(timestamp),
+                               settings.MINECLOUD_WORLDS, timestamp,
+                               settings.MINECLOUD_PREWARM_LEAD_MINUTES,
+                               settings.MINECLOUD_PREWARM_THRESHOLD)
+    if not worlds:
+        return []
+
+    # Someone just shut it down, or no one came to the last pre-warm.
+    cooling_down = set(Instance.objects
+        .filter(world__in=worlds, end__gte=timestamp - PREWARM_COOLDOWN)
+        .values_list('world', flat=True)
+    )
+    launched = []
+    for world in worlds:
+        if world in cooling_down:
+            continue
+        users = list(User.objects
+            .filter(instance__world=world, instance__prewarmed=False)
+            .order_by('-instance__start')[:1]
+        )
+        if users and request_launch(world, users[0], prewarmed=True):
+            launched.append(world)
+    return launched
+
+
+@task
+def shutdown_idle():
+    """
+    Shut down the running servers no one has been logged in to for
+    MINECLOUD_IDLE_SHUTDOWN_MINUTES. Runs every minute.
+
+    """
+    minutes = settings.MINECLOUD_IDLE_SHUTDOWN_MINUTES
+    if not minutes:
+        return []
+    instances = list(Instance.objects.filter(state__exact='running'))
+    if not instances:
+        return []
+
+    sessions = Session.objects.filter(instance__in=instances)
+    occupied = set(sessions
+        .filter(logout__isnull=True)
+        .values_list('instance', flat=True)
+    )
+    last_logouts = dict(sessions
+        .values_list('instance')
+        .annotate(Max('logout'))
+    )
+    cutoff = now() - datetime.timedelta(minutes=minutes)
+    shut_down = []
+    for instance in instances:
+        if instance.id in occupied:
+            continue
+        idle_since = max(instance.ready or instance.start,
+                         last_logouts.get(instance.id) or instance.start)
+        if idle_since > cutoff:
+            continue
+        if transition(instance, ['running'], 'shutting down'):
+            terminate.delay(instance.id)
+            shut_down.append(instance.id)
+    return shut_down
+
+
+# Task that picks up the lifecycle of an instance in each state.
+RESUME_TASKS = {
+    'initiating': launch,
+    'shutting down': terminate,
+    'backup started': terminate,
+    'backup finished': stop,
+}
+
+
+@task
+def resume(instance_id):
+    """Restart the task chain of an instance from its saved state."""
+    instance = Instance.objects.get(pk=instance_id)
+    if instance.state == 'pending':
+        check_state.delay(instance_id, 'running')
+    elif instance.state in RESUME_TASKS:
+        RESUME_TASKS[instance.state].delay(instance_id)
+    elif instance.state == 'stopping':
+        schedule_reconcile()
+
+
+@worker_ready.connect
+def resume_lifecycles(**kwargs):
+    """
+    Resume launches and shutdowns that were interrupted by a restart.
+
+    Any tasks of the old chain that survived the restart are harmless:
+    each step checks the instance state before doing anything, and
+    transitions are made with transition(), so only one chain proceeds.
+
+    """
+    states = ['pending', 'stopping'] + list(RESUME_TASKS)
+    for instance in Instance.objects.filter(state__in=states):
+        logger.info("Resuming lifecycle of instance %s (%s).",
+                    instance.id, instance.state)
+        resume.delay(instance.id)
@@ -0,0 +1,295 @@
+"""
+Game server telemetry, kept as a downsampled time series.
+
+Game servers RPUSH a sample a second, as JSON, onto the TELEMETRY_KEY
+list in Redis:
+
+  {"world": "default", "time": 1371234567, "tps": 19.8, "memory_mb": 612,
+   "chunks": 1450, "players": {"steve": 48, "alex": 120}}
+
+where "players" maps each player online to their latency in ms. The
+ingest_telemetry task records them in batches, with a fixed number of
+queries, and sends the latest sample of each world to the SSE
+'telemetry' channel.
+
+Raw samples are kept for RAW_RETENTION, then rolled up into 1-minute
+rows, which are kept for MINUTE_RETENTION, then into 1-hour rows, kept
+for HOUR_RETENTION (see downsample()). A server that never stops costs
+about 3,600 raw rows, 10,000 1-minute rows, and 24 more rows a day.
+
+"""
+import calendar
+import datetime
+import json
+import logging
+import os
+
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils.timezone import utc
+
+from . import metrics
+from .models import Instance, TelemetrySample
+from .sseview import send_event
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_KEY = 'telemetry'
+
+MINUTE = 60
+HOUR = 60 * 60
+
+RAW_RETENTION = datetime.timedelta(hours=1)
+MINUTE_RETENTION = datetime.timedelta(days=7)
+HOUR_RETENTION = datetime.timedelta(days=400)
+
+# (resolution, rolled up into, after)
+DOWNSAMPLING = [(1, MINUTE, RAW_RETENTION),
+                (MINUTE, HOUR, MINUTE_RETENTION)]
+
+# Most rows downsample() rolls up at a time, per resolution.
+DOWNSAMPLE_BATCH = 20000
+
+SUM_FIELDS = ('count', 'tps_sum', 'memory_sum', 'chunks_sum',
+              'latency_sum', 'latency_count')
+MAX_FIELDS = ('memory_max', 'chunks_max', 'players_max', 'latency_max')
+
+# EC2 instance types a game server can run on:
+# (name, memory in GiB, ECUs, on-demand dollars per hour in US East)
+INSTANCE_TYPES = [
+    ('m1.small', 1.7, 1, 0.06),
+    ('m1.medium', 3.75, 2, 0.12),
+    ('c1.medium', 1.7, 5, 0.145),
+    ('m1.large', 7.5, 4, 0.24),
+    ('m1.xlarge', 15, 8, 0.48),
+    ('m3.xlarge', 15, 13, 0.50),
+    ('c1.xlarge', 7, 20, 0.58),
+]
+
+# Memory needed besides the heap (JVM and OS), in MiB, and headroom kept
+# above the peak heap.
+MEMORY_OVERHEAD_MB = 512
+MEMORY_HEADROOM = 1.25
+
+# A server keeping up runs at 20 ticks per second.
+MAX_TPS = 20.0
+HEALTHY_TPS = 19.0
+
+
+def parse_sample(sample):
+    """Return the fields of a raw TelemetrySample, or None if malformed."""
+    try:
+        latencies = [int(latency)
+                     for latency in (sample.get('players') or {}).values()]
+        tps = float(sample['tps'])
+        memory = float(sample['memory_mb'])
+        chunks = int(sample.get('chunks', 0))
+        start = datetime.datetime.utcfromtimestamp(
+            int(sample['time'])).replace(tzinfo=utc)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    return {'world': sample.get('world', 'default'),
+            'resolution': 1,
+            'start': start,
+            'count': 1,
+            'tps_sum': tps,
+            'tps_min': tps,
+            'memory_sum': memory,
+            'memory_max': memory,
+            'chunks_sum': chunks,
+            'chunks_max': chunks,
+            'players_max': len(latencies),
+            'latency_sum': sum(latencies),
+            'latency_count': len(latencies),
+            'latency_max': max(latencies or [0])}
+
+
+@transaction.commit_on_success
+def record_telemetry(samples):
+    """
+    Record a batch of raw samples, in three queries.
+
+    Samples for worlds without an instance, and samples recorded already
+    (e.g. when a batch is replayed), are dropped. Returns the fields of
+    the latest sample recorded for each world.
+
+    """
+    parsed = filter(None, map(parse_sample, samples))
+    if len(parsed) < len(samples):
+        logger.error("Dropped %d malformed telemetry samples.",
+                     len(samples) - len(parsed))
+    if not parsed:
+        return {}
+
+    instances = dict(Instance.objects
+        .filter(world__in=set(fields['world'] for fields in parsed))
+        .exclude(state__exact='terminated')
+        .values_list('world', 'id')
+    )
+    recorded = set(TelemetrySample.objects
+        .filter(instance__in=instances.values(), resolution=1)
+        .filter(start__gte=min(fields['start'] for fields in parsed))
+        .filter(start__lte=max(fields['start'] for fields in parsed))
+        .values_list('instance', 'start')
+    )
+
+    rows = []
+    latest = {}
+    for fields in parsed:
+        instance_id = instances.get(fields['world'])
+        if instance_id is None:
+            continue
+        if (instance_id, fields['start']) in recorded:
+            continue
+        recorded.add((instance_id, fields['start']))
+        rows.append(TelemetrySample(instance_id=instance_id, **fields))
+        world = fields['world']
+        if world not in latest or fields['start'] >= latest[world]['start']:
+            latest[world] = fields
+    TelemetrySample.objects.bulk_create(rows)
+    metrics.incr('minecloud_telemetry_samples_total', len(rows))
+    return latest
+
+
+def send_telemetry(latest):
+    """Send the latest sample of each world to all SSE clients."""
+    for world, fields in latest.items():
+        latency = None
+        if fields['latency_count']:
+            latency = fields['latency_sum'] // fields['latency_count']
+        data = json.dumps({'world': world,
+                           'time': fields['start'].isoformat(),
+                           'tps': fields['tps_sum'],
+                           'memory_mb': fields['memory_sum'],
+                           'chunks': fields['chunks_sum'],
+                           'players': fields['players_max'],
+                           'latency_ms': latency})
+        send_event('telemetry', data, key='telemetry:%s' % world,
+                   changes_page=False)
+
+
+def bucket_start(when, resolution):
+    """Return the start of the `resolution` seconds `when` falls in."""
+    seconds = calendar.timegm(when.utctimetuple())
+    return datetime.datetime.utcfromtimestamp(
+        seconds - seconds % resolution).replace(tzinfo=utc)
+
+
+def rollup(rows, resolution):
+    """
+    Roll `rows` up into a TelemetrySample per instance per `resolution`
+    seconds. The rows may be of any finer resolution, or `resolution`
+    itself (rows rolled up before, that are getting late samples).
+
+    """
+    buckets = {}
+    for row in rows:
+        key = (row.instance_id, bucket_start(row.start, resolution))
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TelemetrySample(
+                instance_id=row.instance_id, world=row.world,
+                resolution=resolution, start=key[1], tps_min=row.tps_min,
+                **dict((field, getattr(row, field))
+                       for field in SUM_FIELDS + MAX_FIELDS))
+            continue
+        for field in SUM_FIELDS:
+            setattr(bucket, field,
+                    getattr(bucket, field) + getattr(row, field))
+        for field in MAX_FIELDS:
+            setattr(bucket, field, max(getattr(bucket, field),
+                                       getattr(row, field)))
+        bucket.tps_min = min(bucket.tps_min, row.tps_min)
+
+    if resolution == MINUTE:
+        # tps_min is the lowest 1-minute average.
+        for bucket in buckets.values():
+            bucket.tps_min = bucket.tps_sum / bucket.count
+    return buckets.values()
+
+
+@transaction.commit_on_success
+def downsample(now):
+    """
+    Roll up the rows older than their resolution's retention, oldest
+    first, and delete the 1-hour rows older than HOUR_RETENTION.
+
+    Returns True if there are more rows to roll up than one batch.
+
+    """
+    more = False
+    for fine, coarse, retention in DOWNSAMPLING:
+        cutoff = bucket_start(now - retention, coarse)
+        rows = list(TelemetrySample.objects
+            .filter(resolution=fine, start__lt=cutoff)
+            .order_by('start', 'id')[:DOWNSAMPLE_BATCH]
+        )
+        if not rows:
+            continue
+        more = more or len(rows) == DOWNSAMPLE_BATCH
+
+        # Rows rolled up before, into the buckets these rows go in.
+        buckets = set((row.instance_id, bucket_start(row.start, coarse))
+                      for row in rows)
+        existing = [row for row in TelemetrySample.objects
+                        .filter(resolution=coarse)
+                        .filter(instance__in=set(key[0] for key in buckets))
+                        .filter(start__gte=min(key[1] for key in buckets))
+                        .filter(start__lte=max(key[1] for key in buckets))
+                    if (row.instance_id, row.start) in buckets]
+        delete_rows(existing + rows)
+        TelemetrySample.objects.bulk_create(rollup(existing + rows, coarse))
+
+    TelemetrySample.objects.filter(
+        resolution=HOUR, start__lt=now - HOUR_RETENTION).delete()
+    return more
+
+
+def delete_rows(rows, batch_size=500):
+    pks = [row.pk for row in rows]
+    for i in range(0, len(pks), batch_size):
+        TelemetrySample.objects.filter(pk__in=pks[i:i + batch_size]).delete()
+
+
+def recommend_instance_type(current, peak_memory_mb, min_tps):
+    """
+    Return the cheapest instance type with room for `peak_memory_mb` of
+    heap, and enough CPU to keep up: as much as `current` has, if its
+    lowest 1-minute average TPS (`min_tps`) was healthy, and more, in
+    proportion, if it wasn't.
+
+    """
+    types = dict((instance_type[0], instance_type)
+                 for instance_type in INSTANCE_TYPES)
+    needed_ecu = types[current][2] if current in types else 1
+    if min_tps is not None and min_tps < HEALTHY_TPS:
+        needed_ecu *= MAX_TPS / max(min_tps, 1)
+    needed_memory = ((peak_memory_mb or 0) * MEMORY_HEADROOM +
+                     MEMORY_OVERHEAD_MB) / 1024.0
+    candidates = [instance_type for instance_type in INSTANCE_TYPES
+                  if instance_type[1] >= needed_memory and
+                  instance_type[2] >= needed_ecu]
+    if not candidates:
+        return max(INSTANCE_TYPES, key=lambda t: (t[2], t[1]))[0]
+    return min(candidates, key=lambda t: t[3])[0]
+
+
+def rightsizing(since):
+    """
+    Return the peaks of each world's telemetry since `since`, and the
+    instance type they call for, from the 1-minute and 1-hour rows.
+
+    """
+    # The same default as tasks.run_server.
+    current = os.getenv('MCL_EC2_INSTANCE_TYPE', 'm1.small')
+    peaks = (TelemetrySample.objects
+        .filter(resolution__gte=MINUTE, start__gte=since)
+        .values('world')
+        .annotate(memory_mb=Max('memory_max'), tps=Min('tps_min'),
+                  players=Max('players_max'), latency_ms=Max('latency_max'))
+        .order_by('world')
+    )
+    return [dict(peak, current=current,
+                 recommended=recommend_instance_type(
+                     current, peak['memory_mb'], peak['tps']))
+            for peak in peaks]
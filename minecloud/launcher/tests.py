@@ -5,7 +5,41 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import calendar
+import datetime
+import itertools
+import gzip
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from celery import current_app
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import close_connection, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils.timezone import utc
+from django.utils.unittest import skipUnless
+from kombu import Connection
+
+from minecloud import backup
+
+from . import (ec2, hedging, metrics, prewarm, rollups, sseview, startup,
+               tasks, telemetry)
+from .assets import PrecompressedStaticFilesStorage, StaticFilesApplication
+from .models import (DailyPlaytime, DailyUptime, Instance, LaunchAttempt,
+                     PhaseTiming, PoolServer, Session, TelemetrySample,
+                     WorldVolume)
+from .sseserver import SseApplication
+from .standins import FakeEC2Connection, FakeRedis, TaskSimulation
+from .sseview import (EventHub, EventLogReader, HubReader, SelfUpdatingSse,
+                      send_event, send_instance_state)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +48,1386 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class CountingEventLogReader(EventLogReader):
+    """EventLogReader that counts how often it reads the event log."""
+    reads = 0
+
+    def read_new_events(self):
+        CountingEventLogReader.reads += 1
+        return super(CountingEventLogReader, self).read_new_events()
+
+
+class EventHubTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        CountingEventLogReader.reads = 0
+        self.hub = EventHub(lambda: CountingEventLogReader(
+            timeout=None, poll_interval=0.05))
+
+    def tearDown(self):
+        self.hub.stop()
+
+    def reader(self, **kwargs):
+        kwargs.setdefault('timeout', None)
+        return iter(HubReader(self.hub, **kwargs))
+
+    def test_readers_share_one_upstream_reader(self):
+        send_event('instance_state', 'terminated')
+        readers = [self.reader() for i in range(20)]
+        for reader in readers:
+            self.assertEqual(next(reader)[:2], ('instance_state', 'terminated'))
+        reads_before = CountingEventLogReader.reads
+
+        event_id = send_event('instance_state', 'pending')
+        for reader in readers:
+            self.assertEqual(next(reader)[:3],
+                             ('instance_state', 'pending', event_id))
+
+        # Twenty readers, but only the hub's single poller reads the cache.
+        self.assertTrue(CountingEventLogReader.reads - reads_before < 20)
+
+    def test_new_reader_gets_latest_event_per_key(self):
+        send_instance_state('creative', 'initiating')
+        send_instance_state('survival', 'initiating')
+        send_instance_state('creative', 'pending')
+        reader = self.reader(heartbeat_interval=0.1)
+        self.assertEqual(json.loads(next(reader)[1]),
+                         {'world': 'survival', 'state': 'initiating'})
+        self.assertEqual(json.loads(next(reader)[1]),
+                         {'world': 'creative', 'state': 'pending'})
+        self.assertEqual(next(reader), None)
+
+    def test_reader_sends_heartbeat_when_nothing_changes(self):
+        event_id = send_event('instance_state', 'running')
+        reader = self.reader(heartbeat_interval=0.1)
+        self.assertEqual(next(reader)[:3],
+                         ('instance_state', 'running', event_id))
+        self.assertEqual(next(reader), None)
+
+    def test_reader_gets_only_subscribed_channels(self):
+        send_instance_state('creative', 'running')
+        send_event('roster', 'creative roster', key='roster:creative')
+        send_event('roster', 'survival roster', key='roster:survival')
+        reader = self.reader(heartbeat_interval=0.1,
+                             channels=frozenset(['instance_state',
+                                                 'roster:survival']))
+        self.assertEqual(next(reader)[0], 'instance_state')
+        self.assertEqual(next(reader)[1], 'survival roster')
+        self.assertEqual(next(reader), None)
+
+        send_event('backup_progress', '50', key='backup_progress:creative')
+        event_id = send_instance_state('creative', 'shutting down')
+        self.assertEqual(next(reader)[2], event_id)
+
+    def test_reconnecting_reader_gets_missed_events(self):
+        first_id = send_event('instance_state', 'initiating')
+        second_id = send_event('instance_state', 'pending')
+        third_id = send_event('instance_state', 'running')
+        reader = self.reader(last_event_id=first_id)
+        self.assertEqual(next(reader)[:3],
+                         ('instance_state', 'pending', second_id))
+        self.assertEqual(next(reader)[:3],
+                         ('instance_state', 'running', third_id))
+
+    def test_reconnecting_reader_waits_for_hub_to_load(self):
+        def upstream():
+            # The event log's history, read slowly.
+            for event_id in range(1, 5):
+                yield ('instance_state', 'running', event_id,
+                       'instance_state')
+                if event_id < 3:
+                    time.sleep(0.1)
+            while True:
+                yield None
+                time.sleep(0.05)
+        hub = EventHub(upstream)
+        self.addCleanup(hub.stop)
+
+        # A hub that hasn't reached the client's id yet isn't a reset.
+        self.assertEqual([event[2] for event in hub.events_since(3, 5)], [4])
+
+    def test_reader_waits_for_event_sent_after_its_id(self):
+        first_id = send_event('instance_state', 'initiating')
+        log = EventLogReader()
+        self.assertEqual([event[2] for event in log.read_new_events()],
+                         [first_id])
+
+        # send_event() has taken the next id, but not stored the event.
+        cache.incr(sseview.EVENT_SEQUENCE_KEY)
+        self.assertEqual(log.read_new_events(), [])
+        cache.set(sseview._event_key(first_id + 1),
+                  json.dumps([first_id + 1, 'instance_state', 'pending',
+                              'instance_state', time.time()]))
+        self.assertEqual([event[2] for event in log.read_new_events()],
+                         [first_id + 1])
+
+    def test_reader_skips_event_that_was_never_stored(self):
+        send_event('instance_state', 'initiating')
+        log = EventLogReader()
+        log.read_new_events()
+        missing_id = cache.incr(sseview.EVENT_SEQUENCE_KEY)
+        event_id = send_event('instance_state', 'pending')
+        self.assertEqual(log.read_new_events(), [])
+
+        log.gap = (missing_id, time.time() - sseview.EVENT_GAP_GRACE - 1)
+        self.assertEqual([event[2] for event in log.read_new_events()],
+                         [event_id])
+
+    def test_sse_frames(self):
+        event_id = send_event('instance_state', 'running')
+        sse = SelfUpdatingSse(self.reader(heartbeat_interval=0.1))
+        frames = iter(sse)
+        self.assertEqual(''.join(itertools.islice(frames, 5)),
+                         'retry: 2000\n\n'
+                         'id: %d\n'
+                         'event: instance_state\n'
+                         'data: running\n\n' % event_id)
+        self.assertEqual(next(frames), ': heartbeat\n\n')
+
+
+class SseApplicationTest(TestCase):
+    def setUp(self):
+        User.objects.create_user('steve', password='secret')
+        self.app = SseApplication()
+
+    def tearDown(self):
+        # Streaming starts the process's hub.
+        sseview.hub.stop()
+
+    def request(self, **environ):
+        environ.setdefault('PATH_INFO', '/sse')
+        environ.setdefault('REQUEST_METHOD', 'GET')
+        status = []
+        self.headers = {}
+
+        def start_response(s, headers):
+            status.append(s)
+            self.headers = dict(headers)
+        body = self.app(environ, start_response)
+        return status[0], body
+
+    def test_requires_login(self):
+        status, body = self.request()
+        self.assertEqual(status, '403 FORBIDDEN')
+
+    def test_streams_instance_state(self):
+        send_instance_state('default', 'terminated')
+        self.client.login(username='steve', password='secret')
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        status, body = self.request(
+            HTTP_COOKIE='%s=%s' % (settings.SESSION_COOKIE_NAME, session_key))
+        self.assertEqual(status, '200 OK')
+        frames = list(itertools.islice(body, 3))
+        body.close()
+        self.assertEqual(frames[0], 'retry: 2000\n\n')
+        self.assertTrue('event: instance_state\n' in frames)
+
+    def test_allows_credentials_from_allowed_origins(self):
+        saved = settings.SSE_ALLOWED_ORIGINS
+        settings.SSE_ALLOWED_ORIGINS = ['https://minecloud.example.com']
+        try:
+            self.request(HTTP_ORIGIN='https://minecloud.example.com')
+            self.assertEqual(
+                self.headers.get('Access-Control-Allow-Origin'),
+                'https://minecloud.example.com')
+            self.assertEqual(
+                self.headers.get('Access-Control-Allow-Credentials'), 'true')
+
+            self.request(HTTP_ORIGIN='https://evil.example.com')
+            self.assertFalse('Access-Control-Allow-Origin' in self.headers)
+        finally:
+            settings.SSE_ALLOWED_ORIGINS = saved
+
+
+class StaticAssetsTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'js'))
+        shutil.copy(os.path.join(settings.STATIC_DIR, 'js', 'eventsource.js'),
+                    os.path.join(self.root, 'js'))
+        self.storage = PrecompressedStaticFilesStorage(
+            location=self.root, base_url='/static/')
+        list(self.storage.post_process(
+            {'js/eventsource.js': (self.storage, 'js/eventsource.js')}))
+        self.hashed_name = self.storage.manifest['js/eventsource.js']
+        self.app = StaticFilesApplication(
+            lambda environ, start_response: ['django'],
+            root=self.root, prefix='/static/')
+
+    def request(self, path, **environ):
+        environ.update(PATH_INFO=path, REQUEST_METHOD='GET')
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        body = ''.join(self.app(environ, start_response))
+        return response.get('status'), response.get('headers'), body
+
+    def test_collect_writes_hashed_compressed_files(self):
+        self.assertEqual(self.storage.url('js/eventsource.js'),
+                         '/static/' + self.hashed_name)
+        with open(os.path.join(self.root, 'js', 'eventsource.js')) as f:
+            original = f.read()
+        compressed = os.path.join(self.root, self.hashed_name + '.gz')
+        self.assertEqual(gzip.open(compressed).read(), original)
+        self.assertTrue(os.path.getsize(compressed) < len(original))
+
+    def test_serves_precompressed_variant_with_long_lifetime(self):
+        status, headers, body = self.request(
+            '/static/' + self.hashed_name, HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=31536000')
+        self.assertTrue(headers['Content-Type'].endswith('/javascript'))
+        self.assertEqual(int(headers['Content-Length']), len(body))
+
+        # A client that doesn't accept gzip has the uncompressed file,
+        # with a different ETag.
+        status, headers, body = self.request(
+            '/static/' + self.hashed_name, HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '200 OK')
+        self.assertFalse('Content-Encoding' in headers)
+        status, _, body = self.request(
+            '/static/' + self.hashed_name, HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '304 NOT MODIFIED')
+        self.assertEqual(body, '')
+
+    def test_unhashed_names_are_cached_briefly(self):
+        status, headers, body = self.request('/static/js/eventsource.js')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=300')
+
+    def test_serves_only_static_files(self):
+        self.assertEqual(self.request('/static/js/missing.js')[0],
+                         '404 NOT FOUND')
+        self.assertEqual(self.request('/static/../static/js/eventsource.js')[0],
+                         '404 NOT FOUND')
+        self.assertEqual(self.request('/')[2], 'django')
+
+
+class StartupTest(TestCase):
+    def test_web_process_does_not_import_worker_dependencies(self):
+        result = startup.run('web')
+        modules = [module[0] for module in result['modules']]
+        self.assertTrue('minecloud.launcher.views' in modules)
+        self.assertTrue(result['status'])
+        for module in modules:
+            self.assertFalse(module.split('.')[0] in ('boto', 'redis'),
+                             module)
+        self.assertEqual([name for name, seconds in result['phases']],
+                         ['settings', 'import minecloud.wsgi',
+                          'first request'])
+
+
+class ConnectEC2Test(TestCase):
+    def setUp(self):
+        self._environ = os.environ.copy()
+        os.environ.update({'AWS_ACCESS_KEY_ID': 'key',
+                           'AWS_SECRET_ACCESS_KEY': 'secret',
+                           'MCL_EC2_ENDPOINT': 'http://localhost:5000/'})
+        ec2._connections.clear()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        ec2._connections.clear()
+
+    def test_connection_is_shared_per_region(self):
+        conn = ec2.connect_ec2('us-west-2')
+        self.assertTrue(ec2.connect_ec2('us-west-2') is conn)
+        self.assertFalse(ec2.connect_ec2('us-east-1') is conn)
+        self.assertEqual((conn.host, conn.port), ('localhost', 5000))
+
+
+class LifecycleTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('steve', password='secret')
+        self.conn = FakeEC2Connection()
+        self.checked = []
+        self.redis = FakeRedis()
+        self.store = MemoryStore()
+        self._saved = (tasks.connect_ec2, tasks.redis_connection,
+                       tasks.check_state, tasks.world_store,
+                       current_app.conf.CELERY_ALWAYS_EAGER,
+                       settings.MINECLOUD_WARM_POOL_SIZE,
+                       settings.MINECLOUD_BACKUP_TIMEOUT,
+                       settings.MINECLOUD_PERSISTENCE,
+                       settings.MINECLOUD_EBS_SNAPSHOTS_KEPT,
+                       settings.MINECLOUD_PREWARM,
+                       settings.MINECLOUD_IDLE_SHUTDOWN_MINUTES,
+                       settings.MINECLOUD_HEDGE_PLACEMENTS)
+        tasks.connect_ec2 = lambda *args: self.conn
+        tasks.redis_connection = lambda: self.redis
+        tasks.check_state = self
+        tasks.world_store = lambda world: self.store
+        current_app.conf.CELERY_ALWAYS_EAGER = True
+        current_app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+
+    def tearDown(self):
+        (tasks.connect_ec2, tasks.redis_connection,
+         tasks.check_state, tasks.world_store,
+         current_app.conf.CELERY_ALWAYS_EAGER,
+         settings.MINECLOUD_WARM_POOL_SIZE,
+         settings.MINECLOUD_BACKUP_TIMEOUT,
+         settings.MINECLOUD_PERSISTENCE,
+         settings.MINECLOUD_EBS_SNAPSHOTS_KEPT,
+         settings.MINECLOUD_PREWARM,
+         settings.MINECLOUD_IDLE_SHUTDOWN_MINUTES,
+         settings.MINECLOUD_HEDGE_PLACEMENTS) = self._saved
+
+    def delay(self, instance_id, state):
+        """Record check_state calls, instead of waiting for the server."""
+        self.checked.append(state)
+
+    def create_instance(self, state):
+        timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
+        return Instance.objects.create(launched_by=self.user, start=timestamp,
+                                       state=state)
+
+    def test_launch(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'pending')
+        self.assertEqual(instance.ip_address, '10.0.0.1')
+        self.assertEqual(self.checked, ['running'])
+        self.assertEqual(self.conn.calls.count('run_instances'), 1)
+
+    def test_new_server_restores_its_world(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+
+        user_data = self.conn.servers[
+            Instance.objects.get(pk=instance.id).name].user_data
+        self.assertTrue('runcmd:' in user_data)
+        self.assertTrue("minecloud.backup restore %s --reply-to restore:%s "
+                        "--ready-command 'msm minecraft start'"
+                        % (settings.MINECLOUD_WORLD_DIR, instance.id)
+                        in user_data)
+
+    def test_launch_records_phase_timings(self):
+        instance = self.create_instance('initiating')
+        # Ids are reused between tests.
+        cache.delete('instance_phase:%s' % instance.id)
+        metrics.record_state(instance.id, 'initiating')
+        tasks.launch.delay(instance.id)
+        metrics.record_state(instance.id, 'pending')
+
+        self.assertEqual(
+            list(PhaseTiming.objects.values_list('instance', 'phase')),
+            [(instance.id, 'initiating')])
+        self.assertTrue('minecloud_phase_seconds_count{phase="initiating"} 1'
+                        in metrics.render_metrics())
+
+    def test_resumed_launch_reuses_server(self):
+        instance = self.create_instance('initiating')
+        # Worker died after run_instances, before saving the server id.
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(state='initiating',
+                                                       name='')
+        tasks.resume_lifecycles()
+
+        self.assertEqual(len(self.conn.servers), 1)
+        self.assertEqual(Instance.objects.get(pk=instance.id).state, 'pending')
+
+    def test_launch_without_capacity_boots_backup_server(self):
+        settings.MINECLOUD_HEDGE_PLACEMENTS = ['us-west-2b']
+        self.conn = FakeEC2Connection(unavailable_zones=('us-west-2a',))
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'pending')
+        self.assertEqual(self.conn.servers[instance.name].placement,
+                         'us-west-2b')
+        self.assertEqual(
+            list(LaunchAttempt.objects
+                .filter(instance=instance)
+                .order_by('number')
+                .values_list('zone', 'outcome')
+            ),
+            [('', 'failed'), ('us-west-2b', 'won')])
+
+    def test_launch_without_capacity_anywhere_gives_up(self):
+        settings.MINECLOUD_HEDGE_PLACEMENTS = ['us-west-2b']
+        self.conn = FakeEC2Connection(
+            unavailable_zones=('us-west-2a', 'us-west-2b'))
+        instance = tasks.request_launch('default', self.user)
+
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'terminated')
+        self.assertTrue(instance.end is not None)
+        self.assertEqual(
+            list(LaunchAttempt.objects
+                .filter(instance=instance)
+                .values_list('outcome', flat=True)
+            ),
+            ['failed', 'failed'])
+        # Players can try again.
+        self.assertTrue(tasks.request_launch('default', self.user))
+
+    def test_shutdown_after_backup(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(state='backup finished')
+        tasks.stop.delay(instance.id)
+
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'stopping')
+        self.assertTrue(instance.end is not None)
+        self.assertEqual(self.conn.servers[instance.name].state, u'terminated')
+        self.assertEqual(self.checked, ['running', 'terminated'])
+
+    def backup_replies(self, *replies):
+        """Queue the game server's replies to the next backup command."""
+        original_publish = self.redis.publish
+
+        def publish(channel, message):
+            original_publish(channel, message)
+            reply_to = json.loads(message)['reply_to']
+            for reply in replies:
+                self.redis.rpush(reply_to, json.dumps(reply))
+        self.redis.publish = publish
+
+    def test_shutdown_waits_for_backup_reply(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(state='shutting down')
+        self.backup_replies({'status': 'started'},
+                            {'status': 'progress', 'percent': 50},
+                            {'status': 'finished'})
+        tasks.terminate.delay(instance.id)
+
+        channel, command = self.redis.published[0]
+        self.assertEqual(channel, 'command')
+        self.assertEqual(json.loads(command)['command'], 'backup')
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'stopping')
+        self.assertTrue(instance.end is not None)
+
+    def test_backup_command_replies_finish_shutdown(self):
+        world_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, world_dir)
+        with open(os.path.join(world_dir, 'level.dat'), 'wb') as f:
+            f.write('level')
+        saved = (backup.get_store, backup.redis_connection)
+        backup.get_store = lambda options: MemoryStore()
+        backup.redis_connection = lambda: self.redis
+        self.addCleanup(setattr, backup, 'get_store', saved[0])
+        self.addCleanup(setattr, backup, 'redis_connection', saved[1])
+
+        # The game server runs the backup command it's sent, as the
+        # README tells it to.
+        def run_backup(message):
+            backup.main(['backup', world_dir,
+                         '--reply-to', json.loads(message)['reply_to']])
+        self.redis.subscribe('command', run_backup)
+
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(state='shutting down')
+        tasks.terminate.delay(instance.id)
+
+        self.assertEqual(Instance.objects.get(pk=instance.id).state,
+                         'stopping')
+
+    def test_simultaneous_launch_requests_make_one_server(self):
+        self.client.login(username='steve', password='secret')
+        original_now = tasks.now
+        responses = []
+
+        def now():
+            # The other players click "Wake Up Server" while the first
+            # request is between checking for an instance and creating it.
+            tasks.now = original_now
+            for i in range(49):
+                responses.append(self.client.post('/launch'))
+            return original_now()
+        tasks.now = now
+        try:
+            responses.append(self.client.post('/launch'))
+        finally:
+            tasks.now = original_now
+
+        self.assertEqual([response.status_code for response in responses],
+                         [302] * 50)
+        self.assertEqual(Instance.objects.count(), 1)
+        self.assertEqual(self.conn.calls.count('run_instances'), 1)
+        self.assertEqual(self.client.post('/launch').status_code, 302)
+        self.assertEqual(Instance.objects.count(), 1)
+
+    def test_repeated_shutdown_requests_back_up_once(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(state='running')
+        self.backup_replies({'status': 'started'}, {'status': 'finished'})
+        self.client.login(username='steve', password='secret')
+        for i in range(50):
+            self.client.post('/terminate', {'instance_id': instance.id})
+
+        self.assertEqual(len(self.redis.published), 1)
+        self.assertEqual(self.conn.calls.count('terminate_instances'), 1)
+        self.assertEqual(Instance.objects.get(pk=instance.id).state,
+                         'stopping')
+
+    def test_failed_backup_keeps_server_running(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(state='shutting down')
+        self.backup_replies({'status': 'started'},
+                            {'status': 'failed', 'error': 'S3 is down'})
+        tasks.terminate.delay(instance.id)
+
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'backup failed')
+        self.assertFalse('stop_instances' in self.conn.calls)
+
+    def test_backup_finished_without_replies(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(state='shutting down')
+
+        # A game server built before the reply protocol sets the state
+        # itself.
+        self.redis.subscribe('command', lambda message: (Instance.objects
+            .filter(pk=instance.id)
+            .update(state='backup finished')
+        ))
+        tasks.terminate.delay(instance.id)
+
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'stopping')
+        self.assertTrue(instance.end is not None)
+
+    def test_backup_deadline(self):
+        settings.MINECLOUD_BACKUP_TIMEOUT = 0
+        instance = self.create_instance('shutting down')
+        tasks.terminate.delay(instance.id)
+        self.assertEqual(Instance.objects.get(pk=instance.id).state,
+                         'backup failed')
+
+    def test_warm_pool(self):
+        settings.MINECLOUD_WARM_POOL_SIZE = 1
+        tasks.fill_warm_pool.delay()
+        pool_server = PoolServer.objects.get()
+        self.assertEqual(pool_server.state, 'ready')
+        self.assertEqual(self.conn.servers[pool_server.name].state, u'stopped')
+
+        # Launch starts the pooled server, rather than booting a new one.
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'pending')
+        self.assertEqual(instance.pool_server_id, pool_server.id)
+        self.assertEqual(self.conn.calls.count('run_instances'), 1)
+        self.assertEqual(self.conn.calls.count('start_instances'), 1)
+
+        # Shutdown returns it to the pool.
+        Instance.objects.filter(pk=instance.id).update(state='backup finished')
+        tasks.stop.delay(instance.id)
+        self.assertEqual(Instance.objects.get(pk=instance.id).state,
+                         'terminated')
+        self.assertEqual(PoolServer.objects.get().state, 'ready')
+        self.assertFalse('terminate_instances' in self.conn.calls)
+
+    def test_pool_server_older_than_latest_backup_is_retired(self):
+        world_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, world_dir)
+        with open(os.path.join(world_dir, 'level.dat'), 'wb') as f:
+            f.write('level')
+        saved = (backup.get_store, backup.redis_connection)
+        backup.get_store = lambda options: self.store
+        backup.redis_connection = lambda: self.redis
+        self.addCleanup(setattr, backup, 'get_store', saved[0])
+        self.addCleanup(setattr, backup, 'redis_connection', saved[1])
+        self.redis.subscribe('command', lambda message: backup.main(
+            ['backup', world_dir,
+             '--reply-to', json.loads(message)['reply_to']]))
+        restored = set()
+
+        def server_changed(server):
+            # Pool servers restore the latest backup on first boot.
+            if (server.env('MCL_WARM_POOL') and server.state == u'running'
+                    and server.id not in restored):
+                restored.add(server.id)
+                reply_to = server.env('MCL_RESTORE_REPLY_TO')
+                for reply in [{'status': 'started'},
+                              {'status': 'finished',
+                               'manifest': self.store.get('latest')}]:
+                    self.redis.rpush(reply_to, json.dumps(reply))
+        self.conn.on_change = server_changed
+
+        # A cold launch, while the pool is empty, then a pool server
+        # restores the world as it was before that server's backup.
+        cold = self.create_instance('initiating')
+        tasks.launch.delay(cold.id)
+        settings.MINECLOUD_WARM_POOL_SIZE = 1
+        tasks.fill_warm_pool.delay()
+        stale = PoolServer.objects.get()
+        self.assertEqual(stale.state, 'ready')
+        Instance.objects.filter(pk=cold.id).update(state='shutting down')
+        tasks.terminate.delay(cold.id)
+        self.assertEqual(Instance.objects.get(pk=cold.id).state, 'stopping')
+        latest = self.store.get('latest')
+        self.assertNotEqual(stale.manifest, latest)
+
+        # The pool launch boots a new server, rather than start the one
+        # with the old world.
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'pending')
+        self.assertEqual(instance.pool_server_id, None)
+        self.assertFalse('start_instances' in self.conn.calls)
+        self.assertEqual(PoolServer.objects.get(pk=stale.pk).state, 'retired')
+        self.assertEqual(self.conn.servers[stale.name].state, u'terminated')
+
+        # Its replacement restored the latest backup, so it's used.
+        Instance.objects.filter(pk=instance.id).update(state='terminated')
+        fresh = PoolServer.objects.get(state='ready')
+        self.assertEqual(fresh.manifest, latest)
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        self.assertEqual(Instance.objects.get(pk=instance.id).pool_server_id,
+                         fresh.id)
+
+    def test_reconcile_uses_one_describe_call(self):
+        instances = [self.create_instance('initiating') for i in range(5)]
+        for instance in instances:
+            server = self.conn.run_instances('ami-00000000').instances[0]
+            Instance.objects.filter(pk=instance.id).update(name=server.id)
+        self.conn.pending_polls = 0
+        del self.conn.calls[:]
+
+        self.assertEqual(tasks.reconcile(), 5)
+        self.assertEqual(self.conn.calls, ['get_all_instances'])
+        self.assertEqual(self.checked, ['running'] * 5)
+        self.assertEqual(Instance.objects.filter(state='pending').count(), 5)
+
+    def test_restore_ready_moves_to_running(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        for reply in [{'status': 'started'},
+                      {'status': 'progress', 'percent': 50, 'bytes': 10,
+                       'rate': 5},
+                      {'status': 'ready'}]:
+            self.redis.rpush(tasks.restore_reply_key(instance.id),
+                             json.dumps(reply))
+
+        check_state = self._saved[2]
+        check_state.apply(args=(instance.id, 'running'))
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'running')
+        self.assertTrue(instance.ready is not None)
+
+    def test_ebs_persistence(self):
+        settings.MINECLOUD_PERSISTENCE = 'ebs'
+        settings.MINECLOUD_EBS_SNAPSHOTS_KEPT = 1
+
+        def launch_and_stop():
+            instance = self.create_instance('initiating')
+            tasks.launch.delay(instance.id)
+            instance = Instance.objects.get(pk=instance.id)
+            self.assertEqual(instance.state, 'pending')
+            volume = self.conn.volumes[WorldVolume.objects.get().volume_id]
+            self.assertEqual(volume.attach_data.instance_id, instance.name)
+
+            Instance.objects.filter(pk=instance.id).update(
+                state='backup finished')
+            tasks.stop.delay(instance.id)
+            self.assertEqual(self.conn.servers[instance.name].state,
+                             u'terminated')
+            return volume
+
+        volume = launch_and_stop()
+        self.assertEqual(launch_and_stop(), volume)
+        self.assertEqual(self.conn.calls.count('create_volume'), 1)
+        self.assertEqual(self.conn.calls.count('stop_instances'), 0)
+        # Only the newest snapshot is kept.
+        self.assertEqual(self.conn.snapshots.keys(),
+                         [WorldVolume.objects.get().snapshot_id])
+
+        # The next server lands in another zone, so the world moves there
+        # by snapshot.
+        volume.zone = 'us-west-2b'
+        WorldVolume.objects.update(zone='')
+        snapshot_id = WorldVolume.objects.get().snapshot_id
+        moved = launch_and_stop()
+        self.assertEqual(moved.zone, 'us-west-2a')
+        self.assertEqual(moved.snapshot_id, snapshot_id)
+        self.assertFalse(volume.id in self.conn.volumes)
+
+    def test_prewarm_launches_before_players_usually_do(self):
+        settings.MINECLOUD_PREWARM = True
+        cache.delete(prewarm.PATTERNS_CACHE_KEY)
+        timestamp = tasks.now()
+        for weeks in range(1, 4):
+            start = timestamp + datetime.timedelta(minutes=10, weeks=-weeks)
+            Instance.objects.create(
+                launched_by=self.user, start=start, state='terminated',
+                end=start + datetime.timedelta(hours=2))
+
+        self.assertEqual(tasks.prewarm(), ['default'])
+        instance = Instance.objects.get(state='pending')
+        self.assertTrue(instance.prewarmed)
+        self.assertEqual(instance.launched_by, self.user)
+        # Already running.
+        self.assertEqual(tasks.prewarm(), [])
+
+    def test_idle_server_is_shut_down(self):
+        settings.MINECLOUD_IDLE_SHUTDOWN_MINUTES = 30
+        timestamp = tasks.now()
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        Instance.objects.filter(pk=instance.id).update(
+            state='running', ready=timestamp - datetime.timedelta(hours=1))
+        session = Session.objects.create(
+            user=self.user, instance=instance,
+            login=timestamp - datetime.timedelta(minutes=50))
+        self.assertEqual(tasks.shutdown_idle(), [])
+
+        session.logout = timestamp - datetime.timedelta(minutes=20)
+        session.save()
+        self.assertEqual(tasks.shutdown_idle(), [])
+
+        Session.objects.filter(pk=session.pk).update(
+            logout=timestamp - datetime.timedelta(minutes=40))
+        self.backup_replies({'status': 'started'}, {'status': 'finished'})
+        self.assertEqual(tasks.shutdown_idle(), [instance.id])
+        self.assertEqual(Instance.objects.get(pk=instance.id).state,
+                         'stopping')
+
+    def test_reconcile_terminated_server(self):
+        instance = self.create_instance('initiating')
+        tasks.launch.delay(instance.id)
+        instance = Instance.objects.get(pk=instance.id)
+        self.conn.terminate_instances([instance.name])
+
+        tasks.reconcile()
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual(instance.state, 'terminated')
+        self.assertTrue(instance.end is not None)
+
+
+class TaskSimulationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('steve', password='secret')
+        self.sim = TaskSimulation([tasks.launch, tasks.check_state,
+                                   tasks.reconcile, tasks.hedge])
+        self.redis = FakeRedis(clock=self.sim)
+        self.conn = FakeEC2Connection(
+            pending_polls=0, pending_delay=40, missing_ip_delay=5,
+            clock=self.sim, on_change=self.server_changed)
+        self._saved = (tasks.connect_ec2, tasks.redis_connection, tasks.time)
+        tasks.connect_ec2 = lambda *args: self.conn
+        tasks.redis_connection = lambda: self.redis
+        tasks.time = self.sim
+        cache.delete('reconcile_scheduled')
+        self.sim.install()
+
+    def tearDown(self):
+        self.sim.uninstall()
+        (tasks.connect_ec2, tasks.redis_connection, tasks.time) = self._saved
+
+    def server_changed(self, server):
+        """Report the restore as ready 30 seconds after boot."""
+        if server.ip_address:
+            self.sim.spawn(self.restore, server.env('MCL_RESTORE_REPLY_TO'))
+
+    def restore(self, reply_to):
+        self.sim.sleep(30)
+        self.redis.rpush(reply_to, json.dumps({'status': 'ready'}))
+
+    def test_launch_on_simulated_clock(self):
+        timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
+        instance = Instance.objects.create(launched_by=self.user,
+                                           start=timestamp,
+                                           state='initiating')
+
+        def player():
+            tasks.launch.delay(instance.id)
+            while Instance.objects.get(pk=instance.id).state != 'running':
+                self.sim.sleep(1)
+
+        self.assertTrue(self.sim.run(player, timeout=3600))
+        # Booting, IP address, restore, plus reconcile's polling.
+        elapsed = self.sim.time() - self.sim.started
+        self.assertTrue(75 <= elapsed <= 90, elapsed)
+        self.assertEqual(self.conn.calls.count('run_instances'), 1)
+        self.assertEqual(self.sim.stats[tasks.launch.name]['runs'], 1)
+        self.assertTrue(self.sim.stats[tasks.check_state.name]['retries'] > 0)
+
+    def test_slow_launch_is_hedged_in_another_region(self):
+        saved = (settings.MINECLOUD_HEDGE_PLACEMENTS,
+                 settings.MINECLOUD_HEDGE_AFTER_SECONDS)
+        settings.MINECLOUD_HEDGE_PLACEMENTS = ['us-east-1:ami-east']
+        settings.MINECLOUD_HEDGE_AFTER_SECONDS = 60
+        self.conn.pending_delay = 600
+        east = FakeEC2Connection(pending_polls=0, pending_delay=40,
+                                 clock=self.sim, on_change=self.server_changed)
+        east.next_id = 100
+        tasks.connect_ec2 = lambda region=None: (
+            east if region == 'us-east-1' else self.conn)
+        timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
+        instance = Instance.objects.create(launched_by=self.user,
+                                           start=timestamp,
+                                           state='initiating')
+
+        def player():
+            tasks.launch.delay(instance.id)
+            while Instance.objects.get(pk=instance.id).state != 'running':
+                self.sim.sleep(1)
+
+        try:
+            self.assertTrue(self.sim.run(player, timeout=3600))
+        finally:
+            (settings.MINECLOUD_HEDGE_PLACEMENTS,
+             settings.MINECLOUD_HEDGE_AFTER_SECONDS) = saved
+        # The deadline, booting in us-east-1, and the restore.
+        elapsed = self.sim.time() - self.sim.started
+        self.assertTrue(130 <= elapsed <= 150, elapsed)
+        instance = Instance.objects.get(pk=instance.id)
+        self.assertEqual((instance.region, instance.ami),
+                         ('us-east-1', 'ami-east'))
+        # Each server reports its restore on its own list, so the one
+        # that lost can't mark the instance running.
+        self.assertEqual(
+            [server.env('MCL_RESTORE_REPLY_TO')
+             for server in self.conn.servers.values() + east.servers.values()],
+            [tasks.restore_reply_key(instance.id),
+             tasks.restore_reply_key(instance.id, 1)])
+        self.assertEqual(
+            [server.state for server in self.conn.servers.values()],
+            [u'terminated'])
+        self.assertEqual(
+            list(LaunchAttempt.objects
+                .filter(instance=instance)
+                .order_by('number')
+                .values_list('region', 'outcome')
+            ),
+            [('us-west-2', 'lost'), ('us-east-1', 'won')])
+        report = hedging.attempt_report(timestamp)
+        self.assertEqual([(row['placement'], row['won'])
+                          for row in report['placements']],
+                         [('us-east-1', 1), ('us-west-2', 0)])
+
+
+class DemandPatternTest(TestCase):
+    def setUp(self):
+        # A Thursday evening, in US/Pacific.
+        self.now = datetime.datetime(2013, 3, 1, 2, 50, tzinfo=utc)
+
+    def weekly(self, weeks, minutes=10):
+        """The same time, `minutes` from now, `weeks` weeks ago."""
+        return [self.now + datetime.timedelta(minutes=minutes, weeks=-week)
+                for week in weeks]
+
+    def test_regular_time_is_predicted(self):
+        pattern = prewarm.DemandPattern.learn(self.weekly(range(1, 5)),
+                                              self.now)
+        self.assertEqual(pattern.probability(self.now, 15), 1.0)
+        for later in (datetime.timedelta(hours=1), datetime.timedelta(days=1)):
+            self.assertEqual(pattern.probability(self.now + later, 15), 0)
+
+    def test_recent_weeks_count_for_more(self):
+        pattern = prewarm.DemandPattern.learn(
+            self.weekly(range(4, 8)) + self.weekly(range(1, 4), minutes=70),
+            self.now)
+        self.assertTrue(pattern.probability(self.now, 15) < 0.5)
+        self.assertTrue(pattern.probability(
+            self.now + datetime.timedelta(hours=1), 15) > 0.5)
+        self.assertEqual(
+            prewarm.worlds_to_prewarm({'default': pattern}, ['default'],
+                                      self.now, 15, 0.5),
+            [])
+
+    def test_single_week_is_not_a_pattern(self):
+        pattern = prewarm.DemandPattern.learn(self.weekly([1]), self.now)
+        self.assertEqual(pattern.probability(self.now, 15), 0)
+
+
+class PlayerEventsTest(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self._saved = tasks.redis_connection
+        tasks.redis_connection = lambda: self.redis
+        self.players = [User.objects.create_user('player%d' % i)
+                        for i in range(20)]
+        timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
+        self.instance = Instance.objects.create(
+            launched_by=self.players[0], start=timestamp, state='running',
+            name='i-00000', ami='ami-00000000')
+
+    def tearDown(self):
+        tasks.redis_connection = self._saved
+
+    def push(self, event, player, time, world='default'):
+        self.redis.rpush(tasks.PLAYER_EVENTS_KEY, json.dumps(
+            {'event': event, 'player': player, 'world': world,
+             'time': time}))
+
+    def test_events_are_recorded_in_one_batch(self):
+        for i, player in enumerate(self.players):
+            self.push('join', player.username, 1000 + i)
+        for i, player in enumerate(self.players[:10]):
+            self.push('leave', player.username, 2000 + i)
+        self.push('join', 'herobrine', 1000)
+
+        # Instances, users, sessions and one insert, playtime rollups,
+        # then the roster.
+        with self.assertNumQueries(8):
+            self.assertEqual(tasks.ingest_player_events(), 31)
+        self.assertEqual(Session.objects.count(), 20)
+        self.assertEqual(
+            Session.objects.filter(logout__isnull=True).count(), 10)
+        session = Session.objects.get(user=self.players[3])
+        self.assertEqual(session.logout - session.login,
+                         datetime.timedelta(seconds=1000))
+        self.assertEqual(self.redis.lists[tasks.PLAYER_EVENTS_KEY], [])
+
+        roster = json.loads(json.loads(cache.get('roster:default'))[1])
+        self.assertEqual([player['name'] for player in roster['players']],
+                         ['player%d' % i for i in range(10, 20)])
+
+    def test_leave_in_later_batch_and_replayed_join(self):
+        self.push('join', 'player1', 1000)
+        tasks.ingest_player_events()
+        self.push('join', 'player1', 1000)
+        self.push('leave', 'player1', 1500)
+        # Instances, users, sessions and one logout, playtime rollups,
+        # then the roster.
+        with self.assertNumQueries(8):
+            tasks.ingest_player_events()
+
+        session = Session.objects.get()
+        self.assertEqual(session.logout - session.login,
+                         datetime.timedelta(seconds=500))
+
+    def test_malformed_events_are_dropped(self):
+        self.push('join', 'player1', 1000)
+        for malformed in ('[1]', '"join"', '{"event": "join"}',
+                          '{"event": "join", "player": "player2", '
+                          '"time": "noon"}', 'not json'):
+            self.redis.rpush(tasks.PLAYER_EVENTS_KEY, malformed)
+        self.push('join', 'player3', 1000)
+
+        self.assertEqual(tasks.ingest_player_events(), 7)
+        self.assertEqual(
+            sorted(session.user.username
+                   for session in Session.objects.all()),
+            ['player1', 'player3'])
+        self.assertEqual(self.redis.lists[tasks.PLAYER_EVENTS_KEY], [])
+
+
+class TelemetryTest(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self._saved = tasks.redis_connection
+        tasks.redis_connection = lambda: self.redis
+        user = User.objects.create_user('steve')
+        self.start = datetime.datetime(2013, 6, 1, 12, tzinfo=utc)
+        self.instance = Instance.objects.create(
+            launched_by=user, start=self.start, state='running',
+            name='i-00000', ami='ami-00000000')
+        self.time = calendar.timegm(self.start.utctimetuple())
+
+    def tearDown(self):
+        tasks.redis_connection = self._saved
+
+    def push(self, seconds, tps=20, memory_mb=500, world='default'):
+        for second in seconds:
+            self.redis.rpush(tasks.TELEMETRY_KEY, json.dumps(
+                {'world': world, 'time': self.time + second, 'tps': tps,
+                 'memory_mb': memory_mb, 'chunks': 400,
+                 'players': {'steve': 40, 'alex': 80}}))
+
+    def test_samples_are_recorded_in_one_batch(self):
+        self.push(range(10))
+        self.push(range(10), world='unknown')
+        self.redis.rpush(tasks.TELEMETRY_KEY, '{"world": "default"}')
+
+        # Instances, samples recorded already and one insert.
+        with self.assertNumQueries(3):
+            self.assertEqual(tasks.ingest_telemetry(), 21)
+        self.assertEqual(TelemetrySample.objects.count(), 10)
+        live = json.loads(json.loads(cache.get('telemetry:default'))[1])
+        self.assertEqual((live['players'], live['latency_ms']), (2, 60))
+
+        # A replayed batch isn't recorded twice.
+        self.push(range(5, 15))
+        tasks.ingest_telemetry()
+        self.assertEqual(TelemetrySample.objects.count(), 15)
+
+    def test_downsampling(self):
+        self.push(range(60), tps=20)
+        self.push(range(60, 120), tps=10, memory_mb=900)
+        self.push(range(3600, 3660), tps=16)
+        tasks.ingest_telemetry()
+
+        telemetry.downsample(self.start + datetime.timedelta(hours=2,
+                                                             minutes=1))
+        minutes = TelemetrySample.objects.filter(resolution=60)
+        self.assertEqual([(row.count, row.tps_min, row.memory_max)
+                          for row in minutes.order_by('start')],
+                         [(60, 20, 500), (60, 10, 900), (60, 16, 500)])
+        self.assertFalse(TelemetrySample.objects.filter(resolution=1))
+
+        telemetry.downsample(self.start + datetime.timedelta(days=8))
+        hours = TelemetrySample.objects.filter(resolution=3600)
+        self.assertEqual([(row.count, row.tps_sum / row.count, row.tps_min,
+                           row.players_max, row.latency_max)
+                          for row in hours.order_by('start')],
+                         [(120, 15, 10, 2, 80), (60, 16, 16, 2, 80)])
+        self.assertEqual(TelemetrySample.objects.count(), 2)
+
+        telemetry.downsample(self.start + datetime.timedelta(days=500))
+        self.assertFalse(TelemetrySample.objects.exists())
+
+    def test_recommended_instance_type(self):
+        recommend = telemetry.recommend_instance_type
+        self.assertEqual(recommend('m1.small', 700, 19.8), 'm1.small')
+        # Out of memory, or out of CPU.
+        self.assertEqual(recommend('m1.small', 2000, 19.8), 'm1.medium')
+        self.assertEqual(recommend('m1.small', 700, 12), 'm1.medium')
+        self.assertEqual(recommend('m1.small', 700, 5), 'c1.medium')
+        # As much CPU, for less.
+        self.assertEqual(recommend('m1.large', 700, 20), 'c1.medium')
+        self.assertEqual(recommend('m1.small', 100000, 20), 'c1.xlarge')
+
+
+class RollupsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('steve', password='secret')
+        self.midnight = datetime.datetime(2013, 6, 1, tzinfo=utc)
+        self.instance = Instance.objects.create(
+            launched_by=self.user, state='terminated', name='i-00000',
+            ami='ami-00000000',
+            start=self.midnight - datetime.timedelta(hours=2),
+            end=self.midnight + datetime.timedelta(hours=3))
+
+    def test_uptime_is_split_by_day(self):
+        rollups.record_uptime(self.instance.id)
+        rollups.record_uptime(self.instance.id)
+        self.assertEqual(
+            list(DailyUptime.objects.order_by('day')
+                 .values_list('day', 'seconds')),
+            [(datetime.date(2013, 5, 31), 2*3600),
+             (datetime.date(2013, 6, 1), 3*3600)])
+
+    def test_backfill_matches_incremental_rollups(self):
+        for hours in [(-1, 1), (2, 3)]:
+            session = Session.objects.create(
+                user=self.user, instance=self.instance,
+                login=self.midnight + datetime.timedelta(hours=hours[0]),
+                logout=self.midnight + datetime.timedelta(hours=hours[1]))
+            rollups.add_playtime([(self.user.id, 'default', session.login,
+                                   session.logout)])
+        incremental = sorted(DailyPlaytime.objects
+                             .values_list('day', 'seconds'))
+        self.assertEqual(incremental,
+                         [(datetime.date(2013, 5, 31), 3600),
+                          (datetime.date(2013, 6, 1), 2*3600)])
+
+        self.assertEqual(rollups.backfill(), (2, 2))
+        self.assertEqual(sorted(DailyPlaytime.objects
+                                .values_list('day', 'seconds')),
+                         incremental)
+
+    def test_reports_read_only_rollups(self):
+        rollups.backfill()
+        self.client.login(username='steve', password='secret')
+        # Session and user lookups, then one query per report column,
+        # one for the server size report, and one for launch attempts.
+        with self.assertNumQueries(8):
+            response = self.client.get('/reports')
+        self.assertEqual(response.context['launchers'],
+                         [{'username': 'steve', 'hours': 5.0}])
+
+
+class ViewsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('steve', password='secret')
+        self.client.login(username='steve', password='secret')
+        self._saved = (settings.MINECLOUD_WORLDS, tasks.launch)
+        settings.MINECLOUD_WORLDS = ['creative', 'survival']
+        self.launched = []
+        tasks.launch = self
+        cache.clear()
+
+    def tearDown(self):
+        settings.MINECLOUD_WORLDS, tasks.launch = self._saved
+
+    def delay(self, instance_id):
+        """Record tasks.launch calls, instead of launching a server."""
+        self.launched.append(instance_id)
+
+    def test_launch_worlds_in_parallel(self):
+        self.client.post('/launch', {'world': 'creative'})
+        self.client.post('/launch', {'world': 'survival'})
+        self.client.post('/launch', {'world': 'creative'})
+        self.assertEqual(len(self.launched), 2)
+        self.assertEqual(
+            sorted(Instance.objects.values_list('world', flat=True)),
+            ['creative', 'survival'])
+
+    def test_launch_unknown_world(self):
+        response = self.client.post('/launch', {'world': 'nether'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Instance.objects.count(), 0)
+
+    def test_index_queries_dont_grow_with_worlds(self):
+        timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
+        settings.MINECLOUD_WORLDS = ['world%d' % i for i in range(10)]
+        for world in settings.MINECLOUD_WORLDS:
+            instance = Instance.objects.create(
+                launched_by=self.user, world=world, start=timestamp,
+                state='running', name='i-%s' % world, ami='ami-00000000')
+            Session.objects.create(user=self.user, instance=instance,
+                                   login=timestamp)
+
+        # Session and user lookups, then instances and sessions.
+        with self.assertNumQueries(4):
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count('class="msm-up"'), 10)
+
+    def test_index_is_cached_until_state_changes(self):
+        self.client.get('/')
+        # Only the session and user lookups.
+        with self.assertNumQueries(2):
+            response = self.client.get('/')
+        self.assertEqual(response.content.count('class="msm-down"'), 2)
+        self.assertFalse('CSRF-TOKEN-PLACEHOLDER' in response.content)
+        self.assertTrue(self.client.cookies['csrftoken'].value in
+                        response.content)
+
+        self.client.post('/launch', {'world': 'creative'})
+        response = self.client.get('/')
+        self.assertEqual(response.content.count('class="msm-down"'), 1)
+
+    def test_metrics(self):
+        send_event('instance_state', '{}')
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('minecloud_events_sent_total 1\n' in response.content)
+        self.assertTrue(
+            'minecloud_sse_event_delay_seconds_bucket{le="+Inf"} 0\n' in
+            response.content)
+
+        settings.METRICS_TOKEN = 'secret'
+        try:
+            self.assertEqual(self.client.get('/metrics/').status_code, 403)
+            self.assertEqual(
+                self.client.get('/metrics/?token=secret').status_code, 200)
+        finally:
+            settings.METRICS_TOKEN = None
+
+    def test_gauge_never_goes_below_zero(self):
+        key = metrics._key('minecloud_sse_connections')
+        cache.delete(key)
+        metrics.incr('minecloud_sse_connections', -1)
+        self.assertEqual(cache.get(key), 0)
+        metrics.incr('minecloud_sse_connections', -1)
+        metrics.incr('minecloud_sse_connections')
+        self.assertEqual(cache.get(key), 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'pgbroker needs Postgres')
+class PgBrokerTest(TransactionTestCase):
+    def broker_url(self):
+        db = connection.settings_dict
+        return 'pglisten://%s:%s@%s:%s/%s' % (
+            db['USER'], db['PASSWORD'], db['HOST'] or 'localhost',
+            db['PORT'] or 5432, db['NAME'])
+
+    def test_consumer_is_woken_by_notify(self):
+        url = self.broker_url()
+
+        def publish():
+            time.sleep(0.5)
+            try:
+                with Connection(url) as conn:
+                    conn.SimpleQueue('test').put({'n': 1})
+            finally:
+                close_connection()
+
+        with Connection(url) as conn:
+            queue = conn.SimpleQueue('test')
+            publisher = threading.Thread(target=publish)
+            started = time.time()
+            publisher.start()
+            message = queue.get(block=True, timeout=10)
+            publisher.join()
+            message.ack()
+            queue.close()
+        self.assertEqual(message.payload, {'n': 1})
+        # Well before the next poll.
+        self.assertLess(time.time() - started, 2)
+
+    def test_messages_are_claimed_once(self):
+        url = self.broker_url()
+        with Connection(url) as first:
+            with Connection(url) as second:
+                queues = [first.SimpleQueue('test'),
+                          second.SimpleQueue('test')]
+                for n in range(10):
+                    queues[0].put({'n': n})
+                received = []
+                for n in range(10):
+                    message = queues[n % 2].get(block=False)
+                    message.ack()
+                    received.append(message.payload['n'])
+                self.assertRaises(queues[0].Empty, queues[0].get,
+                                  block=False)
+                for queue in queues:
+                    queue.close()
+        self.assertEqual(received, range(10))
+
+
+class MemoryStore(object):
+    """In-memory stand-in for backup.S3Store."""
+    def __init__(self):
+        self.blobs = {}
+        self.modified = {}
+        self.puts = []
+
+    def list(self, prefix=''):
+        return [(name, self.modified[name]) for name in sorted(self.blobs)
+                if name.startswith(prefix)]
+
+    def get(self, name):
+        return self.blobs.get(name)
+
+    def put(self, name, data):
+        self.blobs[name] = data
+        self.modified[name] = time.time()
+        self.puts.append(name)
+
+    def delete(self, names):
+        for name in names:
+            del self.blobs[name]
+
+
+class BackupTest(TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+        self.world_dir = tempfile.mkdtemp()
+        self.mtime = int(time.time())
+        os.mkdir(os.path.join(self.world_dir, 'region'))
+        self.write('level.dat', 'level')
+        self.write('region/r.0.0.mca', os.urandom(backup.CHUNK_SIZE * 3))
+
+    def tearDown(self):
+        shutil.rmtree(self.world_dir)
+
+    def write(self, relpath, data, offset=0):
+        path = os.path.join(self.world_dir, relpath)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+        # Make sure the change is seen, even within the same second.
+        self.mtime += 1
+        os.utime(path, (self.mtime, self.mtime))
+
+    def chunk_puts(self):
+        puts = [name for name in self.store.puts if name.startswith('chunks/')]
+        self.store.puts = []
+        return puts
+
+    def test_backup_uploads_only_changed_chunks(self):
+        name, stats = backup.backup(self.store, self.world_dir, threads=2)
+        self.assertEqual(len(self.chunk_puts()), 4)
+        self.assertEqual(self.store.get('latest'), name)
+
+        self.write('region/r.0.0.mca', 'x' * 4096, offset=backup.CHUNK_SIZE)
+        name, stats = backup.backup(self.store, self.world_dir, threads=2)
+        self.assertEqual(len(self.chunk_puts()), 1)
+        self.assertEqual(stats['uploaded_chunks'], 1)
+
+        manifest = backup.load_manifest(self.store)
+        chunks = manifest['files']['region/r.0.0.mca']['chunks']
+        with open(os.path.join(self.world_dir, 'region/r.0.0.mca'), 'rb') as f:
+            self.assertEqual(
+                ''.join(zlib.decompress(self.store.get('chunks/' + digest))
+                        for digest in chunks),
+                f.read())
+
+    def test_restore_starts_with_spawn(self):
+        level = struct.pack('>bh', 3, 6) + 'SpawnX' + struct.pack('>i', 1000)
+        level += struct.pack('>bh', 3, 6) + 'SpawnZ' + struct.pack('>i', -20)
+        with gzip.open(os.path.join(self.world_dir, 'level.dat'), 'wb') as f:
+            f.write(level)
+        self.write('region/r.1.-1.mca', 'spawn')
+        self.write('region/r.9.9.mca', 'far away')
+        backup.backup(self.store, self.world_dir)
+
+        restore_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_dir)
+        on_disk_when_ready = []
+
+        def ready():
+            on_disk_when_ready.extend(
+                sorted(os.listdir(os.path.join(restore_dir, 'region'))))
+
+        backup.restore(self.store, restore_dir, threads=2, ready=ready)
+        self.assertEqual(on_disk_when_ready, ['r.0.0.mca', 'r.1.-1.mca'])
+        for relpath, st in backup.walk_world(self.world_dir):
+            with open(os.path.join(self.world_dir, relpath), 'rb') as f:
+                with open(os.path.join(restore_dir, relpath), 'rb') as g:
+                    self.assertEqual(f.read(), g.read())
+            self.assertEqual(
+                int(os.stat(os.path.join(restore_dir, relpath)).st_mtime),
+                int(st.st_mtime))
+
+    def test_gc_deletes_unreferenced_chunks(self):
+        first, stats = backup.backup(self.store, self.world_dir)
+        self.write('level.dat', 'changed')
+        second, stats = backup.backup(self.store, self.world_dir)
+        chunks = len(self.store.list('chunks/'))
+
+        self.assertEqual(backup.gc(self.store, keep=1), (1, 0))
+        self.assertEqual(backup.gc(self.store, keep=1, grace=-1), (0, 1))
+        self.assertEqual(len(self.store.list('chunks/')), chunks - 1)
+        self.assertEqual(self.store.list('manifests/'),
+                         [(second, self.store.modified[second])])
+
+    def test_gc_keeps_the_latest_manifest(self):
+        backup.backup(self.store, self.world_dir)
+        self.write('level.dat', 'changed')
+        latest, stats = backup.backup(self.store, self.world_dir)
+
+        self.assertEqual(backup.gc(self.store, keep=0), (1, 0))
+        self.assertEqual([name for name, modified
+                          in self.store.list('manifests/')], [latest])
+        self.assertRaises(SystemExit, backup.main, ['gc', '--keep', '0'])
+
+    def test_gc_during_backup_keeps_reused_chunks(self):
+        self.write('region/r.5.5.mca', 'old')
+        backup.backup(self.store, self.world_dir)
+        self.write('region/r.5.5.mca', 'new')
+        backup.backup(self.store, self.world_dir)
+        for name in self.store.modified:
+            self.store.modified[name] -= 60
+
+        # The region goes back to its old contents, and gc runs while
+        # the backup is past reading which chunks are stored.
+        self.write('region/r.5.5.mca', 'old')
+        collected = []
+
+        def progress(done, total):
+            if not collected:
+                collected.append(backup.gc(self.store, keep=1, grace=30))
+        backup.backup(self.store, self.world_dir, progress=progress)
+        self.assertEqual(collected, [(1, 1)])
+
+        restore_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, restore_dir)
+        backup.restore(self.store, restore_dir)
+        with open(os.path.join(restore_dir, 'region/r.5.5.mca'), 'rb') as f:
+            self.assertEqual(f.read(), 'old')
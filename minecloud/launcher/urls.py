@@ -7,5 +7,7 @@ urlpatterns = patterns('',
     url(r'^$', views.index, name="mcl_index"),
     url(r'^launch$', views.launch, name="mcl_launch"),
     url(r'^terminate$', views.terminate, name="mcl_terminate"),
+    url(r'^reports$', views.reports, name="mcl_reports"),
+    url(r'^metrics/$', views.metrics, name="mcl_metrics"),
     url(r'^sse$', login_required(views.SSE.as_view()), name="mcl_sse"),
 )
\ No newline at end of file
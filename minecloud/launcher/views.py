@@ -1,63 +1,193 @@
 import datetime
+import json
 import time
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db.models import Sum
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.middleware.csrf import get_token
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.utils.timezone import utc
 from django.views.decorators.http import require_POST
 
 from . import tasks
-from .models import Instance, Session
-from .sseview import SseView, send_event
+from .hedging import attempt_report
+from .metrics import render_metrics
+from .models import DailyPlaytime, DailyUptime, Instance, Session
+from .sseview import SseView, page_version
+from .telemetry import rightsizing
+
+# The status of the worlds is rendered once per page version (see
+# send_event), so the reload of every open tab after a state change is
+# served from the cache. The timeout bounds how stale the list of
+# players can get between state changes.
+WORLDS_CACHE_TIMEOUT = 10
+
+# The SSE channels the index page listens to.
+INDEX_SSE_CHANNELS = ('instance_state', 'restore_progress', 'backup_progress',
+                      'roster', 'telemetry')
+
+# Number of days the "recent" columns of the reports cover.
+REPORT_DAYS = 30
+
+# Stands in for the CSRF token in the cached HTML, which is shared by all
+# users.
+CSRF_TOKEN_PLACEHOLDER = 'CSRF-TOKEN-PLACEHOLDER'
 
 
 @login_required
 def index(request):
-    instance = None
-    current_sessions = None
-    err_msg = None
-    running_instances = Instance.objects.exclude(state__exact='terminated')
-    if len(running_instances) == 1: 
-        instance = running_instances[0]
-        current_sessions = (Session.objects
-            .filter(instance_id__exact=instance.id)
-            .filter(logout__isnull=True)
-        )
-    elif len(running_instances) > 1:
-        err_msg = "Error: Multiple instances are running at once."
-    return render(request, 
+    cache_key = 'index_worlds:%s' % page_version()
+    cached = cache.get(cache_key)
+    if cached is None:
+        worlds = get_worlds()
+        world_states = dict(
+            (world['name'],
+             world['instance'].state if world['instance'] else 'terminated')
+            for world in worlds)
+        worlds_html = render_to_string(
+            'launcher/worlds.html',
+            {'worlds': worlds,
+             'show_world_names': len(worlds) > 1,
+             'csrf_token': CSRF_TOKEN_PLACEHOLDER})
+        cached = (worlds_html, json.dumps(world_states))
+        cache.set(cache_key, cached, WORLDS_CACHE_TIMEOUT)
+
+    worlds_html, world_states = cached
+    worlds_html = worlds_html.replace(CSRF_TOKEN_PLACEHOLDER,
+                                      get_token(request))
+    return render(request,
                   'launcher/index.html',
-                  {'instance': instance,
-                   'sessions': current_sessions,
-                   'err_msg': err_msg})
-    
+                  {'worlds_html': mark_safe(worlds_html),
+                   'world_states': world_states,
+                   'sse_url': '%s?channels=%s' % (
+                       settings.SSE_URL or reverse('mcl_sse'),
+                       ','.join(INDEX_SSE_CHANNELS))})
+
+
+def get_worlds():
+    """
+    Return the status of each world, for the worlds.html template.
+
+    One query for all running instances, and one for all their current
+    sessions, however many worlds there are.
+
+    """
+    running_instances = list(Instance.objects
+        .filter(world__in=settings.MINECLOUD_WORLDS)
+        .exclude(state__exact='terminated')
+        .select_related('launched_by')
+    )
+    instances_by_world = {}
+    for instance in running_instances:
+        instances_by_world.setdefault(instance.world, []).append(instance)
+
+    sessions_by_instance = {}
+    current_sessions = (Session.objects
+        .filter(instance__in=[instance.id for instance in running_instances])
+        .filter(logout__isnull=True)
+        .select_related('user')
+    )
+    for session in current_sessions:
+        sessions_by_instance.setdefault(session.instance_id, []).append(session)
+
+    worlds = []
+    for name in settings.MINECLOUD_WORLDS:
+        instance = None
+        sessions = None
+        err_msg = None
+        instances = instances_by_world.get(name, [])
+        if len(instances) == 1:
+            instance = instances[0]
+            sessions = sessions_by_instance.get(instance.id)
+        elif len(instances) > 1:
+            err_msg = "Error: Multiple instances are running at once."
+        worlds.append({'name': name,
+                       'instance': instance,
+                       'sessions': sessions,
+                       'err_msg': err_msg})
+    return worlds
+
 @login_required
 @require_POST
 def launch(request):
-    # Don't launch new instance, unless all previous
-    # instances have been terminated.
-    running_instances = Instance.objects.exclude(state__exact='terminated')
-    if not running_instances:
-        timestamp = datetime.datetime.utcnow().replace(tzinfo=utc)
-        instance = Instance(launched_by=request.user,
-                            start=timestamp,
-                            state='initiating')
-        instance.save()
-        send_event('instance_state', instance.state)
-        tasks.launch.delay(instance.id)
+    world = request.POST.get('world', 'default')
+    if world not in settings.MINECLOUD_WORLDS:
+        return HttpResponseBadRequest("Unknown world.")
+
+    # No new instance is launched, unless all previous
+    # instances of this world have been terminated. Either way, the index
+    # page follows the world's instance over SSE.
+    tasks.request_launch(world, request.user)
     return redirect('mcl_index')
 
 @login_required
 @require_POST
 def terminate(request):
     instance = Instance.objects.get(pk=request.POST['instance_id'])
-    if instance:
-        instance.state = 'shutting down'
-        instance.save()
-        send_event('instance_state', instance.state)
-        tasks.terminate.delay(instance.id)
+    tasks.request_terminate(instance)
     return redirect('mcl_index')
 
 
+@login_required
+def reports(request):
+    """Playtime and uptime totals, read from the daily rollups only."""
+    today = datetime.datetime.utcnow().date()
+    since = today - datetime.timedelta(days=REPORT_DAYS - 1)
+
+    def hours(seconds):
+        return round((seconds or 0) / 3600.0, 1)
+
+    def totals_by(queryset, field):
+        return dict(queryset
+            .values_list(field)
+            .annotate(total=Sum('seconds'))
+            .order_by()
+        )
+
+    playtime = totals_by(DailyPlaytime.objects, 'user__username')
+    recent_playtime = totals_by(DailyPlaytime.objects.filter(day__gte=since),
+                                'user__username')
+    players = [{'username': username,
+                'recent': hours(recent_playtime.get(username)),
+                'total': hours(seconds)}
+               for username, seconds in sorted(
+                   playtime.items(), key=lambda item: -item[1])]
+
+    uptime = totals_by(DailyUptime.objects.filter(day__gte=since), 'day')
+    days = [{'day': day, 'hours': hours(uptime[day])}
+            for day in sorted(uptime, reverse=True)]
+
+    server_hours = totals_by(DailyUptime.objects, 'launched_by__username')
+    launchers = [{'username': username, 'hours': hours(seconds)}
+                 for username, seconds in sorted(
+                     server_hours.items(), key=lambda item: -item[1])]
+
+    since_midnight = datetime.datetime.combine(
+        since, datetime.time()).replace(tzinfo=utc)
+    return render(request,
+                  'launcher/reports.html',
+                  {'players': players,
+                   'days': days,
+                   'launchers': launchers,
+                   'rightsizing': rightsizing(since_midnight),
+                   'launch_attempts': attempt_report(since_midnight),
+                   'report_days': REPORT_DAYS})
+
+
+def metrics(request):
+    """Serve the metrics, for Prometheus or any other scraper."""
+    token = settings.METRICS_TOKEN
+    if token and request.GET.get('token') != token:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(),
+                        content_type='text/plain; version=0.0.4')
+
+
 class SSE(SseView):
     pass
@@ -0,0 +1,16 @@
+import os
+
+from .common import *
+
+# For manage.py benchsse: every process shares its cache through the
+# benchmark's Redis stand-in, instead of memcache.
+BENCH_REDIS_URL = os.getenv('MCL_BENCH_REDIS_URL', 'redis://127.0.0.1:6390/0')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'minecloud.launcher.standins.RedisCache',
+        'LOCATION': BENCH_REDIS_URL,
+    }
+}
+
+ALLOWED_HOSTS = ['127.0.0.1', 'localhost']
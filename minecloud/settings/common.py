@@ -2,10 +2,11 @@
 
 import os
 import urlparse
-import djcelery
 import dj_database_url
 
-from celery.schedules import timedelta
+from datetime import timedelta
+
+from kombu.transport import TRANSPORT_ALIASES
 from memcacheify import memcacheify
 from unipath import Path
 
@@ -104,6 +105,11 @@ STATICFILES_FINDERS = (
 #    'django.contrib.staticfiles.finders.DefaultStorageFinder',
 )
 
+# Content-hashed, precompressed copies, served by the WSGI application
+# (see minecloud.launcher.assets).
+STATICFILES_STORAGE = \
+    'minecloud.launcher.assets.PrecompressedStaticFilesStorage'
+
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = get_required_env_var('DJANGO_SECRET_KEY')
 
@@ -184,12 +190,128 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'minecloud': {
+            'handlers': ['console'],
+            'level': 'ERROR',
+            'propagate': True,
+        },
     }
 }
 
 #Celery
-BROKER_URL = os.getenv('DATABASE_URL').replace('postgres://', 'django://')
-djcelery.setup_loader()
+# Tasks are queued in the database, and workers poll for them with kombu's
+# Django transport. On Postgres 9.5 or later, set MCL_BROKER_TRANSPORT to
+# 'pglisten' to wake workers with LISTEN/NOTIFY instead (see
+# launcher/pgbroker.py).
+TRANSPORT_ALIASES['pglisten'] = 'minecloud.launcher.pgbroker:Transport'
+BROKER_TRANSPORT_NAME = os.getenv('MCL_BROKER_TRANSPORT', 'django')
+BROKER_URL = os.getenv('DATABASE_URL').replace(
+    'postgres://', '%s://' % BROKER_TRANSPORT_NAME)
+# What djcelery.setup_loader() does, without importing Celery into every
+# process that reads the settings.
+os.environ.setdefault('CELERY_LOADER', 'djcelery.loaders.DjangoLoader')
+
+CELERYBEAT_SCHEDULE = {
+    'reconcile-instances': {
+        'task': 'minecloud.launcher.tasks.reconcile',
+        'schedule': timedelta(minutes=1),
+    },
+    'fill-warm-pool': {
+        'task': 'minecloud.launcher.tasks.fill_warm_pool',
+        'schedule': timedelta(minutes=5),
+    },
+    'ingest-telemetry': {
+        'task': 'minecloud.launcher.tasks.ingest_telemetry',
+        'schedule': timedelta(seconds=5),
+    },
+    'downsample-telemetry': {
+        'task': 'minecloud.launcher.tasks.downsample_telemetry',
+        'schedule': timedelta(minutes=5),
+    },
+    'prewarm': {
+        'task': 'minecloud.launcher.tasks.prewarm',
+        'schedule': timedelta(minutes=1),
+    },
+    'shutdown-idle': {
+        'task': 'minecloud.launcher.tasks.shutdown_idle',
+        'schedule': timedelta(minutes=1),
+    },
+    'ingest-player-events': {
+        'task': 'minecloud.launcher.tasks.ingest_player_events',
+        'schedule': timedelta(seconds=5),
+    },
+}
 
 # Memcache
 CACHES = memcacheify()
+
+# Minecraft worlds, each of which gets its own server.
+# Space-separated list of slugs, also used as the S3 prefix of each
+# world's backups.
+MINECLOUD_WORLDS = os.getenv('MCL_WORLDS', 'default').split()
+
+# Number of stopped, pre-provisioned servers to keep ready for each world.
+# 0 disables the warm pool, so every launch boots a fresh server.
+MINECLOUD_WARM_POOL_SIZE = int(os.getenv('MCL_WARM_POOL_SIZE', 0))
+
+# How worlds are kept between launches:
+#   's3'  - backed up to MSM_S3_BUCKET on shutdown, restored on launch.
+#   'ebs' - kept on an EBS volume per world, which is attached on launch,
+#           and snapshotted on shutdown. The warm pool isn't used.
+MINECLOUD_PERSISTENCE = os.getenv('MCL_PERSISTENCE', 's3')
+# With 's3', a new server's userdata restores its world into
+# MINECLOUD_WORLD_DIR (see minecloud.backup), then runs
+# MINECLOUD_START_COMMAND to start the game server.
+MINECLOUD_WORLD_DIR = os.getenv('MCL_WORLD_DIR',
+                                '/opt/msm/servers/minecraft/worlds/world')
+MINECLOUD_START_COMMAND = os.getenv('MCL_START_COMMAND',
+                                    'msm minecraft start')
+# Size in GiB of new world volumes, the device they're attached as, and
+# the number of snapshots kept per world.
+MINECLOUD_EBS_VOLUME_SIZE = int(os.getenv('MCL_EBS_VOLUME_SIZE', 8))
+MINECLOUD_EBS_DEVICE = os.getenv('MCL_EBS_DEVICE', '/dev/sdf')
+MINECLOUD_EBS_SNAPSHOTS_KEPT = int(os.getenv('MCL_EBS_SNAPSHOTS_KEPT', 3))
+
+# Start each world's server shortly before players usually want it, going
+# by when they've launched it and logged in over the last few weeks (see
+# launcher/prewarm.py). A server is started if players wanted it within the
+# next MINECLOUD_PREWARM_LEAD_MINUTES in at least MINECLOUD_PREWARM_THRESHOLD
+# of recent weeks (recent weeks count for more).
+MINECLOUD_PREWARM = bool(os.getenv('MCL_PREWARM', ''))
+MINECLOUD_PREWARM_LEAD_MINUTES = int(os.getenv('MCL_PREWARM_LEAD_MINUTES', 15))
+MINECLOUD_PREWARM_THRESHOLD = float(os.getenv('MCL_PREWARM_THRESHOLD', 0.5))
+
+# Hedged launches (see launcher/hedging.py): if a new server isn't running
+# after MINECLOUD_HEDGE_AFTER_SECONDS, or EC2 can't start it, boot another
+# one in the next of these availability zones or regions ("us-west-2b",
+# "us-east-1", or "us-east-1:ami-1234abcd" to give the AMI to boot there),
+# and keep whichever is ready first. Empty disables hedging.
+MINECLOUD_HEDGE_PLACEMENTS = os.getenv('MCL_HEDGE_PLACEMENTS', '').split()
+MINECLOUD_HEDGE_AFTER_SECONDS = int(os.getenv('MCL_HEDGE_AFTER_SECONDS', 180))
+
+# Shut down running servers no one has been logged in to for this many
+# minutes. 0 leaves them running until someone shuts them down.
+MINECLOUD_IDLE_SHUTDOWN_MINUTES = int(
+    os.getenv('MCL_IDLE_SHUTDOWN_MINUTES', 0))
+
+# Seconds to wait for the game server to finish its backup on shutdown.
+# If it takes longer, the shutdown is abandoned and the server keeps
+# running, so players can try again.
+MINECLOUD_BACKUP_TIMEOUT = int(os.getenv('MCL_BACKUP_TIMEOUT', 30*60))
+
+# If set, /metrics/ must be requested with ?token=<METRICS_TOKEN>.
+METRICS_TOKEN = os.getenv('MCL_METRICS_TOKEN')
+
+# Server-sent events
+# Each SSE response ends after SSE_TIMEOUT seconds (the client reconnects),
+# and sends a heartbeat comment every SSE_HEARTBEAT_INTERVAL seconds while
+# no events happen. Set SSE_URL to serve the stream from the standalone
+# SSE server (manage.py runsseserver) instead of the Django view. If that
+# is another origin, list the origins of the pages that connect to it
+# (e.g. "https://minecloud.example.com") in SSE_ALLOWED_ORIGINS, and set
+# SESSION_COOKIE_DOMAIN so the session cookie is sent to both hosts.
+SSE_TIMEOUT = int(os.getenv('MCL_SSE_TIMEOUT', 45))
+SSE_HEARTBEAT_INTERVAL = int(os.getenv('MCL_SSE_HEARTBEAT_INTERVAL', 15))
+SSE_URL = os.getenv('MCL_SSE_URL')
+SSE_ALLOWED_ORIGINS = os.getenv('MCL_SSE_ALLOWED_ORIGINS', '').split()
+SESSION_COOKIE_DOMAIN = os.getenv('MCL_SESSION_COOKIE_DOMAIN')
@@ -2,6 +2,9 @@ from .common import *
 
 ALLOWED_HOSTS = get_required_env_var('DJANGO_ALLOWED_HOSTS').split()
 
+# /metrics/ exposes operational data, so it's never public in production.
+METRICS_TOKEN = get_required_env_var('MCL_METRICS_TOKEN')
+
 # django-secure settings
 SECURE_FRAME_DENY = 'DENY'
 SECURE_CONTENT_TYPE_NOSNIFF = True
@@ -1,4 +1,3 @@
-from django.conf import settings
 from django.conf.urls import patterns, include, url
 from django.contrib.auth.decorators import login_required
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
@@ -12,20 +11,15 @@ urlpatterns = patterns('',
     url(r'^accounts/', include('registration.auth_urls')),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^ping/', include('ping.urls')),
+    url(r'^metrics/$', views.metrics, name="mcl_metrics"),
     url(r'^sse$', login_required(views.SSE.as_view()), name="mcl_sse"),
 )
  
 urlpatterns += patterns('minecloud.launcher.views',
     url(r'^launch$', 'launch', name="mcl_launch"),
     url(r'^terminate$', 'terminate', name="mcl_terminate"),
+    url(r'^reports$', 'reports', name="mcl_reports"),
     url(r'^$', 'index', name="mcl_index"),
 )
 
 urlpatterns += staticfiles_urlpatterns()
-
-# Quick and dirty way to serve static content on Heroku.
-if not settings.DEBUG:
-    urlpatterns += patterns('',
-        (r'^static/(?P<path>.*)$', 'django.views.static.serve',
-            {'document_root': settings.STATIC_ROOT}),
-    )
@@ -23,6 +23,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "minecloud.settings.dev")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
-# Apply WSGI middleware here.
-# from helloworld.wsgi import HelloWorldApplication
-# application = HelloWorldApplication(application)
+# Serve the collected static files without going through Django. (In
+# development, runserver and staticfiles_urlpatterns serve them.)
+from django.conf import settings
+if not settings.DEBUG:
+    from minecloud.launcher.assets import StaticFilesApplication
+    application = StaticFilesApplication(application)